@@ -3,16 +3,24 @@ import os, sys
 import configparser
 import contextlib
 import datetime
+import hashlib
+import json
 import shutil
+import subprocess
 import tempfile
 import test.support
+import threading
+import time
 import unittest
+import unittest.mock
 import urllib.request as _urllib_request
 import urllib.error as _urllib_error
 import urllib.parse
 import uuid
 import warnings
+from collections import OrderedDict
 
+import feedparser
 from feedparser import parse as _feedparser_parse
 
 #
@@ -27,6 +35,7 @@ config.read(os.path.join(HERE, NAME + ".ini"))
 
 suppress_warnings = bool(int(config.get("testing", "suppress_warnings")))
 use_internet = bool(int(config.get("testing", "use_internet")))
+startup_budget = int(config.get("testing", "startup_budget"))  # ms a no network entry point may add to python3 startup
 i_am_root = os.geteuid() == 0
 
 def _internet_is_available():
@@ -169,6 +178,125 @@ class Test_get_config_file_parameter(TestPiNet):
         super().tearDown()
         os.remove(self.config_file_path)
     
+class Test_write_file(TestPiNet):
+    """Files are replaced atomically, keep their permissions, and edits
+    hold a lock that other processes using flock see.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.file_path = os.path.join(directory.name, "lts.conf")
+        self.track_original(pinet_functions, "FILE_LOCK_DIRPATH")
+        pinet_functions.FILE_LOCK_DIRPATH = os.path.join(directory.name, "locks")
+
+    def test_atomic_write(self):
+        self.assertTrue(pinet_functions.write_file(self.file_path, ["[default]", "LTSP_FATCLIENT=true"]))
+        os.chmod(self.file_path, 0o600)
+        inode = os.stat(self.file_path).st_ino
+        pinet_functions.replace_in_text_file(self.file_path, "LTSP_FATCLIENT", "LTSP_FATCLIENT=false")
+        self.assertEqual(pinet_functions.read_file(self.file_path), ["[default]", "LTSP_FATCLIENT=false"])
+        self.assertNotEqual(os.stat(self.file_path).st_ino, inode)
+        self.assertEqual(os.stat(self.file_path).st_mode & 0o777, 0o600)
+        self.assertEqual(sorted(os.listdir(self.directory)), ["locks", "lts.conf"])
+        self.assertFalse(pinet_functions.write_file(os.path.join(self.directory, "missing", "file"), ["x"]))
+
+    def test_symlink_kept(self):
+        # /var/lib/tftpboot/ltsp/armhf/lts.conf is a symlink to the chroot's lts.conf, see DuplicateLTSConf
+        self.assertTrue(pinet_functions.write_file(self.file_path, ["LTSP_FATCLIENT=true"]))
+        link_path = os.path.join(self.directory, "link.conf")
+        os.symlink(self.file_path, link_path)
+        pinet_functions.replace_in_text_file(link_path, "LTSP_FATCLIENT", "LTSP_FATCLIENT=false")
+        self.assertTrue(os.path.islink(link_path))
+        self.assertEqual(pinet_functions.read_file(self.file_path), ["LTSP_FATCLIENT=false"])
+        self.assertEqual(pinet_functions.get_file_lock_filepath(link_path),
+                         pinet_functions.get_file_lock_filepath(self.file_path))
+
+    def test_lock(self):
+        lock_file_path = pinet_functions.get_file_lock_filepath(self.file_path)
+        with pinet_functions.locked_file(self.file_path):
+            with pinet_functions.locked_file(self.file_path):
+                self.assertEqual(subprocess.call(["flock", "-n", lock_file_path, "true"]), 1)
+            self.assertEqual(subprocess.call(["flock", "-n", lock_file_path, "true"]), 1)
+        self.assertEqual(subprocess.call(["flock", "-n", lock_file_path, "true"]), 0)
+
+
+class Test_ConfigStore(TestPiNet):
+    """The config file is parsed once, reparsed when it changes on disk,
+    and sets in a transaction are written together.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.config_file_path = os.path.join(directory.name, "pinet")
+        with open(self.config_file_path, "w") as f:
+            f.write("NBD=true\nNBDuse=true\n# NBD=comment\n")
+        self.store = pinet_functions.ConfigStore(self.config_file_path)
+
+    def read(self):
+        with open(self.config_file_path) as f:
+            return f.read()
+
+    def test_exact_key(self):
+        self.store.set("NBD", "false")
+        self.store.set("ReleaseChannel", "Stable")
+        self.assertEqual(self.read(), "NBD=false\nNBDuse=true\n# NBD=comment\nReleaseChannel=Stable\n")
+
+    def test_reparse(self):
+        self.assertEqual(self.store.get("NBD"), "true")
+        with open(self.config_file_path, "a") as f:
+            f.write("FastBuild=true\n")
+        self.assertEqual(self.store.get("FastBuild"), "true")
+
+    def test_transaction(self):
+        with self.store.transaction():
+            self.store.set("NBD", "false")
+            self.store.set("NBDBuildNeeded", "true")
+            self.assertEqual(self.store.get("NBD"), "false")
+            self.assertEqual(self.read(), "NBD=true\nNBDuse=true\n# NBD=comment\n")
+        self.assertEqual(self.read(), "NBD=false\nNBDuse=true\n# NBD=comment\nNBDBuildNeeded=true\n")
+        with self.assertRaises(ValueError):
+            with self.store.transaction():
+                self.store.set("NBD", "true")
+                raise ValueError()
+        self.assertEqual(self.store.get("NBD"), "false")
+
+
+class Test_verify_groups(TestPiNet):
+    """Groups changed before a later one fails (or the user aborts) still
+    mark the NBD image as needing a rebuild.
+    """
+
+    def test_abort_keeps_rebuild_needed(self):
+        self.track_original(pinet_functions, "PINET_GROUPS")
+        self.track_original(pinet_functions, "read_file")
+        self.track_original(pinet_functions, "modify_linux_group")
+        self.track_original(pinet_functions, "add_linux_group")
+        self.track_original(pinet_functions, "get_config_store")
+        pinet_functions.PINET_GROUPS = OrderedDict([("pupil", 628), ("teacher", 629)])
+        read_file = pinet_functions.read_file
+        pinet_functions.read_file = lambda filepath: (["pupil:x:1:", "teacher:x:2:"] if filepath.endswith("/etc/group")
+                                                      else read_file(filepath))
+        modified = []
+        def _modify_linux_group(group_name, group_id, in_chroot=False):
+            if group_name == "teacher":
+                raise SystemExit(1)
+            modified.append(group_name)
+        pinet_functions.modify_linux_group = _modify_linux_group
+        pinet_functions.add_linux_group = mock_do_nothing
+        store = pinet_functions.ConfigStore(self.filepath)
+        pinet_functions.get_config_store = lambda *args: store
+        with self.assertRaises(SystemExit):
+            pinet_functions.verify_groups()
+        self.assertEqual(modified, ["pupil", "pupil"])
+        self.assertEqual(pinet_functions.get_config_file_parameter("NBDBuildNeeded", config_file_path=self.filepath),
+                         "true")
+
+
 class Test_replace_line_or_add(TestPiNet):
     """If oldstring is found in any part of a line in the input
     file, that entire line is replaced by newstring. If oldstring
@@ -213,6 +341,47 @@ class Test_replace_bit_or_add(TestPiNet):
         with open(self.filepath) as f:
             self.assertEqual(list(f), results)
 
+class Test_TextFileEditSession(TestPiNet):
+    """Edits are applied in order in one pass, report how many lines each
+    matched, and the file is only written if something changed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.track_original(pinet_functions, "FILE_LOCK_DIRPATH")
+        pinet_functions.FILE_LOCK_DIRPATH = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, pinet_functions.FILE_LOCK_DIRPATH)
+
+    def test_edits(self):
+        with pinet_functions.TextFileEditSession(self.filepath) as session:
+            session.replace("o", "0")
+            session.replace_line("qu", "slow")
+            session.add_if_missing("slow", "never added")
+            session.add_if_missing("jumps", "jumps")
+            session.replace("jump", "leap")
+            session.delete("the")
+        self.assertEqual(session.matches, [2, 1, 1, 0, 1, 1])
+        with open(self.filepath) as f:
+            self.assertEqual(list(f), ["slow\n", "br0wn\n", "f0x\n", "leaps\n"])
+
+    def test_edit_text_file(self):
+        with open(self.filepath, "a") as f:
+            f.write("\n\nREMOTE_APPS=False\n")
+        matches = pinet_functions.edit_text_file(self.filepath, ["deleteBlank", "delete", "fox", "replaceLine",
+                                                                 "REMOTE_APPS", "REMOTE_APPS=True"])
+        self.assertEqual(matches, [2, 1, 1])
+        with open(self.filepath) as f:
+            self.assertEqual(list(f), self.text[:3] + ["REMOTE_APPS=True\n"])
+        with self.assertRaises(ValueError):
+            pinet_functions.edit_text_file(self.filepath, ["sed", "fox", "dog"])
+
+    def test_unchanged(self):
+        mtime = os.stat(self.filepath).st_mtime_ns
+        time.sleep(0.01)
+        self.assertEqual(pinet_functions.edit_text_file(self.filepath, ["replace", "dog", "cat"]), [0])
+        self.assertEqual(os.stat(self.filepath).st_mtime_ns, mtime)
+
+
 class Test_CheckInternet(TestPiNet):
     """Detect whether a useful internet connection is available by
     attempting to download from a set of known-good URLs.
@@ -223,16 +392,16 @@ class Test_CheckInternet(TestPiNet):
 
     def setUp(self):
         super().setUp()
-        self.track_original(pinet_functions.urllib.request, "urlopen")
+        self.track_original(_urllib_request, "urlopen")
     
     def test_internet_on(self):
-        pinet_functions.urllib.request.urlopen = mock_urlopen(True)
+        _urllib_request.urlopen = mock_urlopen(True)
         result = pinet_functions.internet_on()
         self.assertTrue(result)
         self.assertEqual(self.read_data(), "0")
 
     def test_internet_off(self):
-        pinet_functions.urllib.request.urlopen = mock_urlopen(False)
+        _urllib_request.urlopen = mock_urlopen(False)
         result = pinet_functions.internet_on()
         self.assertFalse(result)
         self.assertEqual(self.read_data(), "1")
@@ -244,8 +413,8 @@ class Test_check_update(TestPiNet):
     
     def setUp(self):
         super().setUp()
-        self.track_original(pinet_functions.urllib.request, "urlopen")
-        self.track_original(pinet_functions.feedparser, "parse")
+        self.track_original(_urllib_request, "urlopen")
+        self.track_original(feedparser, "parse")
         self.track_original(pinet_functions, "download_file")
         self.track_original(pinet_functions, "whiptail_box")
         self.track_original(pinet_functions, "whiptail")
@@ -265,13 +434,13 @@ class Test_check_update(TestPiNet):
         super().tearDown()
 
     def test_no_internet_available(self):
-        pinet_functions.urllib.request.urlopen = mock_urlopen(False)
+        _urllib_request.urlopen = mock_urlopen(False)
         pinet_functions.check_update("1.1.1")
         self.assertEqual(self.read_data(), "0")
     
     def test_no_update_available(self):
-        pinet_functions.urllib.request.urlopen = mock_urlopen(True)
-        pinet_functions.feedparser.parse = mock_feedparser_parse("1.0.1")
+        _urllib_request.urlopen = mock_urlopen(True)
+        feedparser.parse = mock_feedparser_parse("1.0.1")
         pinet_functions.check_update("1.1.1")
         self.assertEqual(self.read_data(), "0")
 
@@ -281,8 +450,8 @@ class Test_check_update(TestPiNet):
         # for checking that there is an update to be had
         #
         pinet_functions.update_PiNet = mock_do_nothing
-        pinet_functions.urllib.request.urlopen = mock_urlopen(True)
-        pinet_functions.feedparser.parse = mock_feedparser_parse("1.0.1")
+        _urllib_request.urlopen = mock_urlopen(True)
+        feedparser.parse = mock_feedparser_parse("1.0.1")
         pinet_functions.check_update("0.9.1")
         self.assertEqual(self.read_data(), "1")
 
@@ -319,6 +488,841 @@ class Test_check_if_file_contains(TestPiNet):
         pinet_functions.check_if_file_contains(self.filepath, "***")
         self.assertEqual(self.read_data(), "0")
 
+class Test_ChrootSession(TestPiNet):
+    """Commands sent through a persistent chroot session share one shell
+    but each get their own output and return code back.
+
+    A plain bash shell stands in for ltsp-chroot so this can run anywhere.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.session = pinet_functions.ChrootSession(launch_command=["/bin/bash"], run_as_sudo=False)
+        self.addCleanup(self.session.close)
+
+    def test_output_and_return_code(self):
+        result = self.session.execute("echo hello", echo_output=False)
+        self.assertEqual((result.return_code, result.output), (0, "hello\n"))
+        result = self.session.execute("printf partial; exit 3", echo_output=False)
+        self.assertEqual((result.return_code, result.output), (3, "partial"))
+        self.assertEqual(list(result.stdout_tail), ["partial"])
+
+    def test_session_survives_failed_commands(self):
+        self.assertEqual(self.session.run("false", ignore_errors=True), 1)
+        pid = self.session.process.pid
+        self.assertTrue(self.session.run("cd /; true"))
+        self.assertEqual(self.session.process.pid, pid)
+
+    def test_ltsp_chroot_uses_session(self):
+        self.track_original(pinet_functions, "chrootSession")
+        pinet_functions.chrootSession = self.session
+        self.assertEqual(pinet_functions.ltsp_chroot(["echo", "a b"], return_string=True), "a b\n")
+        self.assertTrue(self.session.is_running())
+
+    def test_shell_dying_mid_command_fails(self):
+        result = self.session.execute("echo before; kill -9 $$", echo_output=False)
+        self.assertEqual((result.return_code, result.output), (-9, "before\n"))
+        self.assertFalse(self.session.is_running())
+
+    def test_ltsp_chroot_does_not_rerun_lost_command(self):
+        self.track_original(pinet_functions, "chrootSession")
+        self.track_original(pinet_functions, "run_bash")
+        pinet_functions.chrootSession = self.session
+        pinet_functions.run_bash = lambda command, **kwargs: self.fail("Command was run again: {}".format(command))
+        self.assertEqual(pinet_functions.ltsp_chroot("echo ran >> {}; kill -9 $$".format(self.filepath),
+                                                     ignore_errors=True), -9)
+        with open(self.filepath) as f:
+            self.assertEqual(f.read(), "".join(self.text) + "ran\n")
+
+
+class Test_run_command(TestPiNet):
+    """Commands have their output streamed into a CommandResult, with the
+    byte counts, last lines and timings, and run_bash keeps its old return
+    values on top of it.
+    """
+
+    def test_result(self):
+        result = pinet_functions.run_command("seq 1 30; echo oops >&2; exit 2", run_as_sudo=False,
+                                             capture_output=True, echo_output=False, tail_lines=3)
+        self.assertEqual(result.return_code, 2)
+        self.assertFalse(result)
+        self.assertEqual(result.output, "".join("{}\n".format(i) for i in range(1, 31)))
+        self.assertEqual(list(result.stdout_tail), ["28", "29", "30"])
+        self.assertEqual(list(result.stderr_tail), ["oops"])
+        self.assertEqual(result.stdout_bytes, len(result.output))
+        self.assertEqual(result.stderr_bytes, 5)
+        self.assertGreaterEqual(result.wall_time, 0)
+        self.assertIsNotNone(result.cpu_time)
+
+    def test_run_bash_return_values(self):
+        self.assertTrue(pinet_functions.run_bash("true", run_as_sudo=False))
+        self.assertEqual(pinet_functions.run_bash(["echo", "hi"], run_as_sudo=False, return_string=True), "hi\n")
+        self.assertEqual(pinet_functions.run_bash("exit 4", run_as_sudo=False, ignore_errors=True), 4)
+        result = pinet_functions.run_bash("echo hi", run_as_sudo=False, return_result=True)
+        self.assertEqual(result.stdout_bytes, 3)
+
+    def test_prompt_without_newline_echoed(self):
+        with test.support.captured_stdout() as stdout:
+            result = pinet_functions.run_command("printf 'Continue? [Y/n] '", run_as_sudo=False)
+            self.assertEqual(list(result.stdout_tail), ["Continue? [Y/n] "])
+            self.assertEqual(stdout.getvalue(), "Continue? [Y/n] ")
+            pinet_functions.run_bash(["echo", "captured"], run_as_sudo=False, return_string=True)
+            self.assertEqual(stdout.getvalue(), "Continue? [Y/n] ")
+
+
+class Test_profile(TestPiNet):
+    """With profiling switched on, commands and network requests are
+    recorded against the current phase and summarised in the report.
+    """
+
+    def setUp(self):
+        super().setUp()
+        profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profile_dir.cleanup)
+        self.profile_filepath = os.path.join(profile_dir.name, "pinet-profile.jsonl")
+        environ = unittest.mock.patch.dict(os.environ, {"PINET_PROFILE": "1", "PINET_PROFILE_PHASE": "buildClient",
+                                                        "PINET_PROFILE_FILE": self.profile_filepath})
+        environ.start()
+        self.addCleanup(environ.stop)
+
+    def test_events_recorded(self):
+        pinet_functions.run_command("sleep 0.1", run_as_sudo=False, echo_output=False)
+        with pinet_functions.profiled("http", "http://example.com"):
+            pass
+        events = pinet_functions.load_profile_events(self.profile_filepath)
+        self.assertEqual([(e["kind"], e["phase"]) for e in events], [("subprocess", "buildClient"), ("http", "buildClient")])
+        self.assertGreaterEqual(events[0]["duration"], 0.1)
+        self.assertEqual(events[0]["return_code"], 0)
+
+    def test_report(self):
+        pinet_functions.run_command("true", run_as_sudo=False, echo_output=False)
+        pinet_functions.run_command("sleep 0.1", run_as_sudo=False, echo_output=False)
+        report = pinet_functions.profile_report(self.profile_filepath, top_count=1)
+        self.assertIn("sleep 0.1", report)
+        self.assertNotIn(" true", report)
+        self.assertIn("     0      2      0  buildClient", report)
+        self.assertIn("Network wait - 0.0s over 0 requests", report)
+
+    def test_disabled(self):
+        os.environ["PINET_PROFILE"] = "0"
+        pinet_functions.run_command("true", run_as_sudo=False, echo_output=False)
+        self.assertFalse(os.path.exists(self.profile_filepath))
+
+
+class Test_PackageStateCache(TestPiNet):
+    """Installed, held and candidate versions come straight from dpkg's
+    status file and apt's lists, and are reloaded when those change.
+    """
+
+    status = """Package: nano
+Status: install ok installed
+Version: 2.7.4-1
+
+Package: sonic-pi
+Status: hold ok installed
+Version: 1:3.0.1
+
+Package: removed
+Status: deinstall ok config-files
+Version: 1.0
+"""
+
+    packages = """Package: nano
+Version: 2.7.4-1+deb9u1
+Size: 1234
+
+Package: sonic-pi
+Version: 1:2.10.0
+Size: 50000
+"""
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        os.makedirs(os.path.join(self.root, "var/lib/dpkg"))
+        os.makedirs(os.path.join(self.root, "var/lib/apt/lists"))
+        self.write("var/lib/dpkg/status", self.status)
+        self.write("var/lib/apt/lists/mirror_dists_stretch_main_binary-armhf_Packages", self.packages)
+        self.cache = pinet_functions.PackageStateCache(self.root)
+
+    def write(self, path, text):
+        with open(os.path.join(self.root, path), "w") as f:
+            f.write(text)
+
+    def test_queries(self):
+        self.assertEqual(self.cache.installed_version("nano"), "2.7.4-1")
+        self.assertIsNone(self.cache.installed_version("removed"))
+        self.assertTrue(self.cache.is_held("sonic-pi"))
+        self.assertFalse(self.cache.is_held("nano"))
+        self.assertEqual(self.cache.candidate("nano"), ("2.7.4-1+deb9u1", 1234))
+        self.assertFalse(self.cache.is_satisfied("nano"))
+        self.assertTrue(self.cache.is_satisfied("sonic-pi"))
+        self.assertTrue(self.cache.is_satisfied("sonic-pi", "1:3.0.1"))
+        self.assertFalse(self.cache.is_satisfied("missing"))
+
+    def test_status_change_invalidates(self):
+        self.assertFalse(self.cache.is_satisfied("nano"))
+        self.write("var/lib/dpkg/status", self.status.replace("2.7.4-1\n", "2.7.4-1+deb9u1\n"))
+        self.assertTrue(self.cache.is_satisfied("nano"))
+
+    def test_compare_debian_versions(self):
+        compare = pinet_functions.compare_debian_versions
+        self.assertEqual(compare("1.0", "1.0"), 0)
+        self.assertEqual(compare("1.0~rc1", "1.0"), -1)
+        self.assertEqual(compare("1.10", "1.9"), 1)
+        self.assertEqual(compare("1:0.1", "2.0"), 1)
+        self.assertEqual(compare("2.7.4-1", "2.7.4-1+deb9u1"), -1)
+        self.assertEqual(compare("1.0a", "1.0+"), -1)
+
+
+class Test_group_apt_installer(TestPiNet):
+    """The package list goes in with as few apt-get runs as possible, with
+    pinned versions in the same run and one apt-mark hold at the end.
+    """
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+        cache = pinet_functions.PackageStateCache(root.name)
+        self.commands = []
+        self.prefetches = []
+        self.failing = set()
+        self.track_original(pinet_functions, "get_package_state_cache")
+        self.track_original(pinet_functions, "ltsp_chroot")
+        self.track_original(pinet_functions, "run_bash")
+        self.track_original(pinet_functions, "get_package_version_to_install")
+        pinet_functions.get_package_state_cache = lambda install_on_server=False: cache
+        pinet_functions.get_package_version_to_install = lambda package_name: None
+        pinet_functions.ltsp_chroot = lambda command, **kwargs: self.run_command("chroot", command)
+        pinet_functions.run_bash = lambda command, **kwargs: self.run_command("server", command)
+
+    def run_command(self, target, command):
+        command = command.replace("env DEBIAN_FRONTEND=noninteractive ", "")
+        if "--print-uris" in command:
+            self.prefetches.append(command)
+            return ""
+        self.commands.append((target, command))
+        return 100 if any(name in command.split() for name in self.failing) else True
+
+    def write_status(self, status):
+        os.makedirs(os.path.join(self.root, "var/lib/dpkg"))
+        with open(os.path.join(self.root, "var/lib/dpkg/status"), "w") as f:
+            f.write(status)
+
+    def package(self, name, version=None, **kwargs):
+        return pinet_functions.SoftwarePackage(name, pinet_functions.APT, version=version, **kwargs)
+
+    def test_transactions(self):
+        pinet_functions.group_apt_installer([
+            self.package("nano"),
+            self.package("sonic-pi", "1:3.0.1"),
+            self.package("idle3", parameters=("--no-install-recommends",)),
+            self.package("curl", install_on_server=True),
+            self.package("nano"),
+            self.package("scratch", "1.4"),
+        ])
+        self.assertEqual(self.commands, [
+            ("chroot", "apt-get install -y --allow-downgrades --allow-change-held-packages nano sonic-pi=1:3.0.1"),
+            ("chroot", "apt-get install -y --no-install-recommends idle3"),
+            ("server", "apt-get install -y curl"),
+            ("chroot", "apt-get install -y --allow-downgrades --allow-change-held-packages scratch=1.4"),
+            ("chroot", "apt-mark hold sonic-pi scratch"),
+        ])
+        self.assertEqual(self.prefetches, [
+            "apt-get install -y --print-uris -qq --allow-downgrades --allow-change-held-packages nano sonic-pi=1:3.0.1",
+            "apt-get install -y --print-uris -qq --no-install-recommends idle3",
+            "apt-get install -y --print-uris -qq --allow-downgrades --allow-change-held-packages scratch=1.4",
+        ])
+
+    def test_manifest_order_is_kept(self):
+        pinet_functions.group_apt_installer([
+            self.package("raspberrypi-ui-mods"),
+            self.package("java-common", parameters=("--no-install-recommends",)),
+            self.package("oracle-java8-jdk"),
+            self.package("wolfram-engine"),
+        ])
+        self.assertEqual([command for target, command in self.commands], [
+            "apt-get install -y raspberrypi-ui-mods",
+            "apt-get install -y --no-install-recommends java-common",
+            "apt-get install -y oracle-java8-jdk wolfram-engine",
+        ])
+
+    def test_failed_transaction_is_bisected(self):
+        self.failing = {"p2", "p5"}
+        failed = pinet_functions.group_apt_installer([self.package("p{}".format(i)) for i in range(8)])
+        self.assertEqual(failed, ["p2", "p5"])
+        self.assertEqual([command for target, command in self.commands], [
+            "apt-get install -y p0 p1 p2 p3 p4 p5 p6 p7",
+            "apt-get install -y p0 p1 p2 p3",
+            "apt-get install -y p0 p1",
+            "apt-get install -y p2 p3",
+            "apt-get install -y p2",
+            "apt-get install -y p3",
+            "apt-get install -y p4 p5 p6 p7",
+            "apt-get install -y p4 p5",
+            "apt-get install -y p4",
+            "apt-get install -y p5",
+            "apt-get install -y p6 p7",
+        ])
+
+    def test_installed_packages_are_skipped(self):
+        self.write_status("Package: nano\nStatus: install ok installed\nVersion: 2.7.4-1\n\n"
+                          "Package: sonic-pi\nStatus: install ok installed\nVersion: 1:2.10.0\n")
+        missing, mismatched, satisfied = pinet_functions.diff_apt_packages(
+            [self.package("nano"), self.package("sonic-pi", "1:3.0.1"), self.package("idle3")])
+        self.assertEqual([[package.name for package in group] for group in (missing, mismatched, satisfied)],
+                         [["idle3"], ["sonic-pi"], ["nano"]])
+        pinet_functions.group_apt_installer([self.package("nano"), self.package("idle3")])
+        self.assertEqual(self.commands, [("chroot", "apt-get install -y idle3")])
+
+    def test_failed_packages_are_not_held(self):
+        self.failing = {"scratch=1.4"}
+        failed = pinet_functions.group_apt_installer([self.package("sonic-pi", "1:3.0.1"),
+                                                      self.package("scratch", "1.4")])
+        self.assertEqual(failed, ["scratch"])
+        self.assertEqual(self.commands[-1], ("chroot", "apt-mark hold sonic-pi"))
+
+    def test_hold_changes(self):
+        self.write_status("Package: sonic-pi\nStatus: hold ok installed\nVersion: 1:3.0.1\n\n"
+                          "Package: scratch\nStatus: hold ok installed\nVersion: 1.4\n\n"
+                          "Package: mine\nStatus: hold ok installed\nVersion: 1.0\n")
+        to_hold, to_unhold = pinet_functions.get_package_hold_changes(
+            ["sonic-pi", "raspberrypi-kernel", "nodered"], ["sonic-pi", "scratch", "raspberrypi-kernel", "nodered"])
+        self.assertEqual((to_hold, to_unhold), (["nodered", "raspberrypi-kernel"], ["scratch"]))
+        pinet_functions.apply_package_holds(to_hold, to_unhold)
+        self.assertEqual(self.commands, [("chroot", "apt-mark unhold scratch"),
+                                         ("chroot", "apt-mark hold nodered raspberrypi-kernel")])
+
+    def test_install_apt_package_holds(self):
+        self.write_status("Package: sonic-pi\nStatus: install ok installed\nVersion: 1:2.10.0\n\n"
+                          "Package: scratch\nStatus: hold ok installed\nVersion: 1.3\n")
+        pinet_functions.install_apt_package("sonic-pi", version="1:3.0.1")
+        pinet_functions.install_apt_package("scratch", version="1.4")
+        self.assertEqual(self.commands, [
+            ("chroot", "apt-get install -y --allow-downgrades --allow-change-held-packages  sonic-pi=1:3.0.1"),
+            ("chroot", "apt-mark hold sonic-pi"),
+            ("chroot", "apt-get install -y --allow-downgrades --allow-change-held-packages  scratch=1.4"),
+        ])
+
+
+class Test_AptPackageCache(TestPiNet):
+    """Downloaded .debs are kept outside the chroot, handed back to apt
+    next time and evicted least recently used first.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.cache_dirpath = os.path.join(directory.name, "apt-cache")
+        self.root = os.path.join(directory.name, "armhf")
+        self.archives = os.path.join(self.root, "var/cache/apt/archives")
+        os.makedirs(self.archives)
+        os.makedirs(os.path.join(self.root, "var/lib/dpkg"))
+        self.installed = OrderedDict()
+        self.install()
+        self.cache = pinet_functions.AptPackageCache(self.cache_dirpath, self.root, max_size=100)
+
+    def install(self, **packages):
+        """Pretend to be apt, downloading any .deb the cache didn't provide
+        """
+        for package_name, version in packages.items():
+            filepath = os.path.join(self.archives, "{}_{}_armhf.deb".format(package_name, version.replace(":", "%3a")))
+            if not os.path.exists(filepath):
+                with open(filepath, "w") as f:
+                    f.write("x" * 40)
+            self.installed[package_name] = version
+        with open(os.path.join(self.root, "var/lib/dpkg/status"), "w") as f:
+            for package_name, version in self.installed.items():
+                f.write("Package: {}\nStatus: install ok installed\nVersion: {}\n\n".format(package_name, version))
+
+    def test_hits_and_misses(self):
+        self.cache.seed()
+        self.install(nano="2.7.4-1", scratch="1:1.4")
+        self.assertEqual(self.cache.harvest(), (0, 2))
+        self.assertEqual(os.listdir(self.archives), [])
+        self.assertEqual(sorted(os.listdir(self.cache_dirpath)), ["index.json", "nano_2.7.4-1_armhf.deb",
+                                                                  "scratch_1%3a1.4_armhf.deb"])
+
+        # Rebuild - the chroot starts again with nothing installed.
+        self.installed.clear()
+        self.install()
+        self.assertEqual(self.cache.seed(), 2)
+        self.install(nano="2.7.4-1", scratch="1:1.4")
+        self.assertEqual(self.cache.harvest(), (2, 0))
+        self.assertEqual((self.cache.stats()["hits"], self.cache.stats()["misses"]), (2, 2))
+
+    def test_least_recently_used_evicted(self):
+        self.cache.seed()
+        self.install(nano="1")
+        self.cache.harvest()
+        self.cache.seed()
+        self.install(scratch="1", idle="1")
+        self.cache.harvest()
+        self.assertEqual(sorted(filename for filename in os.listdir(self.cache_dirpath) if filename.endswith(".deb")),
+                         ["idle_1_armhf.deb", "scratch_1_armhf.deb"])
+        self.assertEqual(self.cache.stats()["size"], 80)
+
+    def test_cached_apt_archives_keeps_build_error(self):
+        harvests = []
+
+        def harvest(evict=True):
+            harvests.append(evict)
+            raise OSError("disk full")
+
+        self.track_original(pinet_functions, "AptPackageCache")
+        pinet_functions.AptPackageCache = lambda: self.cache
+        self.cache.harvest = harvest
+        with self.assertRaisesRegex(ValueError, "build failed"):
+            with pinet_functions.cached_apt_archives():
+                raise ValueError("build failed")
+        with pinet_functions.cached_apt_archives():
+            pass
+        self.assertEqual(harvests, [False, True])
+        self.assertIsNone(pinet_functions.aptPackageCache)
+
+
+class Test_apt_prefetch(TestPiNet):
+    """The downloads apt would make are read from --print-uris, and
+    prefetched files are checked against apt's checksums.
+    """
+
+    def test_parse_print_uris(self):
+        output = ("'http://mirror/raspbian/pool/main/n/nano/nano_2.7.4-1_armhf.deb' nano_2.7.4-1_armhf.deb 484780 SHA256:ab12\n"
+                  "'http://mirror/raspbian/pool/main/s/sonic-pi/sonic-pi_1%3a3.0.1_armhf.deb' sonic-pi_1%3a3.0.1_armhf.deb 100 0123abcd\n"
+                  "Reading package lists...\n")
+        self.assertEqual(pinet_functions.parse_apt_print_uris(output), [
+            pinet_functions.AptDownload("http://mirror/raspbian/pool/main/n/nano/nano_2.7.4-1_armhf.deb",
+                                        "nano_2.7.4-1_armhf.deb", 484780, "SHA256:ab12"),
+            pinet_functions.AptDownload("http://mirror/raspbian/pool/main/s/sonic-pi/sonic-pi_1%3a3.0.1_armhf.deb",
+                                        "sonic-pi_1%3a3.0.1_armhf.deb", 100, "0123abcd"),
+        ])
+
+    def test_verify_download(self):
+        with open(self.filepath, "w") as f:
+            f.write("hello world\n")
+        sha256 = hashlib.sha256(b"hello world\n").hexdigest()
+        self.assertTrue(pinet_functions.verify_apt_download(self.filepath, "SHA256:" + sha256))
+        self.assertFalse(pinet_functions.verify_apt_download(self.filepath, "SHA256:" + "0" * 64))
+        self.assertTrue(pinet_functions.verify_apt_download(self.filepath, hashlib.md5(b"hello world\n").hexdigest()))
+        self.assertTrue(pinet_functions.verify_apt_download(self.filepath, ""))
+
+
+class Test_install_pip_packages(TestPiNet):
+    """All pip packages go in with one pip install per interpreter, using
+    the shared cache mounted into the chroot.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.commands = []
+        self.track_original(pinet_functions, "ltsp_chroot")
+        self.track_original(pinet_functions, "run_bash")
+        self.track_original(pinet_functions, "make_folder")
+        pinet_functions.ltsp_chroot = lambda command, **kwargs: self.run_command("chroot", command)
+        pinet_functions.run_bash = lambda command, **kwargs: self.run_command("server", command)
+        pinet_functions.make_folder = lambda directory: None
+
+    def run_command(self, target, command):
+        self.commands.append((target, " ".join(command)))
+        return 1 if "twython" in command and "pip3" in command else True
+
+    def test_batched_with_cache(self):
+        failed = pinet_functions.install_pip_packages(["pgzero", "twython", "piglow"])
+        self.assertEqual(failed, [("pip3", "twython")])
+        cache = "--cache-dir " + pinet_functions.CHROOT_PIP_CACHE_DIRPATH
+        self.assertEqual(self.commands, [
+            ("server", "mount --bind {} {}{}".format(pinet_functions.PIP_CACHE_DIRPATH, pinet_functions.CHROOT_DIRPATH,
+                                                     pinet_functions.CHROOT_PIP_CACHE_DIRPATH)),
+            ("chroot", "pip2 install -U {} pgzero twython piglow".format(cache)),
+            ("chroot", "pip3 install -U {} pgzero twython piglow".format(cache)),
+            ("chroot", "pip3 install -U {} pgzero".format(cache)),
+            ("chroot", "pip3 install -U {} twython piglow".format(cache)),
+            ("chroot", "pip3 install -U {} twython".format(cache)),
+            ("chroot", "pip3 install -U {} piglow".format(cache)),
+            ("server", "umount {}{}".format(pinet_functions.CHROOT_DIRPATH, pinet_functions.CHROOT_PIP_CACHE_DIRPATH)),
+        ])
+
+
+class Test_apt_update(TestPiNet):
+    """apt-get update only runs when the lists are older than AptUpdateTTL
+    or the apt sources have changed since the last update.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        for dirpath in ("etc/apt/sources.list.d", "var/lib/apt/lists"):
+            os.makedirs(os.path.join(self.root, dirpath))
+        self.write("etc/apt/sources.list", "deb http://mirrordirector.raspbian.org/raspbian/ stretch main\n")
+        self.write("var/lib/apt/lists/raspbian_dists_stretch_main_binary-armhf_Packages", "")
+        self.updates = 0
+        self.track_original(pinet_functions, "CHROOT_DIRPATH")
+        self.track_original(pinet_functions, "ltsp_chroot")
+        self.track_original(pinet_functions, "get_config_file_parameter")
+        pinet_functions.CHROOT_DIRPATH = self.root
+        pinet_functions.ltsp_chroot = self.ltsp_chroot
+        pinet_functions.get_config_file_parameter = lambda parameter, *args, **kwargs: None
+
+    def write(self, filepath, contents):
+        with open(os.path.join(self.root, filepath), "w") as f:
+            f.write(contents)
+
+    def ltsp_chroot(self, command, **kwargs):
+        self.updates += 1
+        return True
+
+    def test_skips_fresh_lists(self):
+        self.assertTrue(pinet_functions.apt_update())
+        self.assertTrue(pinet_functions.apt_update())
+        self.assertEqual(self.updates, 1)
+        pinet_functions.apt_update(force=True)
+        self.assertEqual(self.updates, 2)
+
+    def test_sources_change(self):
+        pinet_functions.apt_update()
+        self.write("etc/apt/sources.list.d/raspi.list", "deb http://archive.raspberrypi.org/debian/ stretch main ui\n")
+        pinet_functions.apt_update()
+        self.assertEqual(self.updates, 2)
+
+    def test_expired_or_failed(self):
+        pinet_functions.ltsp_chroot = lambda command, **kwargs: 100
+        self.assertEqual(pinet_functions.apt_update(), 100)
+        self.assertFalse(os.path.exists(os.path.join(self.root, "var/lib/apt/pinet-update-stamp")))
+        pinet_functions.ltsp_chroot = self.ltsp_chroot
+        pinet_functions.apt_update()
+        pinet_functions.get_config_file_parameter = lambda parameter, *args, **kwargs: "0"
+        pinet_functions.apt_update()
+        self.assertEqual(self.updates, 2)
+
+
+class Test_fast_build(TestPiNet):
+    """Fast build mode drops its config from the chroot when finished, then
+    runs the deferred configuration and triggers once.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        for dirpath in ("etc/dpkg/dpkg.cfg.d", "etc/apt/apt.conf.d"):
+            os.makedirs(os.path.join(directory.name, dirpath))
+        self.commands = []
+        self.track_original(pinet_functions, "CHROOT_DIRPATH")
+        self.track_original(pinet_functions, "ltsp_chroot")
+        self.track_original(pinet_functions, "run_bash")
+        pinet_functions.CHROOT_DIRPATH = directory.name
+        pinet_functions.ltsp_chroot = lambda command, **kwargs: self.commands.append(command) or True
+        pinet_functions.run_bash = lambda command, **kwargs: self.commands.append(command) or True
+
+    def test_enable_finish(self):
+        self.assertTrue(pinet_functions.finish_fast_build())
+        self.assertEqual(self.commands, [])
+        pinet_functions.enable_fast_build()
+        self.assertTrue(pinet_functions.fast_build_enabled())
+        self.assertEqual(pinet_functions.read_file(os.path.join(
+            pinet_functions.CHROOT_DIRPATH, "etc/dpkg/dpkg.cfg.d/pinet-fast-build")), ["force-unsafe-io"])
+        self.assertTrue(pinet_functions.finish_fast_build())
+        self.assertFalse(pinet_functions.fast_build_enabled())
+        self.assertEqual(self.commands, ["dpkg --configure --pending", "dpkg --triggers-only --pending", "sync"])
+
+
+class Test_BuildStageCache(TestPiNet):
+    """Rebuilds restore the snapshot of the latest stage whose inputs are
+    unchanged, and changing a stage invalidates every stage after it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = os.path.join(directory.name, "armhf")
+        self.config_filepath = os.path.join(directory.name, "pinet")
+        with open(self.config_filepath, "w") as f:
+            f.write("ReleaseChannel=Stable\nNBDBuildNeeded=false\n")
+        self.track_original(pinet_functions, "CONFIG_FILE_LOCATION")
+        self.track_original(pinet_functions, "get_config_file_parameter")
+        self.track_original(pinet_functions, "run_bash")
+        pinet_functions.CONFIG_FILE_LOCATION = self.config_filepath
+        pinet_functions.get_config_file_parameter = lambda parameter, *args, **kwargs: None
+        pinet_functions.run_bash = lambda command, **kwargs: subprocess.call(command) == 0 or 1
+        self.cache = pinet_functions.BuildStageCache(os.path.join(directory.name, "build-cache"), self.root)
+        self.stages = ["buildClient:a", "configFixes:b", "FixRepo:c"]
+
+    def build(self, stage):
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, stage), "w") as f:
+            f.write(stage)
+        self.assertTrue(self.cache.save(stage, self.stages) or stage not in self.cache.stages)
+
+    def test_keys(self):
+        keys = self.cache.get_stage_keys(self.stages)
+        self.assertEqual(list(keys), ["buildClient", "configFixes", "FixRepo"])
+        with open(self.config_filepath, "a") as f:
+            f.write("NBDBuildNeeded=true\n")
+        self.assertEqual(self.cache.get_stage_keys(self.stages), keys)
+        changed = self.cache.get_stage_keys(["buildClient:a", "configFixes:changed", "FixRepo:c"])
+        self.assertEqual(changed["buildClient"], keys["buildClient"])
+        self.assertNotEqual(changed["FixRepo"], keys["FixRepo"])
+
+    def test_save_restore(self):
+        self.assertIsNone(self.cache.restore(self.stages))
+        for stage in ("buildClient", "configFixes", "FixRepo"):
+            self.build(stage)
+        self.assertEqual(len(os.listdir(self.cache.cache_dirpath)), 2)
+        with open(os.path.join(self.root, "later"), "w") as f:
+            f.write("later")
+        self.assertEqual(self.cache.restore(self.stages), "FixRepo")
+        self.assertEqual(sorted(os.listdir(self.root)), ["FixRepo", "buildClient", "configFixes"])
+
+        self.stages[1] = "configFixes:changed"
+        self.assertEqual(self.cache.restore(self.stages), "buildClient")
+        self.assertEqual(os.listdir(self.root), ["buildClient"])
+        self.build("configFixes")
+        self.build("FixRepo")
+        self.assertEqual(len(os.listdir(self.cache.cache_dirpath)), 2)
+
+    def test_server_stages_not_cached(self):
+        pinet_functions.get_config_file_parameter = lambda parameter, *args, **kwargs: (
+            "buildClient AddSoftware" if parameter == "BuildCacheStages" else None)
+        cache = pinet_functions.BuildStageCache(self.cache.cache_dirpath, self.root)
+        self.assertEqual(cache.stages, ("buildClient",))
+        self.assertFalse(cache.save("AddSoftware", self.stages + ["AddSoftware:d"]))
+
+
+class Test_BaseRootfsCache(TestPiNet):
+    """The base rootfs is restored and upgraded while the ltsp-build-client
+    config and keyring match, and rebuilt when they change.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.root = os.path.join(directory.name, "armhf")
+        self.config_filepath = os.path.join(directory.name, "ltsp-raspbian.conf")
+        self.write_config("stretch")
+        with open(os.path.join(directory.name, "raspbian.public.key.gpg"), "w") as f:
+            f.write("key")
+        os.makedirs(os.path.join(self.root, "etc"))
+        with open(os.path.join(self.root, "etc/debian_version"), "w") as f:
+            f.write("9.4")
+        self.chroot_commands = []
+        self.track_original(pinet_functions, "run_bash")
+        self.track_original(pinet_functions, "ltsp_chroot")
+        self.track_original(pinet_functions, "apt_update")
+        pinet_functions.run_bash = self.run_bash
+        pinet_functions.ltsp_chroot = lambda command, **kwargs: self.chroot_commands.append(command) or True
+        pinet_functions.apt_update = lambda **kwargs: self.chroot_commands.append("apt-get update") or True
+        self.cache = pinet_functions.BaseRootfsCache(os.path.join(directory.name, "base-rootfs"), self.root,
+                                                     self.config_filepath)
+
+    def run_bash(self, command, return_string=False, **kwargs):
+        if return_string:
+            return "5.5.9"
+        return subprocess.call(command) == 0 or 1
+
+    def write_config(self, dist):
+        with open(self.config_filepath, "w") as f:
+            f.write("DEBOOTSTRAP_KEYRING={}\nDIST={}\nMIRROR=http://raspbian.raspberrypi.org/raspbian\n".format(
+                os.path.join(self.directory, "raspbian.public.key.gpg"), dist))
+
+    def test_save_restore(self):
+        self.assertFalse(self.cache.restore())
+        self.assertTrue(self.cache.save())
+        with open(os.path.join(self.root, "etc/debian_version"), "w") as f:
+            f.write("changed")
+        self.assertTrue(self.cache.restore())
+        self.assertEqual(pinet_functions.read_file(os.path.join(self.root, "etc/debian_version")), ["9.4"])
+        self.assertEqual(self.chroot_commands,
+                         ["apt-get update", "env DEBIAN_FRONTEND=noninteractive apt-get upgrade -y"])
+        self.write_config("buster")
+        self.assertFalse(self.cache.restore())
+
+
+class Test_software_manifest(TestPiNet):
+    """The software list is read from the manifest, and the install plan
+    diffs it against the chroot without running apt.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        self.track_original(pinet_functions, "softwareManifest")
+        self.track_original(pinet_functions, "SOFTWARE_MANIFEST_FILEPATH")
+        self.track_original(pinet_functions, "APT_CACHE_DIRPATH")
+        self.track_original(pinet_functions, "get_package_state_cache")
+        self.track_original(pinet_functions, "get_package_version_to_install")
+        self.track_original(pinet_functions, "get_package_version_manifest")
+        pinet_functions.softwareManifest = None
+        pinet_functions.SOFTWARE_MANIFEST_FILEPATH = os.path.join(self.root, "software-manifest.txt")
+        pinet_functions.APT_CACHE_DIRPATH = os.path.join(self.root, "apt-cache")
+        cache = pinet_functions.PackageStateCache(self.root)
+        pinet_functions.get_package_state_cache = lambda install_on_server=False: cache
+        pinet_functions.get_package_version_to_install = lambda package_name: None
+        pinet_functions.get_package_version_manifest = lambda: unittest.mock.Mock(
+            package_names=lambda: {"scratch", "raspberrypi-kernel"})
+
+    def write(self, filepath, contents):
+        filepath = os.path.join(self.root, filepath)
+        os.makedirs(os.path.dirname(filepath), exist_ok=True)
+        with open(filepath, "w") as f:
+            f.write(contents)
+
+    def test_default_manifest(self):
+        lines = [line for line in pinet_functions.DEFAULT_SOFTWARE_MANIFEST.splitlines()
+                 if line.strip() and not line.startswith("#")]
+        entries = pinet_functions.get_software_manifest()
+        self.assertEqual(len(entries), len(lines))
+        pcmanfm = [entry for entry in entries if entry.name == "pcmanfm"][0]
+        self.assertEqual(pcmanfm.parameters, ("-o", 'Dpkg::Options::="--force-confold"'))
+        self.assertIn("bindfs", [entry.name for entry in entries if entry.install_on_server])
+        self.assertEqual([entry.name for entry in pinet_functions.get_software_manifest("chromium")],
+                         ["chromium-browser", "rpi-chromium-mods"])
+        arduino = pinet_functions.get_software_packages("extra")[0]
+        self.assertEqual((arduino.name, arduino.install_commands), ("Arduino-IDE", ["arduino"]))
+
+    def test_install_plan(self):
+        self.write("software-manifest.txt", "\n".join([
+            "base|nano|apt|chroot",
+            "base|idle3|apt|chroot|--no-install-recommends",
+            "base|sonic-pi|apt|chroot||1:3.0.1",
+            "base|git|apt|chroot",
+            "base|broken|deb|chroot",
+            "python|pgzero|pip|chroot",
+        ]))
+        self.write("var/lib/dpkg/status", "\n".join([
+            "Package: nano\nStatus: install ok installed\nVersion: 2.0\n",
+            "Package: git\nStatus: install ok installed\nVersion: 1:2.11\n",
+            "Package: scratch\nStatus: hold ok installed\nVersion: 1.4\n",
+            "Package: sonic-pi\nStatus: install ok installed\nVersion: 1:2.0\n",
+        ]))
+        self.write("var/lib/apt/lists/raspbian_stretch_main_binary-armhf_Packages", "\n".join([
+            "Package: nano\nVersion: 2.1\nSize: 1000\n",
+            "Package: idle3\nVersion: 3.5\nSize: 2000\n",
+            "Package: git\nVersion: 1:2.11\nSize: 5000\n",
+            "Package: sonic-pi\nVersion: 1:3.0.1\nSize: 4000\n",
+        ]))
+        self.write("apt-cache/sonic-pi_1%3a3.0.1_armhf.deb", "")
+        plan = pinet_functions.get_install_plan()
+        self.assertEqual([package.name for package in plan.add], ["idle3"])
+        self.assertEqual([package.name for package in plan.upgrade], ["nano", "sonic-pi"])
+        self.assertEqual(plan.hold, [(False, "ca-certificates-java"), (False, "sonic-pi")])
+        self.assertEqual(plan.unhold, [(False, "scratch")])
+        self.assertEqual(plan.up_to_date, 1)
+        self.assertEqual((plan.download_size, plan.cached_size), (3000, 4000))
+        self.assertEqual(len(pinet_functions.get_software_manifest()), 5)
+
+
+class Test_PackageVersionManifest(TestPiNet):
+    """Pinned versions are read from the manifests once, with the PiNet-Boot
+    versions taking priority, and a missing manifest is downloaded first.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.manifest = pinet_functions.PackageVersionManifest()
+        self.manifest.package_versions_path = os.path.join(directory.name, "pinet-package-versions.txt")
+        self.manifest.bootfiles_versions_path = os.path.join(directory.name, "apt_version.txt")
+        self.manifest.retry_delay = 0
+        with open(self.manifest.bootfiles_versions_path, "w") as f:
+            f.write("raspberrypi-kernel=1.20180417-1\n")
+        self.downloads = []
+        self.track_original(pinet_functions, "download_file")
+        pinet_functions.download_file = self.download_file
+
+    def download_file(self, url, save_location):
+        self.downloads.append(url)
+        with open(save_location, "w") as f:
+            f.write("raspberrypi-kernel=1.0\nsonic-pi=1:3.0.1\n")
+        return True
+
+    def test_lookups(self):
+        self.assertEqual(self.manifest.get("raspberrypi-kernel"), "1.20180417-1")
+        self.assertEqual(self.manifest.get("sonic-pi"), "1:3.0.1")
+        self.assertIsNone(self.manifest.get("nano"))
+        self.assertEqual(self.manifest.package_names(), {"raspberrypi-kernel", "sonic-pi"})
+        self.assertEqual(len(self.downloads), 1)
+
+    def test_failed_download_keeps_old_copy(self):
+        with open(self.manifest.package_versions_path, "w") as f:
+            f.write("sonic-pi=1:2.0\n")
+        pinet_functions.download_file = lambda url, save_location: False
+        self.assertFalse(self.manifest.refresh())
+        self.assertEqual(self.manifest.get("sonic-pi"), "1:2.0")
+        self.assertFalse(os.path.exists(self.manifest.package_versions_path + ".download"))
+
+    def test_stale_copy_refreshed_before_reading(self):
+        with open(self.manifest.package_versions_path, "w") as f:
+            f.write("sonic-pi=1:2.0\n")
+        self.manifest.max_age = -1
+        self.assertEqual(self.manifest.get("sonic-pi"), "1:3.0.1")
+        self.assertEqual(len(self.downloads), 1)
+
+
+class Test_run_tasks(TestPiNet):
+    """Tasks start once the tasks they come after are done, and tasks
+    needing the same resource never run at the same time.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.events = []
+        self.lock = threading.Lock()
+
+    def step(self, name, fail=False):
+        with self.lock:
+            self.events.append(("start", name))
+        time.sleep(0.05)
+        with self.lock:
+            self.events.append(("end", name))
+        if fail:
+            raise RuntimeError(name)
+        return name
+
+    def test_dependencies_and_resources(self):
+        tasks = [pinet_functions.Task("a", self.step, ("a",), needs=(pinet_functions.CHROOT_APT,)),
+                 pinet_functions.Task("b", self.step, ("b",), needs=(pinet_functions.CHROOT_APT,)),
+                 pinet_functions.Task("c", self.step, ("c",), needs=(pinet_functions.SERVER_APT,)),
+                 pinet_functions.Task("d", self.step, ("d",), after=("a", "c"))]
+        results = pinet_functions.run_tasks(tasks, max_workers=4)
+        self.assertEqual(results, {"a": "a", "b": "b", "c": "c", "d": "d"})
+        # a and c don't conflict so both start before either finishes
+        self.assertLess(self.events.index(("start", "c")), self.events.index(("end", "a")))
+        # a and b share the chroot apt lock
+        self.assertLess(self.events.index(("end", "a")), self.events.index(("start", "b")))
+        self.assertLess(self.events.index(("end", "c")), self.events.index(("start", "d")))
+
+    def test_failed_dependency_is_skipped(self):
+        tasks = [pinet_functions.Task("a", self.step, ("a", True)),
+                 pinet_functions.Task("b", self.step, ("b",), after=("a",)),
+                 pinet_functions.Task("c", self.step, ("c",))]
+        results = pinet_functions.run_tasks(tasks)
+        self.assertEqual(results, {"c": "c"})
+        self.assertNotIn(("start", "b"), self.events)
+
+    def test_abort_waits_for_running_tasks(self):
+        def _abort():
+            time.sleep(0.01)
+            sys.exit(1)
+        tasks = [pinet_functions.Task("a", _abort, needs=(pinet_functions.CHROOT_APT,)),
+                 pinet_functions.Task("b", self.step, ("b",), needs=(pinet_functions.SERVER_APT,)),
+                 pinet_functions.Task("c", self.step, ("c",), needs=(pinet_functions.CHROOT_APT,))]
+        with self.assertRaises(SystemExit):
+            pinet_functions.run_tasks(tasks, max_workers=4)
+        self.assertEqual(self.events, [("start", "b"), ("end", "b")])
+
 @unittest.skipUnless(internet_is_available, "No internet available")
 class Test_download_file(TestPiNet):
     """Download a file and write to a position on the file system and
@@ -333,7 +1337,7 @@ class Test_download_file(TestPiNet):
         super().setUp()
         self.download_filepath = tempfile.mktemp()
         self.addCleanup(remove, self.download_filepath)
-        self.track_original(pinet_functions.urllib.request, "urlopen")
+        self.track_original(_urllib_request, "urlopen")
     
     def test_successful_download(self):
         result = pinet_functions.download_file("http://example.com", self.download_filepath)
@@ -342,7 +1346,7 @@ class Test_download_file(TestPiNet):
             self.assertIn("Example Domain", f.read())
 
     def test_unsuccessful_download(self):
-        pinet_functions.urllib.request.urlopen = mock_urlopen(False)
+        _urllib_request.urlopen = mock_urlopen(False)
         result = pinet_functions.download_file("http://example.com", self.download_filepath)
         self.assertFalse(result)
 
@@ -357,6 +1361,186 @@ class MockFilesystemMixin:
         "Turn filepath into a local filepath rooted at local_dirpath"
         return os.path.join(self.local_dirpath, filepath.lstrip(os.path.sep))
     
+class Test_serve(TestPiNet):
+    """The coprocess answers one JSON line per request, with what the entry
+    point passed to return_data and its exit code, and stops when the
+    request pipe is closed.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.request_file_path = os.path.join(directory.name, "request")
+        self.response_file_path = os.path.join(directory.name, "response")
+        os.mkfifo(self.request_file_path)
+        os.mkfifo(self.response_file_path)
+        self.track_original(pinet_functions, "get_release_channel")
+        pinet_functions.get_release_channel = mock_do_nothing
+        self.track_original(pinet_functions, "apt_update")
+        self.profile_phases = []
+        pinet_functions.apt_update = lambda **kwargs: self.profile_phases.append(os.environ.get("PINET_PROFILE_PHASE"))
+
+    def serve(self, requests):
+        responses = []
+        def _client():
+            with open(self.request_file_path, "w") as f:
+                f.writelines(requests)
+            with open(self.response_file_path) as f:
+                responses.extend(json.loads(line) for line in f)
+        client = threading.Thread(target=_client)
+        client.start()
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stderr(devnull):
+            pinet_functions.serve(self.request_file_path, self.response_file_path)
+        client.join()
+        return responses
+
+    def test_requests(self):
+        with open(self.filepath, "w") as f:
+            f.write("NBD=true\n")
+        responses = self.serve([
+            json.dumps({"args": ["buildDownloadURL", "a \"b\"", "c\nd"]}) + "\n",
+            json.dumps({"args": ["checkIfFileContainsString", self.filepath, "NBD"]}) + "\n",
+            json.dumps({"args": ["aptUpdate", "chroot"], "env": {"PINET_PROFILE_PHASE": "test"}}) + "\n",
+            "not json\n",
+        ])
+        self.assertEqual(responses.pop(0), {"status": 0, "data": "ready"})
+        self.assertEqual(responses[0]["status"], 0)
+        self.assertIn("a \"b\"", responses[0]["data"])
+        self.assertTrue(responses[0]["data"].endswith("c\nd"))
+        self.assertEqual(responses[1], {"status": 0, "data": "1"})
+        self.assertEqual(responses[2], {"status": 1, "data": ""})
+        self.assertEqual(self.profile_phases, ["test"])
+        self.assertNotIn("PINET_PROFILE_PHASE", os.environ)
+        self.assertEqual(responses[3], {"status": 1, "data": ""})
+        self.assertEqual(len(responses), 4)
+        self.assertIsNone(pinet_functions.servedData)
+        self.assertEqual(self.read_data(), "")
+
+
+class Test_answers(TestPiNet):
+    """Prompts with an answer key are answered from PINET_ANSWER_<key> or,
+    unattended, from the answers file, without running whiptail. Unattended,
+    message boxes are skipped and a prompt with no answer stops PiNet.
+    """
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.answers_file_path = os.path.join(directory.name, "answers")
+        with open(self.answers_file_path, "w") as f:
+            f.write("ReleaseChannel=Beta\nExtraSoftware=scratch java\nIPAddressCorrect=Change\nCommandFailed=retry\n")
+        self.track_original(pinet_functions, "Popen")
+        pinet_functions.Popen = unittest.mock.Mock(side_effect=AssertionError("whiptail was run"))
+        self.track_original(pinet_functions, "commandRetries")
+        pinet_functions.commandRetries = {}
+        for name in ("PINET_ANSWERS_FILE", "PINET_ANSWER_City"):
+            self.addCleanup(os.environ.pop, name, None)
+
+    def test_environment(self):
+        os.environ["PINET_ANSWER_City"] = "Belfast"
+        self.assertEqual(pinet_functions.whiptail_box("inputbox", "City", "", False, return_err=True,
+                                                      answer_key="City"), "Belfast")
+        self.assertIsNone(pinet_functions.get_prompt_answer("ReleaseChannel", default="Stable"))
+
+    def test_unattended(self):
+        os.environ["PINET_ANSWERS_FILE"] = self.answers_file_path
+        self.assertEqual(pinet_functions.whiptail_box("msgbox", "Message", "", False), 0)
+        self.assertEqual(pinet_functions.whiptail_select_menu("Release", "", ["Stable", "Beta"],
+                                                              answer_key="ReleaseChannel"), b"Beta")
+        self.assertEqual(pinet_functions.whiptail_check_list("Software", "", [], answer_key="ExtraSoftware"),
+                         b'"scratch" "java"')
+        self.assertFalse(pinet_functions.whiptail_box_yes_no("IP", "", True, custom_yes="Continue",
+                                                             custom_no="Change", answer_key="IPAddressCorrect"))
+        self.assertTrue(pinet_functions.whiptail_box("yesno", "Sure?", "", True, answer_key="ExtraSoftwareConfirm",
+                                                     default="yes"))
+        with self.assertRaises(SystemExit) as context:
+            pinet_functions.whiptail_box("yesno", "Sure?", "", True, answer_key="SudoAccess")
+        self.assertEqual(context.exception.code, pinet_functions.UNANSWERED_EXIT_CODE)
+        with self.assertRaises(SystemExit):
+            pinet_functions.whiptail_box("inputbox", "No key", "", False, return_err=True)
+
+    def test_command_failed(self):
+        os.environ["PINET_ANSWERS_FILE"] = self.answers_file_path
+        for _ in range(pinet_functions.UNATTENDED_RETRY_LIMIT):
+            self.assertFalse(pinet_functions.continue_after_failed_command("false", 1))
+        with self.assertRaises(SystemExit):
+            pinet_functions.continue_after_failed_command("false", 1)
+        self.assertFalse(pinet_functions.continue_after_failed_command("true", 1))
+
+    def test_prompt_answer_entry_point(self):
+        os.environ["PINET_ANSWER_City"] = "no"
+        for box_type, exit_code, data in (("yesno", pinet_functions.DECLINED_EXIT_CODE, ""), ("inputbox", 0, "no")):
+            with self.assertRaises(SystemExit) as context:
+                pinet_functions.run_entry_point(["", "promptAnswer", "City", box_type, ""])
+            self.assertEqual((context.exception.code, self.read_data()), (exit_code, data))
+        with self.assertRaises(SystemExit) as context:
+            pinet_functions.run_entry_point(["", "promptAnswer", "ReleaseChannel", "menu", ""])
+        self.assertEqual(context.exception.code, 255)
+
+
+class Test_startup(TestPiNet):
+    """Entry points that don't use the network start without importing
+    requests, feedparser and the like, and within the startup budget
+    (milliseconds on top of starting python3 itself).
+    """
+    slow_modules = ["concurrent.futures", "crypt", "csv", "feedparser", "netifaces", "pickle", "requests",
+                    "urllib.request", "xml.etree.ElementTree"]
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.env = dict(os.environ, PYTHONPATH=os.path.abspath(HERE), PINET_LOG_DIRPATH=directory.name,
+                        PYTHONPYCACHEPREFIX=os.path.join(directory.name, "pycache"))
+        self.env.pop("PYTHONDONTWRITEBYTECODE", None)
+        self.entry_points = [
+            ["checkIfFileContainsString", self.filepath, "fox"],
+            ["replaceLineOrAdd", self.filepath, "quick", "slow"],
+            ["CompareVersion", "1.0.0", "1.0.1"],
+            ["buildDownloadURL", "PiNet/PiNet", "Scripts/test.txt"],
+        ]
+
+    def run_python(self, *args):
+        start = time.perf_counter()
+        subprocess.check_call([sys.executable] + list(args), env=self.env, stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL)
+        return time.perf_counter() - start
+
+    def test_lazy_imports(self):
+        for entry_point in self.entry_points:
+            output = subprocess.check_output([sys.executable, "-c", "import runpy, sys; sys.argv = {!r}; "
+                                              "runpy.run_module('pinet_functions_python', run_name='__main__'); "
+                                              "print(sorted(set({!r}) & set(sys.modules)))".format(
+                                                  ["pinet_functions_python.py"] + entry_point, self.slow_modules)],
+                                             env=self.env, universal_newlines=True, stderr=subprocess.DEVNULL)
+            self.assertEqual(output.splitlines()[-1], "[]", entry_point)
+
+    def test_startup_budget(self):
+        self.run_python("-m", "pinet_functions_python")  # Compile it once, as an installed copy would be
+        python_time = min(self.run_python("-c", "pass") for _ in range(3))
+        for entry_point in self.entry_points:
+            entry_point_time = min(self.run_python("-m", "pinet_functions_python", *entry_point) for _ in range(3))
+            self.assertLess((entry_point_time - python_time) * 1000, startup_budget, entry_point)
+
+    def test_launcher_search_path(self):
+        # A module in the current folder or next to the Python functions file mustn't be imported in place of a real one
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        functions_filepath = os.path.join(directory.name, "pinet_functions_python.py")
+        shutil.copy(os.path.join(HERE, "pinet_functions_python.py"), functions_filepath)
+        for filename in ("json.py", "shlex.py"):
+            with open(os.path.join(directory.name, filename), "w") as f:
+                f.write("raise SystemExit('shadowed')\n")
+        env = dict(self.env, PythonFunctions=functions_filepath, PinetFilepath=os.path.join(HERE, "..", "pinet"))
+        del env["PYTHONPATH"]
+        subprocess.check_call(["bash", "-c", 'PythonStart={}; eval "$(sed -n "/^PythonFunctionsRun(){{/,/^}}/p" '
+                               '"$PinetFilepath")"; PythonFunctionsRun checkIfFileContainsString "$1" fox'.format(
+                                   sys.executable), "bash", self.filepath], env=env, cwd=directory.name,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
 if False:
     
     class TestDownloads(MockFilesystemMixin, TestPiNet):
@@ -549,4 +1733,5 @@ if __name__ == '__main__':
             with tempfile.TemporaryDirectory() as d:
                 import pinet_functions_python as pinet_functions
                 pinet_functions.PINET_LOG_DIRPATH = d
+                pinet_functions.setup_logger()
                 unittest.main(warnings="ignore" if suppress_warnings else None, verbosity=2)
@@ -11,38 +11,35 @@
 
 # PiNet is a utility for setting up and configuring a Linux Terminal Server Project (LTSP) network for Raspberry Pi's
 
-import crypt
-import csv
+import atexit
+import codecs
+import contextlib
 import datetime
 import errno
-import feedparser
+import fcntl
 import grp
+import hashlib
+import json
 import logging
 import os
 import os.path
-import pickle
 import pwd
 import random
 import re
-import requests
+import shlex
 import shutil
+import signal
 import socket
 import sys
 import tempfile
+import threading
 import time
 import traceback
-import urllib.error
-import urllib.request
-import xml.etree.ElementTree
-from collections import OrderedDict
+from collections import OrderedDict, deque, namedtuple
 from logging import debug
-from subprocess import Popen, PIPE, check_output, CalledProcessError
-
-try:
-    import netifaces
-except ImportError:
-    print("Unable to import netifaces. Please run sudo pip3 install netifaces")
-    netifaces = None
+from subprocess import Popen, PIPE, STDOUT, check_output, CalledProcessError, TimeoutExpired
+# requests, feedparser, netifaces and other slow to import modules are imported in the functions that use them, as
+# every $p call from the bash side that doesn't use them would pay for them otherwise.
 
 
 # basicConfig(level=WARNING)
@@ -70,17 +67,79 @@ RAW_REPOSITORY = RAW_REPOSITORY_BASE + REPOSITORY_NAME
 RAW_BOOT_REPOSITORY = RAW_REPOSITORY_BASE + BOOT_REPOSITORY
 RELEASE_BRANCH = "master"
 CONFIG_FILE_LOCATION = "/etc/pinet"
-PINET_LOG_DIRPATH = "/var/log"
+PINET_LOG_DIRPATH = os.environ.get("PINET_LOG_DIRPATH", "/var/log")
 DATA_TRANSFER_FILEPATH = "/tmp/ltsptmp"
+CHROOT_DIRPATH = "/opt/ltsp/armhf"
+APT_CACHE_DIRPATH = "/opt/PiNet/apt-cache"
+APT_CACHE_DEFAULT_MAX_SIZE = 4096  # MB
+APT_PREFETCH_WORKERS = 4
+PIP_CACHE_DIRPATH = "/opt/PiNet/pip-cache"
+APT_UPDATE_DEFAULT_TTL = 60  # minutes
+SOFTWARE_MANIFEST_FILEPATH = "/opt/PiNet/software-manifest.txt"
+DEFAULT_DOWNLOAD_SPEED = 10  # Mbit/s, used to estimate download times
+BUILD_CACHE_DIRPATH = "/opt/PiNet/build-cache"
+BASE_ROOTFS_CACHE_DIRPATH = "/opt/PiNet/base-rootfs"
+LTSP_BUILD_CONFIG_FILEPATH = "/etc/ltsp/ltsp-raspbian.conf"
+BUILD_CACHE_DEFAULT_STAGES = ("buildClient", "FixRepo")
+# Rebuild-OS stages whose changes outside the chroot pinet can redo after a restore, see BuildStageServerSide in pinet
+BUILD_CACHE_CACHEABLE_STAGES = ("buildClient", "configFixes", "FixRepo")
+BUILD_CACHE_DEFAULT_MAX_AGE = 7  # days
+# /etc/pinet settings that PiNet changes as it runs and that don't affect what is built into the chroot
+BUILD_CACHE_IGNORED_CONFIG = {"NBDBuildNeeded", "InternetConnectionLastCheckSuccess", "ShownStatsNotification",
+                              "ServerID", "City", "OrganisationName", "OrganisationType", "FirstUser",
+                              "PreviousInstalledRaspbianVersion", "AptUpdateTTL", "AptCacheMaxSize", "DownloadSpeed",
+                              "BuildCacheStages", "BuildCacheMaxAge"}
+FAST_BUILD_FILES = {  # Config files in the chroot that switch on fast build mode, see enable_fast_build()
+    "etc/dpkg/dpkg.cfg.d/pinet-fast-build": ["force-unsafe-io"],
+    "etc/apt/apt.conf.d/99pinet-fast-build": ['DPkg::NoTriggers "true";', 'DPkg::ConfigurePending "false";',
+                                              'DPkg::TriggersPending "false";'],
+}
+CHROOT_PIP_CACHE_DIRPATH = "/var/cache/pinet-pip"  # Where PIP_CACHE_DIRPATH is mounted inside the chroot
 CURRENT_RASPBIAN_RELEASE = 9
 RASPBIAN_RELEASES = {7: "Wheezy", 8: "Jessie", 9: "Stretch"}
 configFileData = {}
 fileLogger = None
+chrootSession = None
+packageVersionManifest = None
+aptPackageCache = None
+softwareManifest = None
+servedData = None  # What return_data() was given for the request serve() is running
+commandRetries = {}  # Command to times it has been retried because of an answers file
 
 APT, PIP, SCRIPT, EPOPTES, SCRATCH_GPIO, CUSTOM_APT, CUSTOM_PIP = 1, 2, 3, 4, 5, 6, 7
+INSTALL_TYPES = {"apt": APT, "pip": PIP, "script": SCRIPT, "epoptes": EPOPTES, "scratch-gpio": SCRATCH_GPIO,
+                 "custom-apt": CUSTOM_APT, "custom-pip": CUSTOM_PIP}
+ALWAYS_HELD_PACKAGES = ("ca-certificates-java",)  # Held to block OpenJDK installing, which fails to install on PiNet
+TEXT_EDIT_ACTIONS = ("replaceLine", "replace", "addIfMissing", "delete", "deleteBlank")  # See TextFileEditSession
 RASPBIAN_RELEASE = "stretch"
 STABLE, BETA, ALPHA, DEVELOPMENT = RASPBIAN_RELEASE + "-stable", RASPBIAN_RELEASE + "-beta", RASPBIAN_RELEASE + "-alpha", RASPBIAN_RELEASE + "-development"
 
+# Resources a Task can declare it needs. Tasks sharing a resource never run at the same time, unless the resource
+# allows more than one user in RESOURCE_LIMITS.
+SERVER_APT, CHROOT_APT, NETWORK, CHROOT_FS = "server_apt", "chroot_apt", "network", "chroot_fs"
+RESOURCE_LIMITS = {NETWORK: 2}
+COMMAND_OUTPUT_TAIL_LINES = 20
+# Server upgrade that never prompts, keeping the old config files, as the UpdateAll background job in pinet does
+SERVER_UPGRADE_COMMAND = "env DEBIAN_FRONTEND=noninteractive apt-get upgrade -y -o Dpkg::Options::=--force-confdef " \
+                         "-o Dpkg::Options::=--force-confold < /dev/null"
+COMMAND_OUTPUT_CHUNK_SIZE = 65536  # Most bytes of command output read at once, see stream_command_output()
+PROMPT_LOCK = threading.RLock()
+ANSWER_ENVIRONMENT_PREFIX = "PINET_ANSWER_"  # PINET_ANSWER_<key> answers the prompt with that key, see get_prompt_answer()
+YES_ANSWERS = ("yes", "y", "true", "1")
+UNATTENDED_RETRY_LIMIT = 3  # Times a failed command is retried when CommandFailed is answered with retry
+UNANSWERED_EXIT_CODE = 3  # Exit code when running unattended and a prompt has no answer
+DECLINED_EXIT_CODE = 4  # Exit code of promptAnswer for a no or cancel answer, as 1 is also what an error gives
+PROFILE_LOCK = threading.Lock()
+PROFILE_REPORT_TOP_COUNT = 20
+PACKAGE_STATE_CACHES = {}
+PACKAGE_STATE_CACHES_LOCK = threading.Lock()
+PACKAGE_VERSION_MANIFEST_LOCK = threading.Lock()
+CONFIG_STORES = {}
+CONFIG_STORES_LOCK = threading.Lock()
+FILE_LOCK_DIRPATH = "/run/lock/pinet"  # See locked_file()
+FILE_LOCKS = {}
+FILE_LOCKS_LOCK = threading.Lock()
+
 # Groups every user should be added to.
 PINET_UNRESTRICTED_GROUPS = {"adm": None,
                              "dialout": None,
@@ -145,19 +204,14 @@ class SoftwarePackage():
             programs = self.install_commands
         if self.install_type == PIP:
             self.marked = False
-            if self.install_on_server:
-                run_bash("pip2 install -U " + programs, ignore_errors=True)
-                run_bash("pip3 install -U " + programs, ignore_errors=True)
-            else:
-                ltsp_chroot("pip2 install -U " + programs, ignore_errors=True)
-                ltsp_chroot("pip3 install -U " + programs, ignore_errors=True)
+            install_pip_packages(programs.split(), install_on_server=self.install_on_server)
             return
         elif self.install_type == APT:
             self.marked = False
             install_apt_package(programs, install_on_server=self.install_on_server, parameters=self.parameters, version=self.version)
         elif self.install_type == SCRIPT:
             for i in self.install_commands:
-                run_bash("ltsp-chroot --arch armhf " + i)
+                ltsp_chroot(i)
             self.marked = False
         elif self.install_type == EPOPTES:
             install_epoptes()
@@ -174,12 +228,12 @@ class SoftwarePackage():
                 package_name = whiptail_box("inputbox", _("Custom package"),
                                             _(
                                                 "Enter the name of the name of your package from apt you wish to install."),
-                                            False, return_err=True)
+                                            False, return_err=True, answer_key="CustomAptPackage")
                 if package_name == "":
                     yes_no = whiptail_box("yesno", _("Are you sure?"),
                                           _(
                                               "Are you sure you want to cancel the installation of a custom apt package?"),
-                                          True)
+                                          True, answer_key="CustomPackageCancel", default="yes")
                     if yes_no:
                         self.marked = False
                         done = True
@@ -195,12 +249,12 @@ class SoftwarePackage():
             elif self.install_type == CUSTOM_PIP:
                 package_name = whiptail_box("inputbox", _("Custom Python package"), _(
                     "Enter the name of the name of your python package from pip you wish to install."), False,
-                                            return_err=True)
+                                            return_err=True, answer_key="CustomPipPackage")
                 if package_name == "":
                     yes_no = whiptail_box("yesno", _("Are you sure?"),
                                           _(
                                               "Are you sure you want to cancel the installation of a custom pip package?"),
-                                          True)
+                                          True, answer_key="CustomPackageCancel", default="yes")
                     if yes_no:
                         self.marked = False
                         done = True
@@ -227,6 +281,124 @@ def setup_logger():
     fileLogger.setLevel(logging.DEBUG)
 
 
+def profiling_enabled():
+    """
+    Profiling is switched on with pinet --profile, which exports PINET_PROFILE=1 for every Python call it makes.
+    """
+    return os.environ.get("PINET_PROFILE") == "1"
+
+
+def get_profile_filepath():
+    return os.environ.get("PINET_PROFILE_FILE", PINET_LOG_DIRPATH + "/pinet-profile.jsonl")
+
+
+def record_profile_event(kind, name, start, duration, **details):
+    """
+    Append a timing record to the profile file, if profiling is enabled.
+    The bash side writes to the same file, one JSON object per line.
+    :param kind: What was timed - subprocess, chroot, http, entry, python or phase.
+    :param name: The command, URL or function name.
+    :param start: Start time in seconds since the epoch.
+    :param duration: Time taken in seconds.
+    """
+    if not profiling_enabled():
+        return
+    event = OrderedDict([("kind", kind), ("name", str(name)), ("phase", os.environ.get("PINET_PROFILE_PHASE", "")),
+                         ("start", round(start, 3)), ("duration", round(duration, 3)), ("pid", os.getpid())])
+    event.update(details)
+    try:
+        with PROFILE_LOCK, open(get_profile_filepath(), "a") as profile_file:
+            profile_file.write(json.dumps(event) + "\n")
+    except OSError as e:
+        fileLogger.debug("Unable to write to profile file {}. Error was {}.".format(get_profile_filepath(), e))
+
+
+@contextlib.contextmanager
+def profiled(kind, name, **details):
+    """
+    Time the with block and record it to the profile.
+    """
+    start = time.time()
+    start_time = time.monotonic()
+    try:
+        yield
+    finally:
+        record_profile_event(kind, name, start, time.monotonic() - start_time, **details)
+
+
+def record_entry_point(name, start, start_time):
+    record_profile_event("entry", name, start, time.monotonic() - start_time)
+
+
+def load_profile_events(profile_filepath):
+    events = []
+    with open(profile_filepath) as profile_file:
+        for line in profile_file:
+            try:
+                events.append(json.loads(line))
+            except ValueError:
+                # A line cut short by a process being killed mid write.
+                continue
+    return events
+
+
+def profile_report(profile_filepath=None, top_count=PROFILE_REPORT_TOP_COUNT):
+    """
+    Summarise a profile recorded with pinet --profile.
+    The report is printed, saved next to the profile file and returned.
+    :param profile_filepath: JSON lines profile file. Defaults to the current profile file.
+    :param top_count: Number of slowest commands to list.
+    :return: Report text.
+    """
+    if not profile_filepath:
+        profile_filepath = get_profile_filepath()
+    try:
+        events = load_profile_events(profile_filepath)
+    except OSError:
+        print(_("No profile found at {}.").format(profile_filepath))
+        return ""
+
+    report = ["PiNet profile - {} ({} records)".format(profile_filepath, len(events)), ""]
+
+    phases = [event for event in events if event["kind"] == "phase"]
+    if phases:
+        report.append("Phases")
+        for event in phases:
+            report.append("{:>10.1f}s  {}".format(event["duration"], event["name"]))
+        report.append("")
+
+    commands = [event for event in events if event["kind"] in ("subprocess", "chroot", "http", "python")]
+    report.append("Slowest {} commands".format(top_count))
+    for event in sorted(commands, key=lambda e: e["duration"], reverse=True)[:top_count]:
+        report.append("{:>10.1f}s  {:<10} {:<24} {}".format(event["duration"], event["kind"], event["phase"] or "-",
+                                                           event["name"][:120]))
+    report.append("")
+
+    spawns = OrderedDict()
+    for event in events:
+        if event["kind"] in ("subprocess", "python", "chroot"):
+            phase_spawns = spawns.setdefault(event["phase"] or "-", OrderedDict([("python", 0), ("subprocess", 0),
+                                                                                ("chroot", 0)]))
+            phase_spawns[event["kind"]] += 1
+    report.append("Spawns per phase (Python calls / subprocesses / chroot session commands)")
+    for phase, counts in spawns.items():
+        report.append("{:>6} {:>6} {:>6}  {}".format(counts["python"], counts["subprocess"], counts["chroot"], phase))
+    report.append("")
+
+    network = [event for event in events if event["kind"] == "http"]
+    report.append("Network wait - {:.1f}s over {} requests".format(sum(event["duration"] for event in network),
+                                                                   len(network)))
+
+    report_text = "\n".join(report) + "\n"
+    print(report_text)
+    try:
+        with open(os.path.splitext(profile_filepath)[0] + "-report.txt", "w") as report_file:
+            report_file.write(report_text)
+    except OSError as e:
+        fileLogger.debug("Unable to save profile report. Error was {}.".format(e))
+    return report_text
+
+
 def runBashOld(command, checkFailed=False):
     # Deprecated in favor of new runBash
     if type(command) == str:
@@ -262,7 +434,154 @@ def runBashOutput(command):
     return output
 
 
-def run_bash(command, return_status=True, run_as_sudo=True, return_string=False, ignore_errors=False):
+class CommandResult():
+    """
+    Outcome of a single command run through run_command() or a ChrootSession.
+    """
+
+    command = None
+    return_code = None
+    wall_time = 0.0
+    cpu_time = None
+    stdout_bytes = 0
+    stderr_bytes = 0
+    stdout_tail = None
+    stderr_tail = None
+    output = None
+    partial_lines = None
+    decoders = None
+
+    def __init__(self, command, tail_lines=COMMAND_OUTPUT_TAIL_LINES):
+        super(CommandResult, self).__init__()
+        self.command = command
+        self.stdout_tail = deque(maxlen=tail_lines)
+        self.stderr_tail = deque(maxlen=tail_lines)
+        self.partial_lines = {"stdout": b"", "stderr": b""}
+        self.decoders = {"stdout": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+                         "stderr": codecs.getincrementaldecoder("utf-8")(errors="replace")}
+
+    def __bool__(self):
+        return self.return_code == 0
+
+    def add_output(self, stream_name, data, echo_output=True):
+        """
+        Record output from the command as it arrives.
+        :param stream_name: "stdout" or "stderr".
+        :param data: Raw bytes of output. A line that isn't finished yet (such as a dpkg or debconf prompt) is printed
+        straight away, but only logged once the rest of it arrives or finish_output() is called.
+        :param echo_output: Also print the output to the matching stream of this process.
+        """
+        if stream_name == "stderr":
+            self.stderr_bytes += len(data)
+            echo_stream = sys.stderr
+        else:
+            self.stdout_bytes += len(data)
+            echo_stream = sys.stdout
+        if echo_output:
+            echo_stream.write(self.decoders[stream_name].decode(data))
+            echo_stream.flush()
+        lines = (self.partial_lines[stream_name] + data).split(b"\n")
+        self.partial_lines[stream_name] = lines.pop()
+        for line in lines:
+            self.add_line(stream_name, line.decode(errors="replace"))
+
+    def add_line(self, stream_name, text):
+        if stream_name == "stderr":
+            self.stderr_tail.append(text)
+        else:
+            self.stdout_tail.append(text)
+        fileLogger.debug("[{}] {}".format(stream_name, text))
+
+    def finish_output(self):
+        """
+        Record the last line of each stream if the command didn't end it with a newline.
+        """
+        for stream_name in ("stdout", "stderr"):
+            if self.partial_lines[stream_name]:
+                self.add_line(stream_name, self.partial_lines[stream_name].decode(errors="replace"))
+                self.partial_lines[stream_name] = b""
+
+    def summary(self):
+        if self.cpu_time is None:
+            cpu = ""
+        else:
+            cpu = ", {:.1f}s CPU".format(self.cpu_time)
+        return "{:.1f}s{}, {} bytes stdout, {} bytes stderr".format(self.wall_time, cpu, self.stdout_bytes, self.stderr_bytes)
+
+
+def stream_command_output(pipe, result, stream_name, echo_output, captured):
+    """
+    Reader thread for run_command(). Passes whatever a pipe has to the CommandResult as soon as it arrives, without
+    waiting for the end of the line, so prompts without a trailing newline are shown.
+    :param captured: List to also collect the raw output into, or None to not keep it.
+    """
+    for chunk in iter(lambda: pipe.read1(COMMAND_OUTPUT_CHUNK_SIZE), b""):
+        result.add_output(stream_name, chunk, echo_output)
+        if captured is not None:
+            captured.append(chunk)
+    pipe.close()
+
+
+def run_command(command, run_as_sudo=True, capture_output=False, echo_output=True, interactive=False,
+                tail_lines=COMMAND_OUTPUT_TAIL_LINES):
+    """
+    Run a command, streaming its output to the terminal and the log instead of buffering it.
+    :param command: Bash command to be executed in a string or list form.
+    :param run_as_sudo: Should sudo be prefixed onto the command.
+    :param capture_output: Keep the full stdout of the command in CommandResult.output.
+    :param echo_output: Print the output to the terminal as it arrives.
+    :param interactive: Leave stdout/stderr attached to the terminal (for editors etc). Output is not logged.
+    :param tail_lines: Number of lines kept from the end of stdout and stderr.
+    :return: CommandResult, or None if the command isn't a string or list.
+    """
+    if isinstance(command, str):
+        # If is a string, set shell parameter to True to tell Popen to interpret as a single string.
+        shell = True
+        if run_as_sudo:
+            command = "sudo " + command
+    elif isinstance(command, list):
+        # If is a list, make sure Popen is expecting a list by setting shell to False.
+        shell = False
+        if run_as_sudo:
+            command = (["sudo"] + command)
+    else:
+        return None
+
+    result = CommandResult(command, tail_lines=tail_lines)
+    captured = [] if capture_output else None
+    start = time.time()
+    start_time = time.monotonic()
+    if interactive and not capture_output:
+        process = Popen(command, shell=shell)
+        readers = []
+    else:
+        process = Popen(command, shell=shell, stdout=PIPE, stderr=PIPE)
+        readers = [threading.Thread(target=stream_command_output, args=(process.stdout, result, "stdout", echo_output, captured)),
+                   threading.Thread(target=stream_command_output, args=(process.stderr, result, "stderr", echo_output, None))]
+        for reader in readers:
+            reader.daemon = True
+            reader.start()
+    # wait4 rather than Popen.wait so the CPU time used by the command (and anything it waited on) is known.
+    pid, status, usage = os.wait4(process.pid, 0)
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    for reader in readers:
+        reader.join()
+    result.finish_output()
+    result.return_code = process.returncode
+    result.wall_time = time.monotonic() - start_time
+    result.cpu_time = usage.ru_utime + usage.ru_stime
+    if captured is not None:
+        result.output = b"".join(captured).decode(errors="replace")
+    record_profile_event("subprocess", command, start, result.wall_time, return_code=result.return_code,
+                         cpu_time=round(result.cpu_time, 3))
+    return result
+
+
+def run_bash(command, return_status=True, run_as_sudo=True, return_string=False, ignore_errors=False,
+             return_result=False, interactive=False):
     """
     Run a Bash command from Python and get back its return code or returned string.
 
@@ -271,60 +590,67 @@ def run_bash(command, return_status=True, run_as_sudo=True, return_string=False,
     :param run_as_sudo: Should sudo be prefixed onto the command.
     :param return_string: Whether the actual command response string should be returned.
     :param ignore_errors: Set to True to ignore a non 0 return code.
+    :param return_result: Return the CommandResult instead of the status or string.
+    :param interactive: Command needs the terminal (for example an editor), so don't capture its output.
     :return: Return code or returned string.
     """
-    try:
-        if isinstance(command, str):
-            # If is a string, set shell parameter to True to tell Popen to interpret as a single string.
-            shell = True
-            if run_as_sudo:
-                command = "sudo " + command
-
-        elif isinstance(command, list):
-            # If is a list, make sure Popen is expecting a list by setting shell to False.
-            shell = False
-            if run_as_sudo:
-                command = (["sudo"] + command)
-
-        else:
-            return None
-
+    result = run_command(command, run_as_sudo=run_as_sudo, capture_output=return_string, echo_output=not return_string,
+                         interactive=interactive)
+    if result is None:
+        return None
+    if result.return_code == 0:
+        fileLogger.debug("Command \"" + str(result.command) + "\" executed successfully ({}).".format(result.summary()))
+        if return_result:
+            return result
         if return_string:
-            # If returning the text output.
-            command_output = check_output(command, shell=shell)
-            fileLogger.debug("Command \"" + str(command) + "\" executed successfully.")
-            return command_output.decode()
-        else:
-            # Otherwise, can run with Popen to get the return code.
-            p = Popen(command, shell=shell)
-            p.wait()
-            return_code = p.returncode
-            if return_code != 0:
-                # If process exited with an error (non 0 return code).
-                raise CalledProcessError(return_code, str(command))
-            fileLogger.debug("Command \"" + str(command) + "\" executed successfully.")
+            return result.output
+        return True
+
+    # If reaching this section, the process failed to execute correctly.
+    fileLogger.warning("Command \"" + str(result.command) + "\" failed to execute correctly with a return code of " + str(
+        result.return_code) + " ({}).".format(result.summary()))
+    if result.stderr_tail:
+        fileLogger.warning("Last lines of error output - \n" + "\n".join(result.stderr_tail))
+    if not ignore_errors and not continue_after_failed_command(result.command, result.return_code):
+        # If user Retry
+        return run_bash(command, return_status=return_status, run_as_sudo=run_as_sudo, return_string=return_string,
+                        return_result=return_result, interactive=interactive)
+    if return_result:
+        return result
+    return result.return_code
+
+
+def continue_after_failed_command(command, return_code):
+    """
+    Ask the user whether a failed command should be ignored or retried.
+    :param command: The command that failed, in string or list form.
+    :param return_code: The return code the command exited with.
+    :return: True if the user selected Continue, False if they selected Retry.
+    """
+    # The answer to CommandFailed can be continue, retry (up to UNATTENDED_RETRY_LIMIT times per command) or abort.
+    answer = get_prompt_answer("CommandFailed", _("Command failed to execute"), default="abort")
+    if answer is not None:
+        answer = answer.strip().lower()
+        if answer == "continue":
+            fileLogger.info("Failed command \"" + str(command) + "\" was ignored as answered and program continued.")
             return True
-    except CalledProcessError as c:
-        # If reaching this section, the process failed to execute correctly.
-        fileLogger.warning("Command \"" + str(command) + "\" failed to execute correctly with a return code of " + str(
-            c.returncode) + ".")
-        if not ignore_errors:
-            # If should be alerting the user to errors.
-            continue_on = whiptail_box_yes_no(_("Command failed to execute"), _(
-                "Command \"" + str(command) + "\" failed to execute correctly with a return code of " + str(
-                    c.returncode) + ". Would you like to continue and ignore the error or retry the command?"),
-                                              return_true_false=True, custom_yes=_("Continue"), custom_no=_("Retry"),
-                                              height="11")
-            if continue_on:
-                # If the user selects Continue
-                fileLogger.info("Failed command \"" + str(command) + "\" was ignored and program continued.")
-                return c.returncode
-            else:
-                # If user Retry
-                return run_bash(command, return_status=return_status, run_as_sudo=False,
-                                return_string=return_string)
-        else:
-            return c.returncode
+        if answer == "retry" and commandRetries.get(str(command), 0) < UNATTENDED_RETRY_LIMIT:
+            commandRetries[str(command)] = commandRetries.get(str(command), 0) + 1
+            return False
+        message = _("Command \"{}\" failed with a return code of {}, stopping.").format(command, return_code)
+        fileLogger.error(message)
+        print(message)
+        sys.exit(1)
+    with PROMPT_LOCK:
+        # Tasks run by run_tasks() can fail at the same time, only show one prompt at once.
+        continue_on = whiptail_box_yes_no(_("Command failed to execute"), _(
+            "Command \"" + str(command) + "\" failed to execute correctly with a return code of " + str(
+                return_code) + ". Would you like to continue and ignore the error or retry the command?"),
+                                          return_true_false=True, custom_yes=_("Continue"), custom_no=_("Retry"),
+                                          height="11")
+    if continue_on:
+        fileLogger.info("Failed command \"" + str(command) + "\" was ignored and program continued.")
+    return continue_on
 
 
 def get_users(includeRoot=False):
@@ -335,53 +661,1445 @@ def get_users(includeRoot=False):
     return users
 
 
-def ltsp_chroot(command, return_status=True, return_string=False, ignore_errors=False):
+def ltsp_chroot(command, return_status=True, return_string=False, ignore_errors=False, return_result=False):
+    global chrootSession
     if isinstance(command, str):
         ltsp_prefix = "ltsp-chroot --arch armhf "
     elif isinstance(command, list):
         ltsp_prefix = ["ltsp-chroot", "--arch", "armhf"]
     else:
         return None
+    if chrootSession is not None:
+        # Inside a persistent_chroot() block, so run the command through the already running chroot shell.
+        result = chrootSession.run(command, return_status=return_status, return_string=return_string,
+                                   ignore_errors=ignore_errors, return_result=return_result)
+        if result is not None:
+            return result
+        # The command was never sent to the shell, so it is safe to run it with its own ltsp-chroot instead.
+        fileLogger.warning("Persistent chroot session is unavailable, falling back to a new ltsp-chroot per command.")
+        chrootSession = None
     return run_bash(ltsp_prefix + command, run_as_sudo=True, return_status=return_status,
-                    return_string=return_string, ignore_errors=ignore_errors)
+                    return_string=return_string, ignore_errors=ignore_errors, return_result=return_result)
+
+
+class ChrootSession():
+    """
+    A single long lived shell inside the Raspbian chroot.
+    ltsp-chroot (and with it the /proc, /dev mounts and qemu start up) is only paid for once, then every command
+    is written to the same shell, with a marker line after each one to pick out its output and return code.
+    """
+
+    launch_command = None
+    process = None
+    marker = ""
+
+    def __init__(self, launch_command=None, run_as_sudo=True):
+        super(ChrootSession, self).__init__()
+        if launch_command is None:
+            launch_command = ["ltsp-chroot", "--arch", "armhf", "/bin/bash"]
+        if run_as_sudo:
+            launch_command = ["sudo"] + launch_command
+        self.launch_command = launch_command
+        self.marker = "PINET-CHROOT-SESSION-{}".format(random.getrandbits(64))
+        self.lock = threading.RLock()
+
+    def start(self):
+        """
+        Start the chroot shell.
+        :return: True if the shell is running.
+        """
+        try:
+            self.process = Popen(self.launch_command, stdin=PIPE, stdout=PIPE, stderr=STDOUT)
+        except OSError as e:
+            fileLogger.warning("Unable to start persistent chroot session with {}. Error was {}.".format(self.launch_command, e))
+            self.process = None
+            return False
+        # stdin of every command is /dev/null, so make sure debconf never waits on a question.
+        self.process.stdin.write(b"export DEBIAN_FRONTEND=noninteractive\n")
+        self.process.stdin.flush()
+        fileLogger.debug("Started persistent chroot session - {}".format(" ".join(self.launch_command)))
+        return True
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    def execute(self, command, echo_output=True):
+        """
+        Run a single command in the chroot shell.
+        :param command: Command to run in string or list form.
+        :param echo_output: Print the output of the command as it arrives.
+        :return: CommandResult with the output captured, or None if the shell is not running, so the command was
+        never sent. If the shell dies part way through the command, the CommandResult has a non zero return code.
+        """
+        if isinstance(command, list):
+            command = " ".join(shlex.quote(str(part)) for part in command)
+        with self.lock:
+            if self.process is None and not self.start():
+                return None
+            if not self.is_running():
+                return None
+            # Run in a subshell so "exit" or "cd" in a command can't affect the session. The newline before the
+            # marker makes sure it always starts a line of its own, even if the output didn't end with one.
+            script = "(\n{}\n) < /dev/null 2>&1\nprintf '\\n{} %d\\n' \"$?\"\n".format(command, self.marker)
+            try:
+                self.process.stdin.write(script.encode())
+                self.process.stdin.flush()
+            except (OSError, ValueError):
+                return None
+            result = CommandResult(command)
+            start = time.time()
+            start_time = time.monotonic()
+            marker = self.marker.encode()
+            output = []
+            pending = None
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    # Shell has died part way through the command, so there is no telling how far it got. Report it
+                    # as failed with the shell's exit status (never 0) rather than running it again.
+                    result.return_code = self.wait_for_exit() or 1
+                    fileLogger.warning("Persistent chroot session died while running \"{}\".".format(command))
+                    break
+                if line.startswith(marker + b" "):
+                    result.return_code = int(line.split()[1])
+                    # The last line held back always ends with the extra newline printed ahead of the marker.
+                    if pending is not None:
+                        pending = pending[:-1]
+                    break
+                if pending is not None:
+                    output.append(pending)
+                    result.add_output("stdout", pending, echo_output)
+                pending = line
+            if pending is not None:
+                output.append(pending)
+                if pending:
+                    result.add_output("stdout", pending if pending.endswith(b"\n") else pending + b"\n", echo_output)
+            result.wall_time = time.monotonic() - start_time
+            result.output = b"".join(output).decode(errors="replace")
+            record_profile_event("chroot", command, start, result.wall_time, return_code=result.return_code)
+            return result
+
+    def wait_for_exit(self):
+        """
+        Wait for the shell to exit after its output has closed, killing it if it hangs on.
+        :return: Return code of the shell.
+        """
+        try:
+            return self.process.wait(timeout=60)
+        except TimeoutExpired:
+            self.process.kill()
+            return self.process.wait()
+
+    def run(self, command, return_status=True, return_string=False, ignore_errors=False, return_result=False):
+        """
+        Run a command in the chroot shell, with the same return values and error handling as run_bash.
+        :return: True, the output string if return_string is set, the CommandResult if return_result is set, the
+        return code on failure (including the shell dying part way through), or None if the shell is not running.
+        """
+        result = self.execute(command, echo_output=not return_string)
+        if result is None:
+            return None
+        if result.return_code == 0:
+            fileLogger.debug("Chroot command \"" + str(command) + "\" executed successfully ({}).".format(result.summary()))
+            if return_result:
+                return result
+            if return_string:
+                return result.output
+            return True
+        fileLogger.warning("Chroot command \"" + str(command) + "\" failed to execute correctly with a return code of " + str(
+            result.return_code) + " ({}).".format(result.summary()))
+        if not ignore_errors and not continue_after_failed_command(command, result.return_code):
+            return self.run(command, return_status=return_status, return_string=return_string,
+                            return_result=return_result)
+        if return_result:
+            return result
+        return result.return_code
+
+    def close(self):
+        if self.process is None:
+            return
+        with self.lock:
+            try:
+                self.process.stdin.write(b"exit\n")
+                self.process.stdin.close()
+            except (OSError, ValueError):
+                pass
+            try:
+                self.process.wait(timeout=60)
+            except TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+            fileLogger.debug("Closed persistent chroot session with return code {}.".format(self.process.returncode))
+            self.process = None
+
+
+@contextlib.contextmanager
+def persistent_chroot():
+    """
+    Route every ltsp_chroot() call inside the with block through one ChrootSession.
+    The session is only started on the first chroot command, so wrapping code that might not touch the chroot is free.
+    """
+    global chrootSession
+    if chrootSession is not None:
+        # Already inside a session, so just reuse it.
+        yield chrootSession
+        return
+    session = ChrootSession()
+    chrootSession = session
+    try:
+        yield session
+    finally:
+        if chrootSession is session:
+            chrootSession = None
+        session.close()
+
+
+class Task():
+    """
+    A single step for run_tasks().
+    """
+
+    name = ""
+    function = None
+    args = ()
+    needs = ()
+    after = ()
+
+    def __init__(self, name, function, args=(), needs=(), after=()):
+        """
+        :param name: Unique name of the task, used by other tasks in after.
+        :param function: Function to run.
+        :param args: Arguments to pass to the function.
+        :param needs: Resources (SERVER_APT, CHROOT_APT, NETWORK, CHROOT_FS) the task uses while running.
+        :param after: Names of tasks that must finish before this one starts.
+        """
+        super(Task, self).__init__()
+        self.name = name
+        self.function = function
+        self.args = args
+        self.needs = needs
+        self.after = after
+
+
+def run_tasks(tasks, max_workers=None):
+    """
+    Run a group of Tasks, starting any task whose dependencies are done and whose resources are free.
+    Tasks that don't conflict run at the same time on a bounded pool of worker threads.
+    :param tasks: List of Task objects. List order is used as priority when more than one task could start.
+    :param max_workers: Maximum tasks running at once. Defaults to number of CPUs, up to 4.
+    :return: Dictionary of task name to returned value. Tasks that raised an exception, or depend on one that did,
+    are missing.
+    If a task raises SystemExit (the user aborting a failed command) or KeyboardInterrupt, the tasks not started yet
+    are dropped, the running ones are waited for, then it is raised again.
+    """
+    import concurrent.futures
+    if max_workers is None:
+        max_workers = min(4, os.cpu_count() or 1)
+    task_names = set(task.name for task in tasks)
+    pending = list(tasks)
+    running = {}
+    resources_in_use = {}
+    finished, failed = set(), set()
+    results = {}
+    stop = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for task in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if any(dependency in failed for dependency in task.after):
+                    fileLogger.warning("Skipping task {} as a task it depends on failed.".format(task.name))
+                    pending.remove(task)
+                    failed.add(task.name)
+                    continue
+                if any(dependency in task_names and dependency not in finished for dependency in task.after):
+                    continue
+                if any(resources_in_use.get(resource, 0) >= RESOURCE_LIMITS.get(resource, 1) for resource in task.needs):
+                    continue
+                for resource in task.needs:
+                    resources_in_use[resource] = resources_in_use.get(resource, 0) + 1
+                pending.remove(task)
+                fileLogger.debug("Starting task {}.".format(task.name))
+                running[pool.submit(task.function, *task.args)] = task
+            if not running:
+                if pending:
+                    # Nothing running and nothing able to start, so whatever is left is waiting on itself.
+                    fileLogger.error("Unable to run tasks {} due to a dependency loop.".format(", ".join(task.name for task in pending)))
+                break
+            done, not_done = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                for resource in task.needs:
+                    resources_in_use[resource] -= 1
+                try:
+                    results[task.name] = future.result()
+                    finished.add(task.name)
+                    fileLogger.debug("Task {} complete.".format(task.name))
+                except Exception:
+                    failed.add(task.name)
+                    fileLogger.error("Task {} failed.\n{}".format(task.name, traceback.format_exc()))
+                except BaseException as e:
+                    failed.add(task.name)
+                    if stop is None:
+                        stop = e
+                        if pending:
+                            fileLogger.warning("Task {} stopped, so not starting tasks {}.".format(
+                                task.name, ", ".join(pending_task.name for pending_task in pending)))
+                        failed.update(pending_task.name for pending_task in pending)
+                        pending = []
+    if stop is not None:
+        raise stop
+    return results
+
+
+def debian_version_part_order(char):
+    """
+    Sort order of a single non digit character in a Debian version. ~ sorts before everything, even the end of
+    the string, and letters sort before other symbols.
+    """
+    if char == "~":
+        return -1
+    if char.isalpha():
+        return ord(char)
+    return ord(char) + 256
+
+
+def compare_debian_version_parts(first, second):
+    """
+    Compare an upstream version or revision the same way dpkg does, alternating between non digit and digit runs.
+    :return: -1, 0 or 1.
+    """
+    first_index, second_index = 0, 0
+    while first_index < len(first) or second_index < len(second):
+        # Non digit run, compared character by character. The end of the string counts as 0.
+        while (first_index < len(first) and not first[first_index].isdigit()) or (
+                second_index < len(second) and not second[second_index].isdigit()):
+            first_order = 0
+            second_order = 0
+            if first_index < len(first) and not first[first_index].isdigit():
+                first_order = debian_version_part_order(first[first_index])
+            if second_index < len(second) and not second[second_index].isdigit():
+                second_order = debian_version_part_order(second[second_index])
+            if first_order != second_order:
+                return -1 if first_order < second_order else 1
+            first_index += 1
+            second_index += 1
+        # Digit run, compared as a number.
+        first_start, second_start = first_index, second_index
+        while first_index < len(first) and first[first_index].isdigit():
+            first_index += 1
+        while second_index < len(second) and second[second_index].isdigit():
+            second_index += 1
+        first_number = int(first[first_start:first_index] or "0")
+        second_number = int(second[second_start:second_index] or "0")
+        if first_number != second_number:
+            return -1 if first_number < second_number else 1
+    return 0
+
+
+def compare_debian_versions(first, second):
+    """
+    Compare 2 Debian package versions ([epoch:]upstream[-revision]).
+    :return: -1 if first is older, 0 if they are the same, 1 if first is newer.
+    """
+    versions = []
+    for version in (first, second):
+        epoch, colon, rest = version.partition(":")
+        if not colon:
+            epoch, rest = "0", version
+        upstream, dash, revision = rest.rpartition("-")
+        if not dash:
+            upstream, revision = rest, ""
+        versions.append((int(epoch or "0"), upstream, revision))
+    if versions[0][0] != versions[1][0]:
+        return -1 if versions[0][0] < versions[1][0] else 1
+    return compare_debian_version_parts(versions[0][1], versions[1][1]) or compare_debian_version_parts(
+        versions[0][2], versions[1][2])
+
+
+class PackageStateCache():
+    """
+    Read only view of the packages installed, held and available in a root filesystem (the Raspbian chroot or the
+    server), built straight from dpkg's status file and apt's package lists instead of running dpkg or apt-cache.
+    The status file is reparsed whenever its mtime or size changes, and the package lists whenever any of them do.
+    The candidate version is the newest version in the package lists, apt pinning is not taken into account.
+    """
+
+    root = "/"
+    status_signature = None
+    lists_signature = None
+
+    def __init__(self, root="/"):
+        super(PackageStateCache, self).__init__()
+        self.root = root
+        self.lock = threading.RLock()
+        self.installed = {}
+        self.held = set()
+        self.candidates = {}
+
+    def get_status_filepath(self):
+        return os.path.join(self.root, "var/lib/dpkg/status")
+
+    def get_lists_dirpath(self):
+        return os.path.join(self.root, "var/lib/apt/lists")
+
+    def refresh_status(self):
+        try:
+            stat = os.stat(self.get_status_filepath())
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+        if signature == self.status_signature:
+            return
+        installed = {}
+        held = set()
+        if signature is not None:
+            for fields in self.read_stanzas(self.get_status_filepath(), ("Package", "Status", "Version")):
+                status = fields.get("Status", "").split()
+                if "Package" not in fields or len(status) != 3:
+                    continue
+                if status[0] == "hold":
+                    held.add(fields["Package"])
+                if status[2] == "installed":
+                    installed[fields["Package"]] = fields.get("Version")
+        self.installed, self.held, self.status_signature = installed, held, signature
+        fileLogger.debug("Loaded dpkg status for {} - {} packages installed, {} held.".format(self.root, len(installed),
+                                                                                                len(held)))
+
+    def refresh_lists(self):
+        lists_dirpath = self.get_lists_dirpath()
+        signature = []
+        try:
+            for filename in sorted(os.listdir(lists_dirpath)):
+                if filename.endswith("_Packages"):
+                    stat = os.stat(os.path.join(lists_dirpath, filename))
+                    signature.append((filename, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            pass
+        signature = tuple(signature)
+        if signature == self.lists_signature:
+            return
+        candidates = {}
+        for filename, mtime, size in signature:
+            for fields in self.read_stanzas(os.path.join(lists_dirpath, filename), ("Package", "Version", "Size")):
+                if "Package" not in fields or "Version" not in fields:
+                    continue
+                current = candidates.get(fields["Package"])
+                if current is None or compare_debian_versions(fields["Version"], current[0]) > 0:
+                    candidates[fields["Package"]] = (fields["Version"], int(fields.get("Size", 0)))
+        self.candidates, self.lists_signature = candidates, signature
+        fileLogger.debug("Loaded apt package lists for {} - {} packages available.".format(self.root, len(candidates)))
+
+    @staticmethod
+    def read_stanzas(filepath, wanted_fields):
+        """
+        Read the wanted fields out of a Debian control style file (dpkg status, apt Packages lists).
+        :return: Generator of dictionaries, one for each stanza.
+        """
+        prefixes = tuple(field + ":" for field in wanted_fields)
+        fields = {}
+        with open(filepath, encoding="utf-8", errors="replace") as control_file:
+            for line in control_file:
+                if line == "\n":
+                    if fields:
+                        yield fields
+                    fields = {}
+                elif line.startswith(prefixes):
+                    field, _colon, value = line.partition(":")
+                    fields[field] = value.strip()
+        if fields:
+            yield fields
+
+    def installed_version(self, package_name):
+        with self.lock:
+            self.refresh_status()
+            return self.installed.get(package_name)
+
+    def is_held(self, package_name):
+        with self.lock:
+            self.refresh_status()
+            return package_name in self.held
+
+    def held_packages(self):
+        with self.lock:
+            self.refresh_status()
+            return set(self.held)
+
+    def candidate(self, package_name):
+        """
+        :return: Tuple of (version, download size in bytes) for the newest available version, or None.
+        """
+        with self.lock:
+            self.refresh_lists()
+            return self.candidates.get(package_name)
+
+    def candidate_version(self, package_name):
+        candidate = self.candidate(package_name)
+        return candidate[0] if candidate else None
+
+    def is_satisfied(self, package_name, version=None):
+        """
+        Would installing this package be a no-op?
+        :param package_name: Package to check.
+        :param version: Specific version wanted, or None for the newest available.
+        :return: True if the package is installed at the wanted version, or at least the candidate version.
+        """
+        installed = self.installed_version(package_name)
+        if installed is None:
+            return False
+        if version:
+            return installed == version
+        candidate = self.candidate_version(package_name)
+        return candidate is None or compare_debian_versions(installed, candidate) >= 0
+
+
+class AptPackageCache():
+    """
+    Store of downloaded .deb files kept outside the chroot, so they survive Rebuild-OS removing /opt/ltsp/armhf.
+    Before apt runs in the chroot, the cached .debs are hard linked into the chroot's apt archives directory (seed),
+    so apt finds them already downloaded. Afterwards, anything new apt downloaded is linked back into the cache and
+    the chroot's archives directory emptied (harvest). Least recently used files are evicted to keep the cache under
+    AptCacheMaxSize (MB) from /etc/pinet.
+    Hits and misses are worked out from which packages changed version in dpkg's status file between seed and harvest,
+    and whether their .deb came from the cache.
+    """
+
+    cache_dirpath = APT_CACHE_DIRPATH
+    root = CHROOT_DIRPATH
+    max_size = APT_CACHE_DEFAULT_MAX_SIZE * 1024 * 1024
+
+    def __init__(self, cache_dirpath=APT_CACHE_DIRPATH, root=CHROOT_DIRPATH, max_size=None):
+        super(AptPackageCache, self).__init__()
+        self.cache_dirpath = cache_dirpath
+        self.root = root
+        if max_size is None:
+            try:
+                max_size = int(get_config_file_parameter("AptCacheMaxSize") or APT_CACHE_DEFAULT_MAX_SIZE) * 1024 * 1024
+            except ValueError:
+                max_size = APT_CACHE_DEFAULT_MAX_SIZE * 1024 * 1024
+        self.max_size = max_size
+        self.index_filepath = os.path.join(cache_dirpath, "index.json")
+        self.session_filepath = os.path.join(cache_dirpath, "session.json")
+        self.archives_dirpath = os.path.join(root, "var/cache/apt/archives")
+
+    def load_json(self, filepath, default):
+        try:
+            with open(filepath) as json_file:
+                return json.load(json_file)
+        except (OSError, ValueError):
+            return default
+
+    def save_json(self, filepath, data):
+        temp_filepath = filepath + ".tmp"
+        with open(temp_filepath, "w") as json_file:
+            json.dump(data, json_file, indent=1, sort_keys=True)
+        os.replace(temp_filepath, filepath)
+
+    def load_index(self):
+        index = self.load_json(self.index_filepath, {})
+        index.setdefault("files", {})
+        index.setdefault("hits", 0)
+        index.setdefault("misses", 0)
+        # Pick up any files the index doesn't know about, and forget any that have gone.
+        cached = set(filename for filename in os.listdir(self.cache_dirpath) if filename.endswith(".deb"))
+        for filename in cached - set(index["files"]):
+            index["files"][filename] = {"size": os.path.getsize(os.path.join(self.cache_dirpath, filename)),
+                                        "last_used": 0}
+        for filename in set(index["files"]) - cached:
+            del index["files"][filename]
+        return index
+
+    @staticmethod
+    def link_or_copy(source, destination):
+        try:
+            os.link(source, destination)
+        except OSError:
+            # Cache and chroot on different filesystems.
+            shutil.copy2(source, destination)
+
+    def seed(self):
+        """
+        Link every cached .deb into the chroot's apt archives directory and note the installed package versions.
+        :return: Number of .deb files made available to apt.
+        """
+        if not os.path.isdir(self.archives_dirpath):
+            return 0
+        make_folder(self.cache_dirpath)
+        index = self.load_index()
+        seeded = []
+        for filename in index["files"]:
+            destination = os.path.join(self.archives_dirpath, filename)
+            if not os.path.exists(destination):
+                self.link_or_copy(os.path.join(self.cache_dirpath, filename), destination)
+                seeded.append(filename)
+        self.save_json(self.index_filepath, index)
+        package_state = PackageStateCache(self.root)
+        package_state.refresh_status()
+        self.save_json(self.session_filepath, {"seeded": seeded, "installed": package_state.installed})
+        fileLogger.debug("Seeded {} cached .deb files into {}.".format(len(seeded), self.archives_dirpath))
+        return len(seeded)
+
+    def harvest(self, evict=True):
+        """
+        Move the .debs apt downloaded into the cache, update the hit and miss counts, then evict down to the size limit.
+        :param evict: Evict down to the size limit. Skipped after a failed build, as the next attempt will want the .debs.
+        :return: Tuple of (hits, misses) for this seed/harvest.
+        """
+        if not os.path.isdir(self.archives_dirpath):
+            return 0, 0
+        make_folder(self.cache_dirpath)
+        index = self.load_index()
+        session = self.load_json(self.session_filepath, {"seeded": [], "installed": {}})
+        seeded = set(session["seeded"])
+        now = time.time()
+        archives = [filename for filename in os.listdir(self.archives_dirpath) if filename.endswith(".deb")]
+        for filename in archives:
+            archive_filepath = os.path.join(self.archives_dirpath, filename)
+            if filename not in index["files"]:
+                self.link_or_copy(archive_filepath, os.path.join(self.cache_dirpath, filename))
+                index["files"][filename] = {"size": os.path.getsize(archive_filepath), "last_used": now}
+            os.remove(archive_filepath)
+
+        hits, misses = 0, 0
+        package_state = PackageStateCache(self.root)
+        package_state.refresh_status()
+        for package_name, version in package_state.installed.items():
+            if session["installed"].get(package_name) == version:
+                continue
+            # apt names its downloads name_version_arch.deb, with the epoch colon escaped.
+            prefix = "{}_{}_".format(package_name, version.replace(":", "%3a"))
+            filenames = [filename for filename in archives if filename.startswith(prefix)]
+            if not filenames:
+                continue
+            if filenames[0] in seeded:
+                hits += 1
+            else:
+                misses += 1
+            index["files"][filenames[0]]["last_used"] = now
+        index["hits"] += hits
+        index["misses"] += misses
+        if evict:
+            self.evict(index)
+        self.save_json(self.index_filepath, index)
+        if os.path.exists(self.session_filepath):
+            os.remove(self.session_filepath)
+        fileLogger.info("apt cache - {} packages installed from the cache, {} downloaded.".format(hits, misses))
+        return hits, misses
+
+    def evict(self, index):
+        """
+        Remove the least recently used .debs until the cache is under its size limit.
+        """
+        total_size = sum(details["size"] for details in index["files"].values())
+        for filename, details in sorted(index["files"].items(), key=lambda item: item[1]["last_used"]):
+            if total_size <= self.max_size:
+                break
+            os.remove(os.path.join(self.cache_dirpath, filename))
+            total_size -= details["size"]
+            del index["files"][filename]
+            fileLogger.debug("Evicted {} from the apt cache.".format(filename))
+
+    def stats(self):
+        """
+        :return: OrderedDict of the cache's file count, size, size limit, hits and misses.
+        """
+        make_folder(self.cache_dirpath)
+        index = self.load_index()
+        return OrderedDict([("files", len(index["files"])),
+                            ("size", sum(details["size"] for details in index["files"].values())),
+                            ("max_size", self.max_size), ("hits", index["hits"]), ("misses", index["misses"])])
+
+
+@contextlib.contextmanager
+def cached_apt_archives():
+    """
+    Seed the chroot's apt archives from the AptPackageCache for the with block, and harvest them afterwards.
+    A failed harvest is only logged, so it never hides an exception from the with block.
+    """
+    global aptPackageCache
+    if aptPackageCache is not None:
+        # Already inside a cached block, so the outer one harvests.
+        yield aptPackageCache
+        return
+    cache = AptPackageCache()
+    aptPackageCache = cache
+    completed = False
+    try:
+        cache.seed()
+        yield cache
+        completed = True
+    finally:
+        aptPackageCache = None
+        try:
+            cache.harvest(evict=completed)
+        except Exception as e:
+            fileLogger.warning("Unable to harvest the chroot's apt archives into the apt cache. Error was {}.".format(e))
+
+
+def print_apt_cache_stats():
+    stats = AptPackageCache().stats()
+    requests_total = stats["hits"] + stats["misses"]
+    print(_("apt cache at {} - {} files, {:.0f} MB of {:.0f} MB").format(APT_CACHE_DIRPATH, stats["files"],
+                                                                         stats["size"] / 1048576,
+                                                                         stats["max_size"] / 1048576))
+    print(_("{} packages from the cache, {} downloaded ({:.0f}% hit rate)").format(
+        stats["hits"], stats["misses"], 100.0 * stats["hits"] / requests_total if requests_total else 0))
+
+
+def fast_build_enabled():
+    return any(os.path.exists(os.path.join(CHROOT_DIRPATH, filepath)) for filepath in FAST_BUILD_FILES)
+
+
+def enable_fast_build():
+    """
+    Switch the chroot into fast build mode, for use while rebuilding it. dpkg stops fsyncing every file it unpacks
+    (force-unsafe-io) and apt stops dpkg running triggers (man-db, mime, icon caches, ldconfig...) after every
+    transaction. Nothing is safe against a power cut until finish_fast_build() has run, which is fine for an image
+    that is about to be rebuilt into NBD anyway.
+    """
+    for filepath, contents in FAST_BUILD_FILES.items():
+        write_file(os.path.join(CHROOT_DIRPATH, filepath), contents)
+    fileLogger.info("Fast build mode enabled for {}.".format(CHROOT_DIRPATH))
+
+
+def finish_fast_build():
+    """
+    Switch fast build mode back off, configure anything left unconfigured, run all the deferred triggers once, then
+    sync the chroot to disk.
+    :return: True if the chroot was left fully configured.
+    """
+    if not fast_build_enabled():
+        return True
+    for filepath in FAST_BUILD_FILES:
+        if os.path.exists(os.path.join(CHROOT_DIRPATH, filepath)):
+            os.remove(os.path.join(CHROOT_DIRPATH, filepath))
+    with profiled("fast-build", "deferred triggers"):
+        configured = ltsp_chroot("dpkg --configure --pending", ignore_errors=True) is True
+        triggered = ltsp_chroot("dpkg --triggers-only --pending", ignore_errors=True) is True
+        run_bash("sync", ignore_errors=True)
+    if not (configured and triggered):
+        fileLogger.warning("Deferred dpkg configuration or triggers failed in {}.".format(CHROOT_DIRPATH))
+        return False
+    fileLogger.info("Fast build mode finished for {}.".format(CHROOT_DIRPATH))
+    return True
+
+
+class BuildStageCache():
+    """
+    Snapshots of the chroot, taken as tar files after Rebuild-OS stages, so a rebuild can restore the newest valid
+    snapshot and only run the stages after it.
+    A stage's key is a hash of the key of the stage before it, the stage's own code (hashed by pinet) and the
+    /etc/pinet settings and software manifest the build uses, so changing any of them invalidates the snapshot of
+    that stage and every later one. Only the stages in BuildCacheStages (from /etc/pinet, default buildClient and
+    FixRepo) are snapshotted, and snapshots older than BuildCacheMaxAge days (default 7) aren't restored, so the
+    packages in them don't fall too far behind.
+    A snapshot only holds the chroot, so stages are only cached if pinet can redo what they change on the server
+    (the kernels in the tftp folder for buildClient, the lts.conf link for configFixes). AddSoftware installs
+    server packages, so it always runs.
+    """
+
+    cache_dirpath = BUILD_CACHE_DIRPATH
+    root = CHROOT_DIRPATH
+    stages = BUILD_CACHE_DEFAULT_STAGES
+    max_age = BUILD_CACHE_DEFAULT_MAX_AGE * 86400
+
+    def __init__(self, cache_dirpath=BUILD_CACHE_DIRPATH, root=CHROOT_DIRPATH):
+        super(BuildStageCache, self).__init__()
+        self.cache_dirpath = cache_dirpath
+        self.root = root
+        stages = (get_config_file_parameter("BuildCacheStages") or " ".join(BUILD_CACHE_DEFAULT_STAGES)).split()
+        for stage in stages:
+            if stage not in BUILD_CACHE_CACHEABLE_STAGES:
+                fileLogger.warning("Rebuild-OS stage {} changes the server, so can't be cached.".format(stage))
+        self.stages = tuple(stage for stage in stages if stage in BUILD_CACHE_CACHEABLE_STAGES)
+        try:
+            self.max_age = float(get_config_file_parameter("BuildCacheMaxAge") or BUILD_CACHE_DEFAULT_MAX_AGE) * 86400
+        except ValueError:
+            self.max_age = BUILD_CACHE_DEFAULT_MAX_AGE * 86400
+
+    def get_inputs_hash(self):
+        """
+        :return: Hash of the /etc/pinet settings and the software manifest.
+        """
+        config = sorted(line for line in read_file(CONFIG_FILE_LOCATION)
+                        if line and line.split("=")[0] not in BUILD_CACHE_IGNORED_CONFIG)
+        if os.path.isfile(SOFTWARE_MANIFEST_FILEPATH):
+            manifest = read_file(SOFTWARE_MANIFEST_FILEPATH)
+        else:
+            manifest = DEFAULT_SOFTWARE_MANIFEST.splitlines()
+        return hashlib.sha1("\n".join(config + manifest).encode()).hexdigest()
+
+    def get_stage_keys(self, stage_hashes):
+        """
+        :param stage_hashes: List of "stage:hash of its code", in the order the stages run.
+        :return: OrderedDict of stage name to key.
+        """
+        keys = OrderedDict()
+        key = self.get_inputs_hash()
+        for stage_hash in stage_hashes:
+            stage, _separator, code_hash = stage_hash.partition(":")
+            key = hashlib.sha1("{} {} {}".format(key, stage, code_hash).encode()).hexdigest()
+            keys[stage] = key
+        return keys
+
+    def get_snapshot_filepath(self, stage, key):
+        return os.path.join(self.cache_dirpath, "{}-{}.tar".format(stage, key))
+
+    def find_snapshot(self, keys):
+        """
+        :return: Name of the latest stage with a usable snapshot, or None.
+        """
+        for stage, key in reversed(list(keys.items())):
+            snapshot_filepath = self.get_snapshot_filepath(stage, key)
+            if stage in self.stages and os.path.isfile(snapshot_filepath):
+                if time.time() - os.path.getmtime(snapshot_filepath) < self.max_age:
+                    return stage
+                fileLogger.info("Build cache snapshot {} is too old to use.".format(snapshot_filepath))
+        return None
+
+    def restore(self, stage_hashes):
+        """
+        Replace the chroot with the snapshot of the latest stage that has a usable one.
+        :return: Name of the stage restored, or None if there was nothing to restore.
+        """
+        keys = self.get_stage_keys(stage_hashes)
+        stage = self.find_snapshot(keys)
+        if stage is None:
+            return None
+        snapshot_filepath = self.get_snapshot_filepath(stage, keys[stage])
+        run_bash(["rm", "-rf", "--one-file-system", self.root], ignore_errors=True)
+        make_folder(self.root)
+        with profiled("build-cache", "restore {}".format(stage)):
+            restored = run_bash(["tar", "--numeric-owner", "--xattrs", "-xpf", snapshot_filepath, "-C", self.root],
+                                ignore_errors=True) is True
+        if not restored:
+            fileLogger.warning("Unable to restore build cache snapshot {}.".format(snapshot_filepath))
+            run_bash(["rm", "-rf", "--one-file-system", self.root], ignore_errors=True)
+            return None
+        fileLogger.info("Restored the chroot as it was after {} from {}.".format(stage, snapshot_filepath))
+        return stage
+
+    def save(self, stage, stage_hashes):
+        """
+        Snapshot the chroot after a stage, if the stage is one of the stages to snapshot. Snapshots of the same stage
+        with other keys are removed, as they can no longer be used.
+        :return: True if a snapshot was saved.
+        """
+        if stage not in self.stages or not os.path.isdir(self.root):
+            return False
+        make_folder(self.cache_dirpath)
+        snapshot_filepath = self.get_snapshot_filepath(stage, self.get_stage_keys(stage_hashes)[stage])
+        temp_filepath = snapshot_filepath + ".tmp"
+        with profiled("build-cache", "save {}".format(stage)):
+            saved = run_bash(["tar", "--numeric-owner", "--xattrs", "--one-file-system", "--exclude=./proc/*",
+                              "--exclude=./sys/*", "--exclude=./var/cache/apt/archives/*.deb", "-cf", temp_filepath,
+                              "-C", self.root, "."], ignore_errors=True) is True
+        if not saved:
+            fileLogger.warning("Unable to snapshot the chroot after {}.".format(stage))
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            return False
+        os.replace(temp_filepath, snapshot_filepath)
+        for filename in os.listdir(self.cache_dirpath):
+            filepath = os.path.join(self.cache_dirpath, filename)
+            if filename.startswith(stage + "-") and filepath != snapshot_filepath:
+                os.remove(filepath)
+                fileLogger.debug("Removed old build cache snapshot {}.".format(filepath))
+        fileLogger.info("Saved the chroot as it is after {} to {}.".format(stage, snapshot_filepath))
+        return True
+
+
+class BaseRootfsCache():
+    """
+    Compressed copy of the chroot as ltsp-build-client (debootstrap) left it, so later builds can unpack it and upgrade
+    it instead of debootstrapping again.
+    The copy is only used while the ltsp-build-client config (dist, mirror, locale...), the keyring it was checked
+    against and the ltsp-server version are unchanged. It is compressed with zstd (or pigz, or gzip) streamed through
+    tar, using every core.
+    """
+
+    cache_dirpath = BASE_ROOTFS_CACHE_DIRPATH
+    root = CHROOT_DIRPATH
+    config_filepath = LTSP_BUILD_CONFIG_FILEPATH
+
+    def __init__(self, cache_dirpath=BASE_ROOTFS_CACHE_DIRPATH, root=CHROOT_DIRPATH,
+                 config_filepath=LTSP_BUILD_CONFIG_FILEPATH):
+        super(BaseRootfsCache, self).__init__()
+        self.cache_dirpath = cache_dirpath
+        self.root = root
+        self.config_filepath = config_filepath
+        self.archive_filepath = os.path.join(cache_dirpath, "rootfs.tar")
+        self.metadata_filepath = os.path.join(cache_dirpath, "metadata.json")
+        self.keyring_filepath = os.path.join(cache_dirpath, "keyring.gpg")
+
+    @staticmethod
+    def get_file_hash(filepath):
+        if not os.path.isfile(filepath):
+            return None
+        with open(filepath, "rb") as hashed_file:
+            return hashlib.sha1(hashed_file.read()).hexdigest()
+
+    @staticmethod
+    def get_compress_program():
+        for program in ("zstd -T0", "pigz", "gzip"):
+            if shutil.which(program.split()[0]):
+                return program
+        return None
+
+    def get_metadata(self):
+        """
+        :return: Dictionary of what the base rootfs built now would depend on.
+        """
+        config = dict(line.split("=", 1) for line in read_file(self.config_filepath) if "=" in line)
+        ltsp_version = run_bash("dpkg-query -W -f='${Version}' ltsp-server", return_string=True, ignore_errors=True)
+        return {"dist": config.get("DIST"),
+                "mirror": config.get("MIRROR"),
+                "config": self.get_file_hash(self.config_filepath),
+                "keyring": self.get_file_hash(config.get("DEBOOTSTRAP_KEYRING", "")),
+                "ltsp_version": ltsp_version.strip() if isinstance(ltsp_version, str) else None}
+
+    def load_metadata(self):
+        try:
+            with open(self.metadata_filepath) as metadata_file:
+                return json.load(metadata_file)
+        except (OSError, ValueError):
+            return None
+
+    def is_valid(self, metadata=None):
+        """
+        :return: True if there is a cached base rootfs matching what would be built now.
+        """
+        cached_metadata = self.load_metadata()
+        if cached_metadata is None or not os.path.isfile(self.archive_filepath):
+            return False
+        metadata = metadata or self.get_metadata()
+        changed = [key for key in sorted(metadata) if cached_metadata.get(key) != metadata[key]]
+        if changed:
+            fileLogger.info("Cached base rootfs can't be used, {} changed.".format(", ".join(changed)))
+            return False
+        return True
+
+    def restore(self):
+        """
+        Replace the chroot with the cached base rootfs, then bring its packages up to date.
+        :return: True if the chroot was restored.
+        """
+        if not self.is_valid():
+            return False
+        cached_metadata = self.load_metadata()
+        run_bash(["rm", "-rf", "--one-file-system", self.root], ignore_errors=True)
+        make_folder(self.root)
+        with profiled("base-rootfs", "restore"):
+            restored = run_bash(["tar", "--numeric-owner", "--xattrs", "--use-compress-program",
+                                 cached_metadata["compress_program"], "-xpf", self.archive_filepath, "-C", self.root],
+                                ignore_errors=True) is True
+        if not restored:
+            fileLogger.warning("Unable to unpack the cached base rootfs {}.".format(self.archive_filepath))
+            run_bash(["rm", "-rf", "--one-file-system", self.root], ignore_errors=True)
+            return False
+        fileLogger.info("Restored the base rootfs from {}, upgrading it.".format(self.archive_filepath))
+        apt_update(force=True)
+        ltsp_chroot("env DEBIAN_FRONTEND=noninteractive apt-get upgrade -y")
+        return True
+
+    def save(self):
+        """
+        Save the chroot as the cached base rootfs. Should be run straight after ltsp-build-client.
+        :return: True if saved.
+        """
+        compress_program = self.get_compress_program()
+        if compress_program is None or not os.path.isdir(self.root):
+            return False
+        metadata = self.get_metadata()
+        metadata["compress_program"] = compress_program
+        make_folder(self.cache_dirpath)
+        temp_filepath = self.archive_filepath + ".tmp"
+        with profiled("base-rootfs", "save"):
+            saved = run_bash(["tar", "--numeric-owner", "--xattrs", "--one-file-system", "--use-compress-program",
+                              compress_program, "--exclude=./proc/*", "--exclude=./sys/*",
+                              "--exclude=./var/cache/apt/archives/*.deb", "-cf", temp_filepath, "-C", self.root, "."],
+                             ignore_errors=True) is True
+        if not saved:
+            fileLogger.warning("Unable to save the base rootfs.")
+            if os.path.exists(temp_filepath):
+                os.remove(temp_filepath)
+            return False
+        os.replace(temp_filepath, self.archive_filepath)
+        keyring_filepath = dict(line.split("=", 1) for line in read_file(self.config_filepath) if "=" in line).get(
+            "DEBOOTSTRAP_KEYRING")
+        if keyring_filepath and os.path.isfile(keyring_filepath):
+            shutil.copy2(keyring_filepath, self.keyring_filepath)
+        temp_filepath = self.metadata_filepath + ".tmp"
+        with open(temp_filepath, "w") as metadata_file:
+            json.dump(metadata, metadata_file, indent=1, sort_keys=True)
+        os.replace(temp_filepath, self.metadata_filepath)
+        fileLogger.info("Saved the base rootfs for {} from {} to {}.".format(metadata["dist"], metadata["mirror"],
+                                                                        self.archive_filepath))
+        return True
+
+
+def get_package_state_cache(install_on_server=False):
+    """
+    Get the shared PackageStateCache for the server or the Raspbian chroot.
+    """
+    root = "/" if install_on_server else CHROOT_DIRPATH
+    with PACKAGE_STATE_CACHES_LOCK:
+        if root not in PACKAGE_STATE_CACHES:
+            PACKAGE_STATE_CACHES[root] = PackageStateCache(root)
+        return PACKAGE_STATE_CACHES[root]
+
+
+def apt_packages_satisfied(to_install, install_on_server=False, version=None):
+    """
+    Check if all the apt packages in a space separated list are already installed, so installing them can be skipped.
+    :return: True if nothing would be installed or upgraded.
+    """
+    cache = get_package_state_cache(install_on_server)
+    return all(cache.is_satisfied(package_name, version) for package_name in to_install.split())
+
+
+def get_apt_sources_hash(root="/"):
+    """
+    :return: Hash of the apt sources lists (sources.list and sources.list.d) in a root filesystem.
+    """
+    sources_dirpath = os.path.join(root, "etc/apt/sources.list.d")
+    filepaths = [os.path.join(root, "etc/apt/sources.list")]
+    if os.path.isdir(sources_dirpath):
+        filepaths.extend(os.path.join(sources_dirpath, filename) for filename in sorted(os.listdir(sources_dirpath)))
+    sources_hash = hashlib.sha1()
+    for filepath in filepaths:
+        if os.path.isfile(filepath):
+            sources_hash.update(filepath.encode())
+            with open(filepath, "rb") as sources_file:
+                sources_hash.update(sources_file.read())
+    return sources_hash.hexdigest()
+
+
+def apt_update(install_on_server=False, force=False, ignore_errors=False):
+    """
+    Run apt-get update on the server or in the Raspbian chroot, unless its package lists were already refreshed
+    against the same sources in the last AptUpdateTTL minutes (from /etc/pinet, default 60).
+    Each successful update is recorded in var/lib/apt/pinet-update-stamp as the time and a hash of the sources.
+    :param install_on_server: Update the server instead of the chroot.
+    :param force: Always run apt-get update.
+    :param ignore_errors: Don't ask the user what to do if apt-get fails.
+    :return: True if the package lists are up to date, otherwise the apt-get return code.
+    """
+    root = "/" if install_on_server else CHROOT_DIRPATH
+    stamp_filepath = os.path.join(root, "var/lib/apt/pinet-update-stamp")
+    sources_hash = get_apt_sources_hash(root)
+    if not force:
+        try:
+            ttl = float(get_config_file_parameter("AptUpdateTTL") or APT_UPDATE_DEFAULT_TTL) * 60
+        except ValueError:
+            ttl = APT_UPDATE_DEFAULT_TTL * 60
+        try:
+            stamp_time, stamp_hash = read_file(stamp_filepath)[0].split()
+            age = time.time() - float(stamp_time)
+        except (IndexError, ValueError):
+            stamp_hash, age = None, None
+        lists_dirpath = os.path.join(root, "var/lib/apt/lists")
+        have_lists = os.path.isdir(lists_dirpath) and any(
+            filename.endswith("_Packages") for filename in os.listdir(lists_dirpath))
+        if stamp_hash == sources_hash and age is not None and 0 <= age < ttl and have_lists:
+            fileLogger.debug("Skipping apt-get update for {}, last updated {:.0f} minutes ago.".format(root, age / 60))
+            return True
+    if install_on_server:
+        result = run_bash("apt-get update", ignore_errors=ignore_errors)
+    else:
+        result = ltsp_chroot("apt-get update", ignore_errors=ignore_errors)
+    if result is True:
+        try:
+            with open(stamp_filepath, "w") as stamp_file:
+                stamp_file.write("{} {}\n".format(int(time.time()), sources_hash))
+        except OSError as e:
+            fileLogger.debug("Unable to record apt-get update time in {}. Error was {}.".format(stamp_filepath, e))
+    return result
 
 
 def install_apt_package(to_install, update=False, upgrade=False, install_on_server=False, parameters=(), version=""):
     parameters = " ".join(parameters)
     if update:
-        run_bash("apt-get update")
+        apt_update(install_on_server=True)
     if upgrade:
         run_bash("apt-get upgrade -y")
-    if install_on_server:
-        if version:
-            run_bash("apt-get install -y --allow-downgrades --allow-change-held-packages {} {}={}".format(parameters, to_install, version))
-            run_bash("apt-mark hold {}".format(to_install))
-        else:
-            run_bash("apt-get install -y {} {}".format(parameters, to_install))
+    if apt_packages_satisfied(to_install, install_on_server=install_on_server, version=version):
+        if not version or get_package_state_cache(install_on_server).is_held(to_install):
+            fileLogger.debug("{} is already installed, skipping.".format(to_install))
+            return
+        # Already on the right version, so it only needs holding.
+        apply_package_holds(to_hold=to_install.split(), install_on_server=install_on_server)
+        return
+    run = run_bash if install_on_server else ltsp_chroot
+    if version:
+        run("apt-get install -y --allow-downgrades --allow-change-held-packages {} {}={}".format(parameters, to_install, version))
+        # Only the packages that aren't held yet need an apt-mark call.
+        to_hold, _to_unhold = get_package_hold_changes(to_install.split(), (), install_on_server=install_on_server)
+        apply_package_holds(to_hold=to_hold, install_on_server=install_on_server)
     else:
-        if version:
-            ltsp_chroot("apt-get install -y --allow-downgrades --allow-change-held-packages {} {}={}".format(parameters, to_install, version))
-            ltsp_chroot("apt-mark hold {}".format(to_install))
-        else:
-            ltsp_chroot("apt-get install -y {} {}".format(parameters, to_install))
+        run("apt-get install -y {} {}".format(parameters, to_install))
+
+
+def unique_software_packages(packages):
+    """
+    :return: The SoftwarePackages with later copies of the same package (for the same target) removed.
+    """
+    unique_packages = []
+    seen = set()
+    for package in packages:
+        if (package.install_on_server, package.name) not in seen:
+            seen.add((package.install_on_server, package.name))
+            unique_packages.append(package)
+    return unique_packages
 
 
 def group_apt_installer(packages):
-    packages_to_install = []
+    """
+    Install a list of APT SoftwarePackages in as few apt-get runs as possible.
+    Neighbouring packages that go to the same place (server or chroot) with the same extra apt parameters are merged
+    into one apt-get install, with the pinned versions included as package=version. A package with different
+    parameters starts a new run, so packages are never installed ahead of ones listed before them, which the package
+    manifest relies on. Every pinned package that installed is then held with one apt-mark hold per target.
+    :param packages: List of SoftwarePackages. If a package is listed more than once, the first copy is used.
+    :return: List of names of the packages that failed to install.
+    """
+    unique_packages = unique_software_packages(packages)
+    missing, mismatched, satisfied = diff_apt_packages(unique_packages)
+    fileLogger.info("{} of {} apt packages already satisfied, {} missing and {} at a different version.".format(
+        len(satisfied), len(unique_packages), len(missing), len(mismatched)))
+
+    transactions = []
+    for package in unique_packages:
+        if package in satisfied:
+            continue
+        key = (package.install_on_server, tuple(package.parameters))
+        if not transactions or transactions[-1][0] != key:
+            transactions.append((key, OrderedDict()))
+        transactions[-1][1][package.name] = package.version
+
+    prefetch_apt_transactions([(transaction, parameters) for (install_on_server, parameters), transaction in
+                               transactions if not install_on_server])
+    failed = []
+    for (install_on_server, parameters), transaction in transactions:
+        print("Going to install {}".format(" ".join(transaction)))
+
+        def install(package_names):
+            return install_apt_transaction(OrderedDict((package_name, transaction[package_name]) for package_name in
+                                                       package_names), install_on_server=install_on_server,
+                                           parameters=parameters, ignore_errors=True) is True
+
+        failed.extend(bisect_install(list(transaction), install))
+
+    to_hold = OrderedDict()
+    for package in unique_packages:
+        if package.version and package.name not in failed and \
+                not get_package_state_cache(package.install_on_server).is_held(package.name):
+            to_hold.setdefault(package.install_on_server, []).append(package.name)
+    for install_on_server, package_names in to_hold.items():
+        apply_package_holds(to_hold=package_names, install_on_server=install_on_server)
+    if failed:
+        fileLogger.warning("Failed to install apt packages - {}".format(", ".join(failed)))
+        print(_("The following packages failed to install - {}").format(" ".join(failed)))
+    return failed
+
+
+def diff_apt_packages(packages):
+    """
+    Compare wanted APT SoftwarePackages against the installed packages in dpkg's status file, without running apt
+    or starting the chroot.
+    :param packages: List of SoftwarePackages.
+    :return: Tuple of (missing, mismatched, satisfied) lists of SoftwarePackages. Mismatched packages are installed,
+    but not at the pinned version (or older than the available version if not pinned).
+    """
+    missing, mismatched, satisfied = [], [], []
     for package in packages:
-        if not package.version and not package.parameters and not package.install_on_server:
-            packages_to_install.append(package.name)
+        cache = get_package_state_cache(package.install_on_server)
+        if apt_packages_satisfied(package.name, install_on_server=package.install_on_server, version=package.version):
+            satisfied.append(package)
+        elif all(cache.installed_version(package_name) for package_name in package.name.split()):
+            mismatched.append(package)
         else:
-            if packages_to_install:
-                print("Going to install {}".format(" ".join(packages_to_install)))
-                returned = ltsp_chroot("apt-get install -y {}".format(" ".join(packages_to_install)), ignore_errors=True)
-                if returned != True:
-                    for single_package in packages_to_install:
-                        install_apt_package(single_package)
-                packages_to_install = []
-            install_apt_package(package.name, install_on_server=package.install_on_server, parameters=package.parameters, version=package.version)
+            missing.append(package)
+    return missing, mismatched, satisfied
 
 
+def get_package_hold_changes(wanted_holds, managed_packages, install_on_server=False):
+    """
+    Work out which packages need holding or unholding, using the holds in dpkg's status file.
+    :param wanted_holds: Package names that should end up held.
+    :param managed_packages: Package names PiNet controls the hold of (the version manifests). Any other held package
+    was held by someone else and is left alone.
+    :param install_on_server: Check the server instead of the Raspbian chroot.
+    :return: Tuple of (to_hold, to_unhold) sorted lists of package names.
+    """
+    held = get_package_state_cache(install_on_server).held_packages()
+    wanted_holds = set(wanted_holds)
+    return sorted(wanted_holds - held), sorted((held & set(managed_packages)) - wanted_holds)
+
+
+def apply_package_holds(to_hold=(), to_unhold=(), install_on_server=False):
+    """
+    Hold and unhold packages, with at most one apt-mark call for each.
+    """
+    run = run_bash if install_on_server else ltsp_chroot
+    if to_unhold:
+        fileLogger.debug("Marking {} to be unheld for updates.".format(", ".join(to_unhold)))
+        run("apt-mark unhold {}".format(" ".join(to_unhold)), ignore_errors=True)
+    if to_hold:
+        fileLogger.debug("Marking {} to be held.".format(", ".join(to_hold)))
+        run("apt-mark hold {}".format(" ".join(to_hold)))
+
+
+def bisect_install(items, install):
+    """
+    Install a batch of items in one go. If that fails, split the batch in half and try each half, carrying on until
+    the items that fail on their own are found. The rest still get installed in batches.
+    :param items: List of items to install.
+    :param install: Function taking a list of items and returning True if they all installed.
+    :return: List of items that failed to install on their own.
+    """
+    if not items or install(items):
+        return []
+    if len(items) == 1:
+        return list(items)
+    middle = len(items) // 2
+    return bisect_install(items[:middle], install) + bisect_install(items[middle:], install)
+
+
+def build_apt_install_command(packages, parameters=(), extra_options=()):
+    """
+    :param packages: OrderedDict of package name to the version to install, or None for the newest version.
+    :param parameters: Extra apt-get parameters.
+    :param extra_options: apt-get options to add after -y.
+    :return: apt-get install command string.
+    """
+    package_specs = []
+    for package_name, version in packages.items():
+        if version:
+            package_specs.append("{}={}".format(package_name, version))
+        else:
+            package_specs.append(package_name)
+    command = ["apt-get", "install", "-y"] + list(extra_options)
+    if any(packages.values()):
+        command.extend(["--allow-downgrades", "--allow-change-held-packages"])
+    return " ".join(command + list(parameters) + package_specs)
+
+
+def install_apt_transaction(packages, install_on_server=False, parameters=(), ignore_errors=False):
+    """
+    Install a group of packages with a single apt-get install.
+    :param packages: OrderedDict of package name to the version to install, or None for the newest version.
+    :param install_on_server: Install on the server instead of the Raspbian chroot.
+    :param parameters: Extra apt-get parameters.
+    :param ignore_errors: Don't ask the user what to do if apt-get fails.
+    :return: True if the install worked, otherwise the return code.
+    """
+    command = build_apt_install_command(packages, parameters)
+    if install_on_server:
+        return run_bash(command, ignore_errors=ignore_errors)
+    # Some packages (sonic-pi) ask debconf questions, which would stop an unattended install.
+    return ltsp_chroot("env DEBIAN_FRONTEND=noninteractive " + command, ignore_errors=ignore_errors)
+
+
+AptDownload = namedtuple("AptDownload", ["uri", "filename", "size", "checksum"])
+
+
+def parse_apt_print_uris(output):
+    """
+    Parse the output of apt-get install --print-uris -qq.
+    Each line is - 'uri' filename size checksum
+    :return: List of AptDownloads.
+    """
+    downloads = []
+    for line in output.splitlines():
+        parts = line.split()
+        if len(parts) < 3 or not parts[0].startswith("'"):
+            continue
+        try:
+            size = int(parts[2])
+        except ValueError:
+            continue
+        checksum = parts[3] if len(parts) > 3 else ""
+        downloads.append(AptDownload(parts[0].strip("'"), parts[1], size, checksum))
+    return downloads
+
+
+def verify_apt_download(filepath, checksum):
+    """
+    Check a downloaded file against the checksum apt gave for it (for example SHA256:abc...). Older versions of apt
+    give a bare MD5 sum.
+    :return: True if the file matches, or there is no checksum to check against.
+    """
+    if not checksum:
+        return True
+    algorithm, _colon, expected = checksum.rpartition(":")
+    hash_name = {"": "md5", "MD5Sum": "md5", "SHA1": "sha1", "SHA256": "sha256", "SHA512": "sha512"}.get(algorithm)
+    if hash_name is None:
+        return True
+    file_hash = hashlib.new(hash_name)
+    with open(filepath, "rb") as downloaded_file:
+        for block in iter(lambda: downloaded_file.read(1048576), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest() == expected.lower()
+
+
+def download_apt_package(download, archives_dirpath):
+    """
+    Download a single .deb into an apt archives directory the same way apt does, via the partial directory.
+    :return: True if the file was downloaded and its checksum matches.
+    """
+    import requests
+    partial_filepath = os.path.join(archives_dirpath, "partial", download.filename)
+    try:
+        with profiled("http", download.uri, size=download.size):
+            response = requests.get(download.uri, stream=True, timeout=30)
+            response.raise_for_status()
+            with open(partial_filepath, "wb") as deb_file:
+                for chunk in response.iter_content(65536):
+                    deb_file.write(chunk)
+    except (requests.RequestException, OSError) as e:
+        fileLogger.debug("Unable to prefetch {}. Error was {}.".format(download.uri, e))
+        if os.path.exists(partial_filepath):
+            os.remove(partial_filepath)
+        return False
+    if not verify_apt_download(partial_filepath, download.checksum):
+        fileLogger.warning("Prefetched {} does not match its checksum, leaving it to apt.".format(download.filename))
+        os.remove(partial_filepath)
+        return False
+    os.replace(partial_filepath, os.path.join(archives_dirpath, download.filename))
+    return True
+
+
+def prefetch_apt_packages(downloads, archives_dirpath=CHROOT_DIRPATH + "/var/cache/apt/archives",
+                          max_workers=APT_PREFETCH_WORKERS):
+    """
+    Download .debs concurrently into an apt archives directory, so the apt-get install that follows doesn't need to
+    download anything. Anything that fails is left for apt to download itself.
+    :param downloads: List of AptDownloads.
+    :return: List of AptDownloads that failed.
+    """
+    import concurrent.futures
+    downloads = [download for download in downloads if download.uri.startswith(("http://", "https://"))]
+    if not downloads:
+        return []
+    make_folder(os.path.join(archives_dirpath, "partial"))
+    start_time = time.monotonic()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(lambda download: download_apt_package(download, archives_dirpath), downloads))
+    duration = max(time.monotonic() - start_time, 0.001)
+    failed = [download for download, result in zip(downloads, results) if not result]
+    downloaded_size = sum(download.size for download, result in zip(downloads, results) if result)
+    fileLogger.info("Prefetched {} of {} packages ({:.1f} MB) in {:.1f}s, {:.2f} MB/s.".format(
+        len(downloads) - len(failed), len(downloads), downloaded_size / 1048576, duration,
+        downloaded_size / 1048576 / duration))
+    return failed
+
+
+def prefetch_apt_transactions(transactions):
+    """
+    Work out every .deb the chroot apt transactions will need with apt-get --print-uris, then prefetch them.
+    :param transactions: List of (packages, parameters), as passed to install_apt_transaction().
+    """
+    downloads = OrderedDict()
+    for packages, parameters in transactions:
+        output = ltsp_chroot(build_apt_install_command(packages, parameters, ("--print-uris", "-qq")),
+                             return_string=True, ignore_errors=True)
+        if isinstance(output, str):
+            for download in parse_apt_print_uris(output):
+                downloads[download.filename] = download
+    prefetch_apt_packages(list(downloads.values()))
+
+
+class PackageVersionManifest():
+    """
+    The package versions PiNet pins packages to. Versions in the PiNet-Boot apt_version.txt take priority over the
+    general PiNet-Configs package_versions.txt.
+    Both files are read once per process and then looked up from memory. A package_versions.txt older than 12 hours
+    gets one download attempt before it is read, keeping the old copy if that fails. It isn't refreshed in the
+    background, as most $p calls are short lived processes that would exit part way through the download.
+    """
+
+    package_versions_path = "/opt/PiNet/pinet-package-versions.txt"
+    bootfiles_versions_path = "/opt/PiNet/PiBootBackup/apt_version.txt"
+    bootfiles_versions_path_reserve = "/tmp/apt_version.txt"
+    max_age = 12 * 3600
+    download_attempts = 3
+    retry_delay = 30
+    bootfile_versions = None
+    package_versions = None
+
+    def __init__(self):
+        super(PackageVersionManifest, self).__init__()
+        self.lock = threading.RLock()
+
+    def load(self):
+        with self.lock:
+            if self.bootfile_versions is None:
+                if os.path.isfile(self.bootfiles_versions_path):
+                    self.bootfile_versions = parse_config_file(read_file(self.bootfiles_versions_path))
+                else:
+                    # If the apt version list doesn't exist, then download
+                    if not os.path.isfile(self.bootfiles_versions_path_reserve):
+                        download_file(build_download_url("PiNet/PiNet-Boot", "boot/apt_version.txt"),
+                                      self.bootfiles_versions_path_reserve)
+                    self.bootfile_versions = parse_config_file(read_file(self.bootfiles_versions_path_reserve))
+            if self.package_versions is None:
+                if not os.path.isfile(self.package_versions_path):
+                    self.refresh()
+                elif time.time() - os.path.getctime(self.package_versions_path) > self.max_age:
+                    self.refresh(download_attempts=1)
+                self.package_versions = parse_config_file(read_file(self.package_versions_path))
+
+    def refresh(self, download_attempts=None):
+        """
+        Download a new copy of package_versions.txt, retrying with an exponential backoff.
+        The download goes to a temporary file that is then renamed over the old copy, so a failed download never
+        leaves a missing or half written file behind.
+        :param download_attempts: Times to try the download, default download_attempts.
+        :return: True if the download worked.
+        """
+        download_attempts = download_attempts or self.download_attempts
+        url = build_download_url("PiNet/PiNet-Configs", "packages/package_versions.txt")
+        download_path = self.package_versions_path + ".download"
+        make_folder(os.path.dirname(self.package_versions_path))  # In case folder doesn't exist yet.
+        delay = self.retry_delay
+        for download_attempt in range(1, download_attempts + 1):
+            if download_file(url, download_path):
+                os.replace(download_path, self.package_versions_path)
+                fileLogger.debug("Refreshed {} from {}.".format(self.package_versions_path, url))
+                return True
+            fileLogger.warning("Unable to download package_versions.txt file from {}. Already attempted {} time.".format(
+                url, download_attempt))
+            if download_attempt < download_attempts:
+                time.sleep(delay)  # Allow for any issues with web connectivity.
+                delay *= 2
+        if os.path.exists(download_path):
+            os.remove(download_path)
+        return False
+
+    def get(self, package_name):
+        """
+        :param package_name: Name of package to check.
+        :return: Package version to be installed, or None.
+        """
+        self.load()
+        return self.bootfile_versions.get(package_name) or self.package_versions.get(package_name)
+
+    def package_names(self):
+        """
+        :return: Set of every package name with a pinned version.
+        """
+        self.load()
+        return set(self.bootfile_versions) | set(self.package_versions)
+
+
+def get_package_version_manifest():
+    global packageVersionManifest
+    with PACKAGE_VERSION_MANIFEST_LOCK:
+        if packageVersionManifest is None:
+            packageVersionManifest = PackageVersionManifest()
+        return packageVersionManifest
+
 
 def get_package_version_to_install(package_name):
     """
@@ -389,39 +2107,7 @@ def get_package_version_to_install(package_name):
     :param package_name: Name of package to check.
     :return: Package version to be installed, or None.
     """
-    current_time = time.time()
-    pinet_package_versions_path = "/opt/PiNet/pinet-package-versions.txt"
-    pinet_bootfiles_versions_path = "/opt/PiNet/PiBootBackup/apt_version.txt"
-    pinet_bootfiles_versions_path_reserve = "/tmp/apt_version.txt"
-
-    # Check first if the package is included in /opt/PiNet/PiBootBackup/boot/apt_version.txt. If not, then fall back to general package list at /opt/PiNet/pinet-package-versions.txt.
-    if os.path.isfile(pinet_bootfiles_versions_path):
-        bootfile_package_version = get_config_file_parameter(package_name, config_file_path=pinet_bootfiles_versions_path)
-    else:
-        # If the apt version list doesn't exist, then download
-        if not os.path.isfile(pinet_bootfiles_versions_path_reserve):
-            download_file(build_download_url("PiNet/PiNet-Boot", "boot/apt_version.txt"), pinet_bootfiles_versions_path_reserve)
-        bootfile_package_version = get_config_file_parameter(package_name, config_file_path=pinet_bootfiles_versions_path_reserve)
-
-    # If the file doesn't exist or is over 12 hours old, get the newest copy off the web.
-    if not os.path.isfile(pinet_package_versions_path) or ((current_time - os.path.getctime(pinet_package_versions_path)) / 3600 > 12):
-        make_folder("/opt/PiNet") # In case folder doesn't exist yet.
-        for download_attempts in range(1, 4): # Attempt downloading 3 times with a 30s gap between each if fails first time.
-            remove_file(pinet_package_versions_path)
-            if download_file(build_download_url("PiNet/PiNet-Configs", "packages/package_versions.txt"), pinet_package_versions_path):
-                break
-            fileLogger.warning("Now able to download package_versions.txt file from {}. Already attempted {} time.".format(build_download_url("PiNet/PiNet-Configs", "packages/package_versions.txt"), download_attempts))
-            if download_attempts == 3:
-                # Not able to get the file correctly downloaded. Going to give up and return None after deleting the file.
-                remove_file(pinet_package_versions_path)
-                if bootfile_package_version:
-                    return bootfile_package_version
-            time.sleep(30) # Wait for 30s to allow for any issues with web connectivity.
-
-    if bootfile_package_version:
-        return bootfile_package_version
-    else:
-        return get_config_file_parameter(package_name, config_file_path=pinet_package_versions_path)
+    return get_package_version_manifest().get(package_name)
 
 
 def make_folder(directory):
@@ -499,20 +2185,91 @@ def read_file(file_path):
     return cleaned_file_contents
 
 
+def get_file_lock_filepath(file_path):
+    """
+    :return: Path of the lock file for a file, for example /run/lock/pinet/_etc_pinet.lock for /etc/pinet.
+    """
+    return os.path.join(FILE_LOCK_DIRPATH, os.path.realpath(file_path).replace("/", "_") + ".lock")
+
+
+@contextlib.contextmanager
+def locked_file(file_path):
+    """
+    Hold an exclusive advisory lock (flock) on a file for the with block, so reading, changing and writing it back
+    can't interleave with another pinet process or thread doing the same.
+    The lock is taken on a separate lock file (see get_file_lock_filepath()), as the file itself is replaced on every
+    write. It can be taken again by the thread already holding it. If the lock file can't be created, the block runs
+    without the lock. A symlink shares the lock of the file it points to.
+    """
+    file_path = os.path.realpath(file_path)
+    with FILE_LOCKS_LOCK:
+        lock = FILE_LOCKS.setdefault(file_path, {"thread_lock": threading.RLock(), "depth": 0, "fd": None})
+    with lock["thread_lock"]:
+        if lock["depth"] == 0:
+            try:
+                make_folder(FILE_LOCK_DIRPATH)
+                lock["fd"] = os.open(get_file_lock_filepath(file_path), os.O_RDWR | os.O_CREAT, 0o644)
+                fcntl.flock(lock["fd"], fcntl.LOCK_EX)
+            except OSError as e:
+                fileLogger.debug("Unable to lock {}, continuing without the lock. Error was {}.".format(file_path, e))
+                if lock["fd"] is not None:
+                    os.close(lock["fd"])
+                lock["fd"] = None
+        lock["depth"] += 1
+        try:
+            yield
+        finally:
+            lock["depth"] -= 1
+            if lock["depth"] == 0 and lock["fd"] is not None:
+                fcntl.flock(lock["fd"], fcntl.LOCK_UN)
+                os.close(lock["fd"])
+                lock["fd"] = None
+
+
 def write_file(file_path, file_contents):
     """
+    Replace a file atomically. The contents are written to a temporary file in the same folder, which is fsynced
+    and renamed over the file, so a crash or full disk leaves either the old or the new file, never a truncated one.
+    The file keeps its permissions and owner. If the path is a symlink, the file it points to is replaced and the
+    symlink is left as it is.
 
     :param file_path: Full path to the file to be read.
     :param file_contents: Contents of the file as a list of strings (with no newline characters).
     :return: Status of the file write
     """
+    file_path = os.path.realpath(file_path)
+    temp_file_path = None
     try:
-        with open(file_path, 'w') as f:
-            f.write('\n'.join(file_contents) + '\n')
+        with locked_file(file_path):
+            file_descriptor, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)),
+                                                               prefix="." + os.path.basename(file_path) + ".")
+            with os.fdopen(file_descriptor, "w") as f:
+                f.write('\n'.join(file_contents) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            if os.path.exists(file_path):
+                stat = os.stat(file_path)
+                os.chmod(temp_file_path, stat.st_mode & 0o7777)
+                try:
+                    os.chown(temp_file_path, stat.st_uid, stat.st_gid)
+                except OSError:
+                    pass
+            else:
+                os.chmod(temp_file_path, 0o644)
+            os.replace(temp_file_path, file_path)
+            temp_file_path = None
+            directory_descriptor = os.open(os.path.dirname(os.path.abspath(file_path)), os.O_RDONLY)
+            try:
+                os.fsync(directory_descriptor)
+            finally:
+                os.close(directory_descriptor)
         return True
     except IOError as e:
         print(e)
         return False
+    finally:
+        if temp_file_path is not None and os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
 
 
 def check_string_exists(filename, to_search_for):
@@ -569,10 +2326,13 @@ def download_file_urllib(url, save_location):
     Downloads a file from the internet using a standard browser header.
     Custom header is required to allow access to all pages.
     """
+    import urllib.error
+    import urllib.request
     try:
         req = urllib.request.Request(url)
         req.add_header('User-agent', 'Mozilla 5.10')
-        f = urllib.request.urlopen(req)
+        with profiled("http", url):
+            f = urllib.request.urlopen(req)
         text_file = open(save_location, "wb")
         text_file.write(f.read())
         text_file.close()
@@ -587,8 +2347,10 @@ def download_file_urllib(url, save_location):
 
 
 def download_file(url, save_location):
+    import requests
     try:
-        response = requests.get(url, headers={'User-agent': 'Mozilla 5.10'}, timeout=5)
+        with profiled("http", url):
+            response = requests.get(url, headers={'User-agent': 'Mozilla 5.10'}, timeout=5)
         if response.status_code == requests.codes.ok:
             with open(save_location, 'wb') as f:
                 f.write(response.content)
@@ -642,6 +2404,116 @@ def parse_config_file(config_file, read_first_use_only=False):
     return parsed
 
 
+class ConfigStore():
+    """
+    Parsed copy of a key=value config file such as /etc/pinet, in the format bash's ConfigFileRead sources.
+    The file is parsed once and then only reparsed when a stat() shows it has changed (mtime, size or inode), so
+    lookups are dictionary reads. Values set inside a transaction() are written together with one atomic replace of
+    the file when it ends, outside of one each set is written straight away.
+    Lines other than the keys being set (comments, blank lines, other keys) are written back as they were.
+    """
+
+    filepath = CONFIG_FILE_LOCATION
+    signature = None
+
+    def __init__(self, filepath=CONFIG_FILE_LOCATION):
+        super(ConfigStore, self).__init__()
+        self.filepath = filepath
+        self.lock = threading.RLock()
+        self.lines = []
+        self.values = {}
+        self.first_values = {}
+        self.pending = OrderedDict()
+        self.transaction_depth = 0
+
+    def refresh(self):
+        """
+        Reparse the file if it has changed since it was last parsed.
+        """
+        with self.lock:
+            try:
+                stat = os.stat(self.filepath)
+                signature = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            except OSError:
+                signature = None
+            if signature == self.signature and signature is not None:
+                return
+            self.lines = read_file(self.filepath)
+            self.values = parse_config_file(self.lines)
+            self.first_values = parse_config_file(self.lines, read_first_use_only=True)
+            self.signature = signature
+
+    def get(self, key, read_first_use_only=False):
+        """
+        :param read_first_use_only: Use the first copy of the key in the file, instead of the last.
+        :return: Value of the key, or None if not set.
+        """
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            self.refresh()
+            return (self.first_values if read_first_use_only else self.values).get(key)
+
+    def set(self, key, value):
+        with self.lock:
+            self.pending[key] = str(value)
+            if not self.transaction_depth:
+                self.flush()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Collect the sets made in the with block into one write. If the block raises an exception, they are dropped.
+        """
+        with self.lock:
+            self.transaction_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self.transaction_depth -= 1
+                if not self.transaction_depth:
+                    self.pending.clear()
+                raise
+            self.transaction_depth -= 1
+            if not self.transaction_depth:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the pending values to the file. Every line setting the key is replaced (the key must match exactly), or
+        the key is added to the end if it isn't there.
+        """
+        with self.lock, locked_file(self.filepath):
+            if not self.pending:
+                return
+            self.refresh()
+            lines = list(self.lines)
+            for key, value in self.pending.items():
+                new_line = "{}={}".format(key, value)
+                indexes = [index for index, line in enumerate(lines) if "=" in line and
+                           not line.startswith("#") and line.split("=")[0].strip() == key]
+                for index in indexes:
+                    lines[index] = new_line
+                if not indexes:
+                    lines.append(new_line)
+            if not write_file(self.filepath, lines):
+                return
+            fileLogger.debug("Set {} in {}.".format(", ".join("{}={}".format(key, value) for key, value in
+                                                              self.pending.items()), self.filepath))
+            self.pending.clear()
+            self.signature = None
+
+
+def get_config_store(config_file_path=CONFIG_FILE_LOCATION):
+    """
+    Get the shared ConfigStore for a config file.
+    """
+    with CONFIG_STORES_LOCK:
+        if config_file_path not in CONFIG_STORES:
+            CONFIG_STORES[config_file_path] = ConfigStore(config_file_path)
+        return CONFIG_STORES[config_file_path]
+
+
 def get_config_file_parameter(parameter_key, read_first_use_only=False, config_file_path=CONFIG_FILE_LOCATION):
     """
     :param parameter_key: Parameter key to search for in the config file.
@@ -649,12 +2521,7 @@ def get_config_file_parameter(parameter_key, read_first_use_only=False, config_f
     :param config_file_path: The full path of the config file. Default CONFIG_FILE_LOCATION variable.
     :return: Key or if not found, None.
     """
-    config_file = read_file(config_file_path)
-
-    parsed_config_file = parse_config_file(config_file, read_first_use_only=read_first_use_only)
-    if parameter_key in parsed_config_file:
-        return parsed_config_file[parameter_key]
-    return None
+    return get_config_store(config_file_path).get(parameter_key, read_first_use_only=read_first_use_only)
 
 
 def get_config_parameter(filep, search_for, break_on_first_find=False):
@@ -674,11 +2541,15 @@ def get_config_parameter(filep, search_for, break_on_first_find=False):
 
 
 def set_config_parameter(option, value, filep="/etc/pinet"):
-    new_value = option + "=" + value
-    replace_line_or_add(filep, option, new_value)
+    get_config_store(filep).set(option, value)
 
 
 def return_data(data):
+    global servedData
+    if servedData is not None:
+        # Running under serve(), so the data goes back with the response instead of through the transfer file.
+        servedData = str(data)
+        return
     # TODO: Switch to use write_file
     with open(DATA_TRANSFER_FILEPATH, "w+") as text_file:
         text_file.write(str(data))
@@ -691,6 +2562,46 @@ def read_return():
         print(text_file.read())
 
 
+def serve(request_filepath, response_filepath):
+    """
+    Run entry points for the bash side for a whole PiNet session, so it doesn't start a new Python for every $p call.
+    Each request is a JSON line {"args": [entry point, arguments...], "env": {variable: value}}, each response a JSON
+    line {"status": exit code, "data": whatever the entry point gave return_data()}. A {"status": 0, "data": "ready"}
+    line is sent first, once both pipes are open. Whiptail and print() still use the terminal, as the pipes are only
+    used for requests and responses. Returns when the request pipe is closed.
+    :param request_filepath: Named pipe requests are read from. Opened before the response pipe.
+    :param response_filepath: Named pipe responses are written to.
+    """
+    global servedData
+    # Background jobs of a bash script ignore Ctrl+C, but it should stop whatever the user is waiting on.
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    with open(request_filepath) as request_file, open(response_filepath, "w") as response_file:
+        response_file.write(json.dumps({"status": 0, "data": "ready"}) + "\n")
+        response_file.flush()
+        for line in request_file:
+            servedData = ""
+            environment = dict(os.environ)
+            try:
+                request = json.loads(line)
+                os.environ.update(request.get("env", {}))
+                get_release_channel()
+                run_entry_point([sys.argv[0]] + request["args"])
+                status = 0
+            except SystemExit as e:
+                status = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception:
+                fileLogger.exception("Request {} failed.".format(line.strip()))
+                traceback.print_exc()
+                status = 1
+            # The environment a request was sent with only applies to that request, as it would for a new python3.
+            os.environ.clear()
+            os.environ.update(environment)
+            sys.stdout.flush()
+            response_file.write(json.dumps({"status": status, "data": servedData}, ensure_ascii=False) + "\n")
+            response_file.flush()
+            servedData = None
+
+
 def remove_file(file):
     try:
         shutil.rmtree(file)
@@ -742,6 +2653,67 @@ def set_current_user_to_owner(path):
 
 # ----------------Whiptail functions-----------------
 
+def unattended():
+    """
+    PiNet runs unattended when started with pinet --answers file, which exports PINET_ANSWERS_FILE. Prompts are then
+    answered from PINET_ANSWER_<key> environment variables or the answers file, and never shown.
+    """
+    return bool(os.environ.get("PINET_ANSWERS_FILE"))
+
+
+def get_prompt_answer(answer_key, title="", default=None):
+    """
+    Look up the answer to a prompt. PINET_ANSWER_<key> environment variables come before the answers file (key=value
+    lines, like /etc/pinet), and answer prompts even when PiNet isn't running unattended.
+    If running unattended and there is no answer or default, PiNet can't continue, so this exits.
+    :param answer_key: Stable key of the prompt, for example ReleaseChannel. None for prompts without one.
+    :param title: Title of the prompt, for the error if there is no answer.
+    :param default: Answer to use when running unattended if the answers file doesn't give one.
+    :return: The answer, or None if the prompt should be shown.
+    """
+    answer = None
+    if answer_key:
+        answer = os.environ.get(ANSWER_ENVIRONMENT_PREFIX + answer_key)
+        if answer is None and unattended():
+            answer = get_config_file_parameter(answer_key, config_file_path=os.environ["PINET_ANSWERS_FILE"])
+    if answer is None and unattended():
+        answer = default
+        if answer is None:
+            message = _("Running unattended, but there is no answer for \"{}\" ({}) in {}.").format(
+                title, answer_key or _("prompt has no answer key"), os.environ["PINET_ANSWERS_FILE"])
+            fileLogger.error(message)
+            print(message)
+            sys.exit(UNANSWERED_EXIT_CODE)
+    if answer is not None:
+        fileLogger.info("Prompt {} (\"{}\") answered with \"{}\".".format(answer_key, title, answer))
+    return answer
+
+
+def get_whiptail_answer(whiptail_type, title, answer_key, default=None, custom_yes=""):
+    """
+    Answer a whiptail box without showing it, if it has an answer (see get_prompt_answer()). Message boxes are logged
+    and skipped when running unattended.
+    :param whiptail_type: Box type, for example yesno, inputbox, menu or checklist.
+    :param custom_yes: Label of the yes button, which is also accepted as a yes answer.
+    :return: (return code, output) whiptail would have given for the answer, or None if the box should be shown.
+    """
+    if whiptail_type == "msgbox":
+        if unattended():
+            fileLogger.info("Message \"{}\" not shown, running unattended.".format(title))
+            return 0, ""
+        return None
+    answer = get_prompt_answer(answer_key, title, default)
+    if answer is None:
+        return None
+    if whiptail_type == "yesno":
+        yes_answers = YES_ANSWERS + ((custom_yes.lower(),) if custom_yes else ())
+        return (0 if answer.strip().lower() in yes_answers else 1), ""
+    if whiptail_type == "checklist":
+        # Selected tags are output quoted, "tag1" "tag2"
+        return 0, " ".join('"{}"'.format(tag) for tag in answer.split())
+    return 0, answer
+
+
 #
 # A general-purpose whiptail function. This can be used in the implementation
 # of the other whiptail_... functions, allowing it to be overridden
@@ -768,25 +2740,34 @@ def whiptail(*args):
         return "ERROR"
 
 
-def whiptail_box(whiltailType, title, message, return_true_false, height="8", width="78", return_err=False, other=""):
-    cmd = ["whiptail", "--title", title, "--" + whiltailType, message, height, width, other]
-    p = Popen(cmd, stderr=PIPE)
-    out, err = p.communicate()
+def whiptail_box(whiltailType, title, message, return_true_false, height="8", width="78", return_err=False, other="",
+                 answer_key=None, default=None):
+    answer = get_whiptail_answer(whiltailType, title, answer_key, default)
+    if answer is None:
+        cmd = ["whiptail", "--title", title, "--" + whiltailType, message, height, width, other]
+        p = Popen(cmd, stderr=PIPE)
+        out, err = p.communicate()
+        return_code, output = p.returncode, err.decode()
+    else:
+        return_code, output = answer
 
     if return_true_false:
-        if p.returncode == 0:
+        if return_code == 0:
             return True
-        elif p.returncode == 1:
+        elif return_code == 1:
             return False
         else:
             return "ERROR"
     elif return_err:
-        return err.decode()
+        return output
     else:
-        return p.returncode
+        return return_code
 
 
-def whiptail_select_menu(title, message, items, height="16", width="78", other="5"):
+def whiptail_select_menu(title, message, items, height="16", width="78", other="5", answer_key=None, default=None):
+    answer = get_whiptail_answer("menu", title, answer_key, default)
+    if answer is not None:
+        return answer[1].encode()
     cmd = ["whiptail", "--title", title, "--menu", message, height, width, other]
     if isinstance(items, list):
         for x in range(0, len(items)):
@@ -805,7 +2786,10 @@ def whiptail_select_menu(title, message, items, height="16", width="78", other="
         return "Cancel"
 
 
-def whiptail_check_list(title, message, items):
+def whiptail_check_list(title, message, items, answer_key=None, default=None):
+    answer = get_whiptail_answer("checklist", title, answer_key, default)
+    if answer is not None:
+        return answer[1].encode()
     height, width, other = "20", "100", str(len(items))  # "16", "78", "5"
     cmd = ["whiptail", "--title", title, "--checklist", message, height, width, other]
     for x in range(0, len(items)):
@@ -821,24 +2805,29 @@ def whiptail_check_list(title, message, items):
 
 
 def whiptail_box_yes_no(title, message, return_true_false, height="8", width="78", return_error=False, custom_yes="",
-                        custom_no=""):
-    cmd = ["whiptail", "--yesno", "--title", title, message, height, width,
-           "--yes-button", custom_yes,
-           "--no-button", custom_no]
-    p = Popen(cmd, stderr=PIPE)
-    out, err = p.communicate()
+                        custom_no="", answer_key=None, default=None):
+    answer = get_whiptail_answer("yesno", title, answer_key, default, custom_yes=custom_yes)
+    if answer is None:
+        cmd = ["whiptail", "--yesno", "--title", title, message, height, width,
+               "--yes-button", custom_yes,
+               "--no-button", custom_no]
+        p = Popen(cmd, stderr=PIPE)
+        out, err = p.communicate()
+        return_code, output = p.returncode, err.decode()
+    else:
+        return_code, output = answer
 
     if return_true_false:
-        if p.returncode == 0:
+        if return_code == 0:
             return True
-        elif p.returncode == 1:
+        elif return_code == 1:
             return False
         else:
             return "ERROR"
     elif return_error:
-        return err.decode()
+        return output
     else:
-        return p.returncode
+        return return_code
 
 
 # ---------------- Main functions -------------------
@@ -855,24 +2844,25 @@ def replace_in_text_file(file_path, string_to_search_for, new_string, replace_al
     :param replace_entire_line: If found, replace the entire line. If false, does an inplace replace.
     :return: If string was found in file and replaced, return True. If appended on end of file, return False.
     """
-    text_file = read_file(file_path)
-    found = False
-    for index, line in enumerate(text_file):
-        if string_to_search_for in line:
-            if replace_entire_line:
-                text_file[index] = new_string
-            else:
-                text_file[index] = text_file[index].replace(string_to_search_for, new_string)
-            found = True
-            if not replace_all_uses:
-                break
-    if found:
-        write_file(file_path, text_file)
-        return True
-    if add_if_not_exists:
-        text_file.append(new_string)
-        write_file(file_path, text_file)
-    return False
+    with locked_file(file_path):
+        text_file = read_file(file_path)
+        found = False
+        for index, line in enumerate(text_file):
+            if string_to_search_for in line:
+                if replace_entire_line:
+                    text_file[index] = new_string
+                else:
+                    text_file[index] = text_file[index].replace(string_to_search_for, new_string)
+                found = True
+                if not replace_all_uses:
+                    break
+        if found:
+            write_file(file_path, text_file)
+            return True
+        if add_if_not_exists:
+            text_file.append(new_string)
+            write_file(file_path, text_file)
+        return False
 
 
 def replace_line_or_add(file, string, new_string):
@@ -881,9 +2871,10 @@ def replace_line_or_add(file, string, new_string):
     Pass it a text file in list form and it will search for strings.
     If it finds a string, it will replace that entire line with new_string
     """
-    text_file = read_file(file)
-    text_file = find_replace_any_line_in_list(text_file, string, new_string)
-    write_file(file, text_file)
+    with locked_file(file):
+        text_file = read_file(file)
+        text_file = find_replace_any_line_in_list(text_file, string, new_string)
+        write_file(file, text_file)
 
 
 def replace_bit_or_add(file, string, new_string):
@@ -892,9 +2883,125 @@ def replace_bit_or_add(file, string, new_string):
     Pass it a text file in list form and it will search for strings.
     If it finds a string, it will replace that exact string with new_string
     """
-    text_file = read_file(file)
-    text_file = find_replace_section_in_list(text_file, string, new_string)
-    write_file(file, text_file)
+    with locked_file(file):
+        text_file = read_file(file)
+        text_file = find_replace_section_in_list(text_file, string, new_string)
+        write_file(file, text_file)
+
+
+TextEdit = namedtuple("TextEdit", ["action", "search", "new_string"])
+
+
+class TextFileEditSession():
+    """
+    An ordered list of edits to a text file, applied in one pass over the file when the session is committed and
+    written back with a single atomic write_file() (only if anything changed). Each edit applies to every line
+    containing its search string, seeing the line as the edits before it left it, so the result is the same as
+    making the edits one after another.
+    Actions are replaceLine (replace the whole line), replace (replace the search string within the line),
+    addIfMissing (add new_string at the end if no line contains the search string), delete and deleteBlank (delete
+    empty lines, takes no search string).
+
+    with TextFileEditSession("/opt/ltsp/armhf/etc/lts.conf") as session:
+        session.replace_line("REMOTE_APPS", "REMOTE_APPS=True")
+        session.add_if_missing("REMOTE_APPS", "REMOTE_APPS=True")
+    """
+
+    file_path = None
+
+    def __init__(self, file_path):
+        super(TextFileEditSession, self).__init__()
+        self.file_path = file_path
+        self.edits = []
+        self.matches = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        if exc_type is None:
+            self.commit()
+
+    def edit(self, action, search, new_string=None):
+        if action not in TEXT_EDIT_ACTIONS:
+            raise ValueError("Unknown text edit {}".format(action))
+        self.edits.append(TextEdit(action, search, new_string))
+
+    def replace_line(self, search, new_string):
+        self.edit("replaceLine", search, new_string)
+
+    def replace(self, search, new_string):
+        self.edit("replace", search, new_string)
+
+    def add_if_missing(self, search, new_string):
+        self.edit("addIfMissing", search, new_string)
+
+    def delete(self, search):
+        self.edit("delete", search)
+
+    def delete_blank(self):
+        self.edit("deleteBlank", "")
+
+    def apply_edits(self, line, first_edit=0):
+        """
+        Run a line through the edits from first_edit on, counting the lines each edit matches.
+        :return: The edited line, or None if it was deleted.
+        """
+        for index in range(first_edit, len(self.edits)):
+            edit = self.edits[index]
+            if edit.action == "deleteBlank":
+                matched = not line
+            else:
+                matched = edit.search in line
+            if not matched:
+                continue
+            self.matches[index] += 1
+            if edit.action == "replaceLine":
+                line = edit.new_string
+            elif edit.action == "replace":
+                line = line.replace(edit.search, edit.new_string)
+            elif edit.action in ("delete", "deleteBlank"):
+                return None
+        return line
+
+    def commit(self):
+        """
+        :return: Number of lines each edit matched, in the order the edits were made. An addIfMissing edit that
+        matched 0 lines added its line.
+        """
+        self.matches = [0] * len(self.edits)
+        with locked_file(self.file_path):
+            original_lines = read_file(self.file_path)
+            lines = [line for line in (self.apply_edits(line) for line in original_lines) if line is not None]
+            for index, edit in enumerate(self.edits):
+                if edit.action == "addIfMissing" and self.matches[index] == 0:
+                    # Lines added go through the edits after the one adding them, as they would one at a time.
+                    line = self.apply_edits(edit.new_string, index + 1)
+                    if line is not None:
+                        lines.append(line)
+            if lines != original_lines:
+                write_file(self.file_path, lines)
+        return self.matches
+
+
+def edit_text_file(file_path, arguments):
+    """
+    Make a list of edits given on the command line in one TextFileEditSession, for example
+    editTextFile /opt/ltsp/armhf/etc/lts.conf delete NFS_HOME=/home replaceLine REMOTE_APPS REMOTE_APPS=True
+    :param arguments: Each action followed by its search string, then its new string unless it is a delete.
+    :return: Number of lines each edit matched.
+    """
+    session = TextFileEditSession(file_path)
+    arguments = deque(arguments)
+    while arguments:
+        action = arguments.popleft()
+        if action == "deleteBlank":
+            session.edit(action, "")
+        elif action == "delete":
+            session.edit(action, arguments.popleft())
+        else:
+            session.edit(action, arguments.popleft(), arguments.popleft())
+    return session.commit()
 
 
 def internet_on_urllib(timeout_limit=5, return_type=True):
@@ -902,20 +3009,25 @@ def internet_on_urllib(timeout_limit=5, return_type=True):
     Checks if there is an internet connection.
     If there is, return a 0, if not, return a 1
     """
+    import urllib.error
+    import urllib.request
     try:
-        response = urllib.request.urlopen('http://www.google.com', timeout=int(timeout_limit))
+        with profiled("http", 'http://www.google.com'):
+            response = urllib.request.urlopen('http://www.google.com', timeout=int(timeout_limit))
         return_data(0)
         return True
     except urllib.error.URLError:
         pass
     try:
-        response = urllib.request.urlopen('http://raspbian.raspberrypi.org/', timeout=int(timeout_limit))
+        with profiled("http", 'http://raspbian.raspberrypi.org/'):
+            response = urllib.request.urlopen('http://raspbian.raspberrypi.org/', timeout=int(timeout_limit))
         return_data(0)
         return True
     except urllib.error.URLError:
         pass
     try:
-        response = urllib.request.urlopen('http://18.62.0.96', timeout=int(timeout_limit))
+        with profiled("http", 'http://18.62.0.96'):
+            response = urllib.request.urlopen('http://18.62.0.96', timeout=int(timeout_limit))
         return_data(0)
         return True
     except urllib.error.URLError:
@@ -933,8 +3045,10 @@ def internet_on(timeout_limit=3, return_type=True):
             return_data(0)
             return True
 
+    import requests
     try:
-        response = requests.get("http://archive.raspbian.org/raspbian.public.key", timeout=int(timeout_limit))
+        with profiled("http", "http://archive.raspbian.org/raspbian.public.key"):
+            response = requests.get("http://archive.raspbian.org/raspbian.public.key", timeout=int(timeout_limit))
         if response.status_code == requests.codes.ok:
             set_config_parameter("InternetConnectionLastCheckSuccess", datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S"))
             return_data(0)
@@ -942,7 +3056,8 @@ def internet_on(timeout_limit=3, return_type=True):
     except (requests.ConnectionError, requests.Timeout):
         pass
     try:
-        response = requests.get("http://archive.raspberrypi.org/debian/raspberrypi.gpg.key", timeout=int(timeout_limit))
+        with profiled("http", "http://archive.raspberrypi.org/debian/raspberrypi.gpg.key"):
+            response = requests.get("http://archive.raspberrypi.org/debian/raspberrypi.gpg.key", timeout=int(timeout_limit))
         if response.status_code == requests.codes.ok:
             set_config_parameter("InternetConnectionLastCheckSuccess", datetime.datetime.now().strftime("%Y-%m-%d-%H:%M:%S"))
             return_data(0)
@@ -957,8 +3072,11 @@ def test_site_connection(site_url, timeout_limit=5):
     """
     Tests to see if can access the given website.
     """
+    import urllib.error
+    import urllib.request
     try:
-        response = urllib.request.urlopen(site_url, timeout=int(timeout_limit))
+        with profiled("http", site_url):
+            response = urllib.request.urlopen(site_url, timeout=int(timeout_limit))
         return True
     except urllib.error:
         return False
@@ -1013,7 +3131,7 @@ def internet_full_status_check(timeoutLimit=5):
             if not site[3]:
                 answer = whiptail_box("yesno", _("Proceeding not recommended"), _(
                     "A highly recommended site is inaccessible. Perhaps a proxy or web filtering system may be blockeing access. Would you like to proceed anyway? (not recommended). The domain that is unable to be accessed is - " +
-                    site[1]), True, height="11")
+                    site[1]), True, height="11", answer_key="ProceedWithoutSite")
                 if not answer:
                     return_data(1)
                     return False
@@ -1021,7 +3139,7 @@ def internet_full_status_check(timeoutLimit=5):
             if not site[3]:
                 answer = whiptail_box("yesno", _("Proceeding not recommended"), _(
                     "A recommended site is inaccessible. Perhaps a proxy or web filtering system may be blockeing access. Would you like to proceed anyway? (not recommended). The domain that is unable to be accessed is - " +
-                    site[1]), True, height="11")
+                    site[1]), True, height="11", answer_key="ProceedWithoutSite")
                 if answer == False:
                     return_data(1)
                     return False
@@ -1072,6 +3190,8 @@ def get_version_number(data):
 
 
 def check_update(current_version):
+    import feedparser
+    import xml.etree.ElementTree
     if not internet_on(5, False):
         print(_("No Internet Connection"))
         return_data(0)
@@ -1079,7 +3199,8 @@ def check_update(current_version):
     download_file("http://bit.ly/pinetCheckCommits", "/dev/null")
     pinet_software_update_url = "{}/commits/{}.atom".format(REPOSITORY, RELEASE_BRANCH)
     debug("Checking for updates from {}.".format(pinet_software_update_url))
-    d = feedparser.parse(pinet_software_update_url)
+    with profiled("http", pinet_software_update_url):
+        d = feedparser.parse(pinet_software_update_url)
     try:
         for index, entries in enumerate(d.entries): #Iterate over each line in the .atom file up to x5 times to find a line with a version number
             data = entries.content[0].get('value')
@@ -1171,8 +3292,11 @@ def install_check_kernel_updater():
 # def importUsers():
 
 def display_change_log(version):
+    import feedparser
+    import xml.etree.ElementTree
     version = "Release " + version
-    d = feedparser.parse(REPOSITORY + '/commits/' + RELEASE_BRANCH + '.atom')
+    with profiled("http", REPOSITORY + '/commits/' + RELEASE_BRANCH + '.atom'):
+        d = feedparser.parse(REPOSITORY + '/commits/' + RELEASE_BRANCH + '.atom')
     releases = []
     for x in range(0, len(d.entries)):
         data = (d.entries[x].content[0].get('value'))
@@ -1215,6 +3339,7 @@ def display_change_log(version):
 
 
 def open_csv_file(theFile):
+    import csv
     data_list = []
     if os.path.isfile(theFile):
         with open(theFile) as csvFile:
@@ -1234,6 +3359,7 @@ def open_csv_file(theFile):
 
 
 def import_users_csv(theFile, default_password, dry_run=False):
+    import crypt
     user_data_list = []
     data_list = open_csv_file(theFile)
     if dry_run == "True" or dry_run == True:
@@ -1343,6 +3469,7 @@ def save_pickled(toSave, path="/tmp/pinetSoftware.dump"):
     """
     Saves list of SoftwarePackage objects.
     """
+    import pickle
     with open(path, "wb") as output:
         pickle.dump(toSave, output, pickle.HIGHEST_PROTOCOL)
 
@@ -1351,6 +3478,7 @@ def load_pickled(path="/tmp/pinetSoftware.dump", delete_after=True):
     """
     Loads list of SoftwarePackage objects ready to be used.
     """
+    import pickle
     try:
         with open(path, "rb") as input:
             obj = pickle.load(input)
@@ -1413,22 +3541,335 @@ Type=Application
 Categories=Utility;Application;""".split("\n"))
 
 
+# The software PiNet installs, one package per line as
+# group|name|type|target|apt parameters|version|install commands|description
+# Trailing empty fields can be left off. An empty version uses the version manifests (see PackageVersionManifest).
+# Groups are installed in stages by install_chroot_software(), "extra" is the Additional Software menu.
+# A copy at SOFTWARE_MANIFEST_FILEPATH replaces this one.
+DEFAULT_SOFTWARE_MANIFEST = """
+# group|name|type|target|apt parameters|version|install commands|description
+base|idle|apt|chroot
+base|idle3|apt|chroot
+base|python-dev|apt|chroot
+base|nano|apt|chroot
+base|python3-dev|apt|chroot
+base|scratch|apt|chroot
+base|scratch2|apt|chroot
+base|python3-tk|apt|chroot
+base|git|apt|chroot
+base|debian-reference-en|apt|chroot
+base|dillo|apt|chroot
+base|apt-transport-https|apt|chroot
+base|python|apt|chroot
+base|python-pygame|apt|chroot
+base|python3-pygame|apt|chroot
+base|python-tk|apt|chroot
+base|sudo|apt|chroot
+base|sshpass|apt|chroot
+base|pcmanfm|apt|chroot|-o Dpkg::Options::="--force-confold"
+base|python3-numpy|apt|chroot
+base|wget|apt|chroot
+base|xpdf|apt|chroot
+base|gtk2-engines|apt|chroot
+base|alsa-utils|apt|chroot
+base|wpagui|apt|chroot
+base|omxplayer|apt|chroot
+base|lxde|apt|chroot
+base|net-tools|apt|chroot
+base|mpg123|apt|chroot
+base|ssh|apt|chroot
+base|locales|apt|chroot
+base|less|apt|chroot
+base|fbset|apt|chroot
+base|psmisc|apt|chroot
+base|strace|apt|chroot
+base|ifplugd|apt|chroot
+base|ed|apt|chroot
+base|ncdu|apt|chroot
+base|console-setup|apt|chroot
+base|keyboard-configuration|apt|chroot
+base|debconf-utils|apt|chroot
+base|parted|apt|chroot
+base|unzip|apt|chroot
+base|build-essential|apt|chroot
+base|manpages-dev|apt|chroot
+base|bash-completion|apt|chroot
+base|gdb|apt|chroot
+base|pkg-config|apt|chroot
+base|python-rpi.gpio|apt|chroot
+base|v4l-utils|apt|chroot
+base|lua5.1|apt|chroot
+base|luajit|apt|chroot
+base|hardlink|apt|chroot
+base|curl|apt|chroot
+base|fake-hwclock|apt|chroot
+base|nfs-common|apt|chroot
+base|usbutils|apt|chroot
+base|python3-rpi.gpio|apt|chroot
+base|python-pip|apt|chroot
+base|python3-pip|apt|chroot
+base|python-picamera|apt|chroot
+base|python3-picamera|apt|chroot
+base|python3-gpiozero|apt|chroot
+base|x2x|apt|chroot
+base|xserver-xorg-video-fbturbo|apt|chroot
+base|netsurf-common|apt|chroot
+base|netsurf-gtk|apt|chroot
+base|rpi-update|apt|chroot
+base|ftp|apt|chroot
+base|raspberrypi-kernel|apt|chroot
+base|raspberrypi-bootloader|apt|chroot
+base|libraspberrypi0|apt|chroot
+base|libraspberrypi-dev|apt|chroot
+base|libraspberrypi-doc|apt|chroot
+base|libraspberrypi-bin|apt|chroot
+base|i2c-tools|apt|chroot
+base|man-db|apt|chroot
+base|raspberrypi-artwork|apt|chroot
+base|ca-certificates|apt|chroot|--no-install-recommends
+base|cifs-utils|apt|chroot|--no-install-recommends
+base|midori|apt|chroot|--no-install-recommends
+base|lxtask|apt|chroot|--no-install-recommends
+base|epiphany-browser|apt|chroot|--no-install-recommends
+base|minecraft-pi|apt|chroot
+base|python-smbus|apt|chroot
+base|python3-smbus|apt|chroot
+base|dosfstools|apt|chroot
+base|ruby|apt|chroot
+base|iputils-ping|apt|chroot
+base|scrot|apt|chroot
+base|gstreamer1.0-x|apt|chroot
+base|gstreamer1.0-omx|apt|chroot
+base|gstreamer1.0-plugins-base|apt|chroot
+base|gstreamer1.0-plugins-good|apt|chroot
+base|gstreamer1.0-plugins-bad|apt|chroot
+base|gstreamer1.0-alsa|apt|chroot
+base|gstreamer1.0-libav|apt|chroot
+base|raspberrypi-sys-mods|apt|chroot|-o Dpkg::Options::="--force-confold"
+base|raspberrypi-net-mods|apt|chroot|-o Dpkg::Options::="--force-confnew"
+base|raspberrypi-ui-mods|apt|chroot|-o Dpkg::Options::="--force-confnew"
+base|java-common|apt|chroot|--no-install-recommends
+base|oracle-java8-jdk|apt|chroot
+# wolfram-engine must come after the Oracle Java packages, otherwise OpenJDK is installed
+base|wolfram-engine|apt|chroot
+base|apt-utils|apt|chroot
+base|wpasupplicant|apt|chroot
+base|wireless-tools|apt|chroot
+base|firmware-atheros|apt|chroot
+base|firmware-brcm80211|apt|chroot
+base|firmware-libertas|apt|chroot
+base|firmware-misc-nonfree|apt|chroot
+base|firmware-realtek|apt|chroot
+base|libpng12-dev|apt|chroot
+base|libreoffice|apt|chroot|--no-install-recommends
+base|libreoffice-gtk|apt|chroot|--no-install-recommends
+base|myspell-en-gb|apt|chroot
+base|mythes-en-us|apt|chroot
+base|smartsim|apt|chroot
+base|alacarte|apt|chroot
+base|rc-gui|apt|chroot
+base|claws-mail|apt|chroot
+base|tree|apt|chroot
+base|greenfoot|apt|chroot
+base|bluej|apt|chroot
+base|raspi-gpio|apt|chroot
+base|nuscratch|apt|chroot
+base|iceweasel|apt|chroot
+base|mu|apt|chroot
+base|python-twython|apt|chroot
+base|python3-twython|apt|chroot
+base|python-flask|apt|chroot
+base|python3-flask|apt|chroot
+base|python-picraft|apt|chroot
+base|python3-picraft|apt|chroot
+base|python3-thonny|apt|chroot
+base|libmtp-runtime|apt|chroot
+base|rsync|apt|chroot
+base|htop|apt|chroot
+base|fonts-liberation2|apt|chroot
+base|gldriver-test|apt|chroot
+base|python-gpiozero|apt|chroot
+base|libjpeg-dev|apt|chroot
+base|sense-hat|apt|chroot
+base|nodered|apt|chroot
+# libqt4-network can be removed when a Sonic-Pi update fixes its dependency issue
+base|libqt4-network|apt|chroot
+base|python-sense-emu|apt|chroot
+base|python3-sense-emu|apt|chroot
+base|sense-emu-tools|apt|chroot
+base|python-sense-emu-doc|apt|chroot
+base|gvfs|apt|chroot
+base|cups|apt|chroot
+base|policykit-1|apt|chroot
+base|fonts-droid-fallback|apt|chroot
+# Server side
+base|bindfs|apt|server
+base|python3-feedparser|apt|server
+base|ntp|apt|server
+base|python-pip|apt|server
+base|python3-pip|apt|server
+base|curl|apt|server
+# Installed with pip once the chroot packages are in
+python|pgzero|pip|chroot
+python|pibrella|pip|chroot
+python|skywriter|pip|chroot
+python|unicornhat|pip|chroot
+python|piglow|pip|chroot
+python|pianohat|pip|chroot
+python|explorerhat|pip|chroot
+python|twython|pip|chroot
+python|python-sonic|pip|chroot
+# Installed on their own after the Python packages
+sonic-pi|sonic-pi|apt|chroot
+chromium|chromium-browser|apt|chroot
+chromium|rpi-chromium-mods|apt|chroot
+# Optional software offered in the Additional Software menu
+extra|Arduino-IDE|apt|chroot|||arduino|Programming environment for Arduino microcontrollers
+extra|Scratch-gpio|scratch-gpio|chroot||||A special version of scratch for GPIO work
+extra|Epoptes|epoptes|chroot||||Free and open source classroom management software
+extra|Custom-package|custom-apt|chroot||||Allows you to enter the name of a package from Raspbian repository
+extra|Custom-python|custom-pip|chroot||||Allows you to enter the name of a Python library from pip.
+"""
+
+SoftwareManifestEntry = namedtuple("SoftwareManifestEntry", ("group", "name", "install_type", "install_on_server",
+                                                             "parameters", "version", "install_commands",
+                                                             "description"))
+InstallPlan = namedtuple("InstallPlan", ("add", "upgrade", "hold", "unhold", "up_to_date", "download_size",
+                                         "cached_size"))
+
+
+def parse_software_manifest(lines):
+    """
+    :param lines: Lines of a software manifest, see DEFAULT_SOFTWARE_MANIFEST.
+    :return: List of SoftwareManifestEntries, in manifest order. Invalid lines are logged and skipped.
+    """
+    entries = []
+    for line_number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        fields = [field.strip() for field in line.split("|")]
+        fields.extend([""] * (len(SoftwareManifestEntry._fields) - len(fields)))
+        group, name, install_type, target, parameters, version, install_commands, description = fields[:8]
+        if not name or install_type not in INSTALL_TYPES or target not in ("chroot", "server"):
+            fileLogger.warning("Skipping invalid software manifest line {} - {}".format(line_number, line))
+            continue
+        entries.append(SoftwareManifestEntry(group, name, INSTALL_TYPES[install_type], target == "server",
+                                             tuple(parameters.split()), version or None,
+                                             install_commands.split() or None, description))
+    return entries
+
+
+def get_software_manifest(group=None):
+    """
+    Load the software manifest, from SOFTWARE_MANIFEST_FILEPATH if it exists or the built in one if not. It is only
+    read once per process.
+    :param group: Only return the entries in this group.
+    :return: List of SoftwareManifestEntries.
+    """
+    global softwareManifest
+    if softwareManifest is None:
+        if os.path.isfile(SOFTWARE_MANIFEST_FILEPATH):
+            fileLogger.info("Using the software manifest from {}.".format(SOFTWARE_MANIFEST_FILEPATH))
+            softwareManifest = parse_software_manifest(read_file(SOFTWARE_MANIFEST_FILEPATH))
+        else:
+            softwareManifest = parse_software_manifest(DEFAULT_SOFTWARE_MANIFEST.splitlines())
+    return [entry for entry in softwareManifest if group is None or entry.group == group]
+
+
+def get_software_packages(group):
+    """
+    :return: List of SoftwarePackages for a group of the software manifest.
+    """
+    return [SoftwarePackage(entry.name, entry.install_type, install_commands=entry.install_commands,
+                            description=_(entry.description) if entry.description else "",
+                            install_on_server=entry.install_on_server, parameters=entry.parameters,
+                            version=entry.version) for entry in get_software_manifest(group)]
+
+
+def get_install_plan():
+    """
+    Diff the apt packages in the software manifest against what is installed on the server and in the chroot, from
+    dpkg's status file and apt's package lists, without running apt.
+    Download sizes are those of the newest available versions and don't include any new dependencies.
+    :return: InstallPlan. add and upgrade are lists of SoftwarePackages, hold and unhold lists of
+    (install_on_server, package name).
+    """
+    packages = unique_software_packages(
+        [package for group in ("base", "sonic-pi", "chromium") for package in get_software_packages(group)
+         if package.install_type == APT])
+    missing, mismatched, satisfied = diff_apt_packages(packages)
+
+    hold, unhold = [], []
+    for install_on_server in (False, True):
+        pinned = [package.name for package in packages
+                  if package.version and package.install_on_server == install_on_server]
+        if install_on_server:
+            to_hold, to_unhold = get_package_hold_changes(pinned, (), install_on_server=True)
+        else:
+            to_hold, to_unhold = get_package_hold_changes(pinned + list(ALWAYS_HELD_PACKAGES),
+                                                          get_package_version_manifest().package_names())
+        hold.extend((install_on_server, package_name) for package_name in to_hold)
+        unhold.extend((install_on_server, package_name) for package_name in to_unhold)
+
+    cached_filenames = os.listdir(APT_CACHE_DIRPATH) if os.path.isdir(APT_CACHE_DIRPATH) else []
+    download_size, cached_size = 0, 0
+    for package in missing + mismatched:
+        cache = get_package_state_cache(package.install_on_server)
+        for package_name in package.name.split():
+            candidate = cache.candidate(package_name)
+            if candidate is None:
+                continue
+            version, size = candidate
+            prefix = "{}_{}_".format(package_name, (package.version or version).replace(":", "%3a"))
+            if not package.install_on_server and any(filename.startswith(prefix) for filename in cached_filenames):
+                cached_size += size
+            else:
+                download_size += size
+    return InstallPlan(missing, mismatched, hold, unhold, len(satisfied), download_size, cached_size)
+
+
+def print_install_plan():
+    """
+    Print what installing the software manifest would change, with an estimate of the download size and time at
+    DownloadSpeed Mbit/s (from /etc/pinet, default 10).
+    """
+    plan = get_install_plan()
+
+    def describe(package):
+        installed = get_package_state_cache(package.install_on_server).installed_version(package.name)
+        wanted = package.version or get_package_state_cache(package.install_on_server).candidate_version(package.name)
+        return "  {}{} {}{}".format(package.name, " (server)" if package.install_on_server else "",
+                                   "{} -> ".format(installed) if installed else "", wanted or _("unknown version"))
+
+    for title, packages in ((_("Add"), plan.add), (_("Upgrade"), plan.upgrade)):
+        print("{} ({}):".format(title, len(packages)))
+        for package in packages:
+            print(describe(package))
+    for title, package_names in ((_("Hold"), plan.hold), (_("Unhold"), plan.unhold)):
+        print("{} ({}):".format(title, len(package_names)))
+        for install_on_server, package_name in package_names:
+            print("  {}{}".format(package_name, " (server)" if install_on_server else ""))
+    print(_("{} packages already up to date.").format(plan.up_to_date))
+    if not (plan.add or plan.upgrade or plan.hold or plan.unhold):
+        print(_("Nothing to change, the installed software matches the software manifest."))
+        return
+    try:
+        speed = float(get_config_file_parameter("DownloadSpeed") or DEFAULT_DOWNLOAD_SPEED)
+    except ValueError:
+        speed = DEFAULT_DOWNLOAD_SPEED
+    print(_("Download {:.1f} MB (plus {:.1f} MB from the apt cache), about {:.1f} minutes at {:g} Mbit/s. New dependencies are not included.").format(
+        plan.download_size / 1048576, plan.cached_size / 1048576, plan.download_size * 8 / (speed * 1000000) / 60, speed))
+    print(_("{} pip packages are checked by pip at install time.").format(len(get_software_manifest("python"))))
+
+
 def install_software_list(hold_off_install=False):
     """
     Replacement for ExtraSoftware function in bash.
     Builds a list of possible software to install (using SoftwarePackage class) then displays the list using checkbox Whiptail menu.
     Checks what options the user has collected, then saves the packages list to file (using pickle). If hold_off_install is False, then runs installSoftwareFromFile().
     """
-    software = [
-        SoftwarePackage("Arduino-IDE", APT, description=_("Programming environment for Arduino microcontrollers"),
-                        install_commands=["arduino", ]),
-        SoftwarePackage("Scratch-gpio", SCRATCH_GPIO, description=_("A special version of scratch for GPIO work")),
-        SoftwarePackage("Epoptes", EPOPTES, description=_("Free and open source classroom management software")),
-        SoftwarePackage("Custom-package", CUSTOM_APT,
-                        description=_(
-                            "Allows you to enter the name of a package from Raspbian repository")),
-        SoftwarePackage("Custom-python", CUSTOM_PIP,
-                        description=_("Allows you to enter the name of a Python library from pip."))]
+    software = get_software_packages("extra")
 
     software_list = []
     for i in software:
@@ -1442,7 +3883,8 @@ def install_software_list(hold_off_install=False):
             "In the next window you can select additional software you wish to install. Use space bar to select applications and hit enter when you are finished."),
                      False)
         result = (whiptail_check_list(_("Extra Software Submenu"), _(
-            "Select any software you want to install. Use space bar to select then enter to continue."), software_list))
+            "Select any software you want to install. Use space bar to select then enter to continue."), software_list,
+                                      answer_key="ExtraSoftware", default=""))
         try:
             result = result.decode("utf-8")
         except AttributeError:
@@ -1451,7 +3893,8 @@ def install_software_list(hold_off_install=False):
         if result != "Cancel":
             if result == "":
                 yesno = whiptail_box("yesno", _("Are you sure?"),
-                                     _("Are you sure you don't want to install any additional software?"), True)
+                                     _("Are you sure you don't want to install any additional software?"), True,
+                                     answer_key="ExtraSoftwareConfirm", default="yes")
                 if yesno:
                     save_pickled(software)
                     done = True
@@ -1459,7 +3902,8 @@ def install_software_list(hold_off_install=False):
                 result_list = result.split(" ")
                 yesno = whiptail_box("yesno", _("Are you sure?"),
                                      _("Are you sure you want to install this software?") + " \n" + (
-                                         result.replace(" ", "\n")), True, height=str(7 + len(result.split(" "))))
+                                         result.replace(" ", "\n")), True, height=str(7 + len(result.split(" "))),
+                                     answer_key="ExtraSoftwareConfirm", default="yes")
                 if yesno:
                     for i in software:
                         if i.name in result_list:
@@ -1472,6 +3916,8 @@ def install_software_list(hold_off_install=False):
         install_software_from_file()
 
 
+@persistent_chroot()
+@cached_apt_archives()
 def install_software_from_file(packages=None):
     """
     Second part of installSoftwareList().
@@ -1484,7 +3930,7 @@ def install_software_from_file(packages=None):
         if i.marked == True:
             print(_("Installing") + " " + str(i.name))
             if not need_compress:
-                ltsp_chroot("apt-get update")
+                apt_update()
             i.install_package()
             i.marked = False
             set_config_parameter("NBDBuildNeeded", "true")
@@ -1495,235 +3941,130 @@ def install_software_from_file(packages=None):
         nbd_run()
 
 
+@persistent_chroot()
+@cached_apt_archives()
 def install_chroot_software():
-    ltsp_chroot("apt-get update")
+    apt_update()
     ltsp_chroot("apt-get autoremove -y")
-    ltsp_chroot("apt-mark hold ca-certificates-java") # Needed to block OpenJDK installing, which fails to install on PiNet
-    packages = []
-    packages.append(SoftwarePackage("idle", APT))
-    packages.append(SoftwarePackage("idle3", APT))
-    packages.append(SoftwarePackage("python-dev", APT))
-    packages.append(SoftwarePackage("nano", APT))
-    packages.append(SoftwarePackage("python3-dev", APT))
-    packages.append(SoftwarePackage("scratch", APT))
-    packages.append(SoftwarePackage("scratch2", APT))
-    packages.append(SoftwarePackage("python3-tk", APT))
-    packages.append(SoftwarePackage("git", APT))
-    packages.append(SoftwarePackage("debian-reference-en", APT))
-    packages.append(SoftwarePackage("dillo", APT))
-    packages.append(SoftwarePackage("apt-transport-https", APT))
-    packages.append(SoftwarePackage("python", APT))
-    packages.append(SoftwarePackage("python-pygame", APT))
-    packages.append(SoftwarePackage("python3-pygame", APT))
-    packages.append(SoftwarePackage("python-tk", APT))
-    packages.append(SoftwarePackage("sudo", APT))
-    packages.append(SoftwarePackage("sshpass", APT))
-    packages.append(SoftwarePackage("pcmanfm", APT, parameters=("-o", 'Dpkg::Options::="--force-confold"',)))
-    packages.append(SoftwarePackage("python3-numpy", APT))
-    packages.append(SoftwarePackage("wget", APT))
-    packages.append(SoftwarePackage("xpdf", APT))
-    packages.append(SoftwarePackage("gtk2-engines", APT))
-    packages.append(SoftwarePackage("alsa-utils", APT))
-    packages.append(SoftwarePackage("wpagui", APT))
-    packages.append(SoftwarePackage("omxplayer", APT))
-    packages.append(SoftwarePackage("lxde", APT))
-    packages.append(SoftwarePackage("net-tools", APT))
-    packages.append(SoftwarePackage("mpg123", APT))
-    packages.append(SoftwarePackage("ssh", APT))
-    packages.append(SoftwarePackage("locales", APT))
-    packages.append(SoftwarePackage("less", APT))
-    packages.append(SoftwarePackage("fbset", APT))
-    packages.append(SoftwarePackage("sudo", APT))
-    packages.append(SoftwarePackage("psmisc", APT))
-    packages.append(SoftwarePackage("strace", APT))
-    packages.append(SoftwarePackage("ifplugd", APT))
-    packages.append(SoftwarePackage("ed", APT))
-    packages.append(SoftwarePackage("ncdu", APT))
-    packages.append(SoftwarePackage("console-setup", APT))
-    packages.append(SoftwarePackage("keyboard-configuration", APT))
-    packages.append(SoftwarePackage("debconf-utils", APT))
-    packages.append(SoftwarePackage("parted", APT))
-    packages.append(SoftwarePackage("unzip", APT))
-    packages.append(SoftwarePackage("build-essential", APT))
-    packages.append(SoftwarePackage("manpages-dev", APT))
-    packages.append(SoftwarePackage("python", APT))
-    packages.append(SoftwarePackage("bash-completion", APT))
-    packages.append(SoftwarePackage("gdb", APT))
-    packages.append(SoftwarePackage("pkg-config", APT))
-    packages.append(SoftwarePackage("python-rpi.gpio", APT))
-    packages.append(SoftwarePackage("v4l-utils", APT))
-    packages.append(SoftwarePackage("lua5.1", APT))
-    packages.append(SoftwarePackage("luajit", APT))
-    packages.append(SoftwarePackage("hardlink", APT))
-    packages.append(SoftwarePackage("curl", APT))
-    packages.append(SoftwarePackage("fake-hwclock", APT))
-    # packages.append(SoftwarePackage("ntp", APT))
-    packages.append(SoftwarePackage("nfs-common", APT))
-    packages.append(SoftwarePackage("usbutils", APT))
-    #packages.append(SoftwarePackage("libfreetype6-dev", APT))
-    packages.append(SoftwarePackage("python3-rpi.gpio", APT))
-    packages.append(SoftwarePackage("python-rpi.gpio", APT))
-    packages.append(SoftwarePackage("python-pip", APT))
-    packages.append(SoftwarePackage("python3-pip", APT))
-    packages.append(SoftwarePackage("python-picamera", APT))
-    packages.append(SoftwarePackage("python3-picamera", APT))
-    packages.append(SoftwarePackage("python3-gpiozero", APT))
-    packages.append(SoftwarePackage("x2x", APT))
-    packages.append(SoftwarePackage("xserver-xorg-video-fbturbo", APT))
-    packages.append(SoftwarePackage("netsurf-common", APT))
-    packages.append(SoftwarePackage("netsurf-gtk", APT))
-    packages.append(SoftwarePackage("rpi-update", APT))
-    packages.append(SoftwarePackage("ftp", APT))
-    packages.append(SoftwarePackage("raspberrypi-kernel", APT))
-    packages.append(SoftwarePackage("raspberrypi-bootloader", APT))
-    packages.append(SoftwarePackage("libraspberrypi0", APT))
-    packages.append(SoftwarePackage("libraspberrypi-dev", APT))
-    packages.append(SoftwarePackage("libraspberrypi-doc", APT))
-    packages.append(SoftwarePackage("libraspberrypi-bin", APT))
-    packages.append(SoftwarePackage("i2c-tools", APT))
-    packages.append(SoftwarePackage("man-db", APT))
-    packages.append(SoftwarePackage("raspberrypi-artwork", APT))
-    packages.append(SoftwarePackage("ca-certificates", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("cifs-utils", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("midori", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("lxtask", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("epiphany-browser", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("minecraft-pi", APT))
-    packages.append(SoftwarePackage("python-smbus", APT))
-    packages.append(SoftwarePackage("python3-smbus", APT))
-    packages.append(SoftwarePackage("dosfstools", APT))
-    packages.append(SoftwarePackage("ruby", APT))
-    packages.append(SoftwarePackage("iputils-ping", APT))
-    packages.append(SoftwarePackage("scrot", APT))
-    packages.append(SoftwarePackage("gstreamer1.0-x", APT))
-    packages.append(SoftwarePackage("gstreamer1.0-omx", APT))
-    packages.append(SoftwarePackage("gstreamer1.0-plugins-base", APT))
-    packages.append(SoftwarePackage("gstreamer1.0-plugins-good", APT))
-    packages.append(SoftwarePackage("gstreamer1.0-plugins-bad", APT))
-    packages.append(SoftwarePackage("gstreamer1.0-alsa", APT))
-    packages.append(SoftwarePackage("gstreamer1.0-libav", APT))
-    packages.append(SoftwarePackage("raspberrypi-sys-mods", APT, parameters=("-o", 'Dpkg::Options::="--force-confold"',)))
-    packages.append(SoftwarePackage("raspberrypi-net-mods", APT, parameters=("-o", 'Dpkg::Options::="--force-confnew"',)))
-    packages.append(SoftwarePackage("raspberrypi-ui-mods", APT, parameters=("-o", 'Dpkg::Options::="--force-confnew"',)))
-    packages.append(SoftwarePackage("java-common", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("oracle-java8-jdk", APT))
-    packages.append(SoftwarePackage("wolfram-engine", APT)) # Must be installed after the Oracle Java packages, otherwise OpenJDK is installed
-    packages.append(SoftwarePackage("apt-utils", APT))
-    packages.append(SoftwarePackage("wpasupplicant", APT))
-    packages.append(SoftwarePackage("wireless-tools", APT))
-    packages.append(SoftwarePackage("firmware-atheros", APT))
-    packages.append(SoftwarePackage("firmware-brcm80211", APT))
-    packages.append(SoftwarePackage("firmware-libertas", APT))
-    packages.append(SoftwarePackage("firmware-misc-nonfree", APT))
-    packages.append(SoftwarePackage("firmware-realtek", APT))
-    packages.append(SoftwarePackage("libpng12-dev", APT))
-    # packages.append(SoftwarePackage("linux-image-3.18.0-trunk-rpi", APT))
-    # packages.append(SoftwarePackage("linux-image-3.18.0-trunk-rpi2", APT))
-    # packages.append(SoftwarePackage("linux-image-3.12-1-rpi", APT))
-    # packages.append(SoftwarePackage("linux-image-3.10-3-rpi", APT))
-    # packages.append(SoftwarePackage("linux-image-3.2.0-4-rpi", APT))
-    #packages.append(SoftwarePackage("linux-image-rpi-rpfv", APT))
-    #packages.append(SoftwarePackage("linux-image-rpi2-rpfv", APT))
-    packages.append(SoftwarePackage("libreoffice", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("libreoffice-gtk", APT, parameters=("--no-install-recommends",)))
-    packages.append(SoftwarePackage("myspell-en-gb", APT))
-    packages.append(SoftwarePackage("mythes-en-us", APT))
-    packages.append(SoftwarePackage("smartsim", APT))
-    packages.append(SoftwarePackage("alacarte", APT))
-    packages.append(SoftwarePackage("rc-gui", APT))
-    packages.append(SoftwarePackage("claws-mail", APT))
-    packages.append(SoftwarePackage("tree", APT))
-    packages.append(SoftwarePackage("greenfoot", APT))
-    packages.append(SoftwarePackage("bluej", APT))
-    packages.append(SoftwarePackage("raspi-gpio", APT))
-    packages.append(SoftwarePackage("libreoffice", APT))
-    packages.append(SoftwarePackage("nuscratch", APT))
-    packages.append(SoftwarePackage("iceweasel", APT))
-    packages.append(SoftwarePackage("mu", APT))
-    packages.append(SoftwarePackage("python-twython", APT))
-    packages.append(SoftwarePackage("python3-twython", APT))
-    packages.append(SoftwarePackage("python-flask", APT))
-    packages.append(SoftwarePackage("python3-flask", APT))
-    packages.append(SoftwarePackage("python-picraft", APT))
-    packages.append(SoftwarePackage("python3-picraft", APT))
-    packages.append(SoftwarePackage("python3-thonny", APT))
-    packages.append(SoftwarePackage("libmtp-runtime", APT))
-    packages.append(SoftwarePackage("rsync", APT))
-    packages.append(SoftwarePackage("htop", APT))
-    packages.append(SoftwarePackage("fonts-liberation2", APT))
-    packages.append(SoftwarePackage("gldriver-test", APT))
-    packages.append(SoftwarePackage("python-gpiozero", APT))
-    packages.append(SoftwarePackage("python3-gpiozero", APT))
     ltsp_chroot("touch /boot/config.txt")  # Required due to bug in sense-hat package installer
-    packages.append(SoftwarePackage("libjpeg-dev", APT))
-    #packages.append(SoftwarePackage("pillow", PIP))
-    packages.append(SoftwarePackage("sense-hat", APT))
-    packages.append(SoftwarePackage("nodered", APT))
-    packages.append(SoftwarePackage("libqt4-network", APT))  # Remove when Sonic-Pi update fixes dependency issue.
-    packages.append((SoftwarePackage("python-sense-emu", APT)))
-    packages.append((SoftwarePackage("python3-sense-emu", APT)))
-    packages.append((SoftwarePackage("sense-emu-tools", APT)))
-    packages.append((SoftwarePackage("python-sense-emu-doc", APT)))
-    packages.append((SoftwarePackage("gvfs", APT)))
-    packages.append((SoftwarePackage("cups", APT)))
-    packages.append((SoftwarePackage("policykit-1", APT)))
-    packages.append((SoftwarePackage("fonts-droid-fallback", APT)))
-    packages.append((SoftwarePackage("fonts-liberation2", APT)))
-
-    packages.append(SoftwarePackage("bindfs", APT, install_on_server=True))
-    packages.append(SoftwarePackage("python3-feedparser", APT, install_on_server=True))
-    packages.append(SoftwarePackage("ntp", APT, install_on_server=True))
-    packages.append(SoftwarePackage("python-pip", APT, install_on_server=True))
-    packages.append(SoftwarePackage("python3-pip", APT, install_on_server=True))
-    packages.append(SoftwarePackage("curl", APT, install_on_server=True))
-
-    #for package in packages:
-    #    package.install_package()
-
-    # Unhold all packages
-    pinet_package_versions_path = "/opt/PiNet/pinet-package-versions.txt"
-    pinet_bootfiles_versions_path = "/opt/PiNet/PiBootBackup/apt_version.txt"
-    held_packages = list(parse_config_file(read_file(pinet_package_versions_path)).keys()) + list(parse_config_file(read_file(pinet_bootfiles_versions_path)).keys())
-    for package in held_packages:
-        ltsp_chroot("apt-mark unhold {}".format(package), ignore_errors=True)
-        fileLogger.debug("Marking {} to be unheld for updates.".format(package))
-
-
-    group_apt_installer(packages)
+    packages = get_software_packages("base")
+
+    # Packages no longer pinned to a version are unheld so they can update. The ones still pinned are installed with
+    # --allow-change-held-packages and held once installed by group_apt_installer().
+    pinned = [package.name for package in packages if package.version and not package.install_on_server]
+    to_hold, to_unhold = get_package_hold_changes(pinned + list(ALWAYS_HELD_PACKAGES),
+                                                  get_package_version_manifest().package_names())
+    apply_package_holds(to_hold=sorted(set(to_hold) - set(pinned)), to_unhold=to_unhold)
+
+    python_packages = get_software_packages("python")
+    server_packages = [package for package in packages if package.install_on_server]
+    chroot_packages = [package for package in packages if not package.install_on_server]
+
+    #ltsp_chroot("sudo apt-get -y purge clipit")  # Remove clipit application as serves no purpose on Raspbian
+    # The server and the chroot have separate apt locks, so server side work runs alongside the chroot side work.
+    tasks = [
+        Task("chroot packages", group_apt_installer, (chroot_packages,), needs=(CHROOT_APT, NETWORK)),
+        Task("server packages", group_apt_installer, (server_packages,), needs=(SERVER_APT, NETWORK)),
+        # Runs alongside the chroot tasks, so it mustn't stop to ask anything on the shared terminal.
+        Task("server upgrade", run_bash, (SERVER_UPGRADE_COMMAND,), needs=(SERVER_APT, NETWORK), after=("server packages",)),
+        Task("ssh keys", run_bash, ("ltsp-update-sshkeys",), needs=(CHROOT_FS,), after=("server upgrade",)),
+        Task("raspi2png", install_raspi2png, needs=(NETWORK, CHROOT_FS)),
+        Task("python packages", install_chroot_python_packages, (python_packages,), needs=(CHROOT_APT, NETWORK), after=("chroot packages",)),
+        Task("sonic-pi", group_apt_installer, (get_software_packages("sonic-pi"),), needs=(CHROOT_APT, NETWORK), after=("python packages",)),
+        Task("chromium", group_apt_installer, (get_software_packages("chromium"),), needs=(CHROOT_APT, NETWORK), after=("sonic-pi",)),
+        Task("chroot upgrade", ltsp_chroot, ("apt-get upgrade -y",), needs=(CHROOT_APT, NETWORK), after=("chromium",)),
+        Task("chroot autoremove", ltsp_chroot, ("apt-get autoremove -y",), needs=(CHROOT_APT,), after=("chroot upgrade",)),
+    ]
+    results = run_tasks(tasks)
+    failed = [task.name for task in tasks if task.name not in results]
+    if failed:
+        fileLogger.error("Software install tasks {} failed.".format(", ".join(failed)))
+        print(_("Unable to finish installing software, these steps failed - {}. See the PiNet log for details.").format(
+            ", ".join(failed)))
+        return False
+    return True
 
+
+def install_chroot_python_packages(python_packages):
+    """
+    Upgrade pip in the chroot, then install the provided PIP SoftwarePackages.
+    """
     ltsp_chroot("easy_install --upgrade pip")  # Fixes known "cannot import name IncompleteRead" error
     ltsp_chroot("easy_install3 --upgrade pip")  # Fixes known "cannot import name IncompleteRead" error
+    package_names = []
+    for python_package in python_packages:
+        python_package.marked = False
+        if isinstance(python_package.install_commands, list) and python_package.install_commands:
+            package_names.extend(python_package.install_commands)
+        else:
+            package_names.extend((python_package.install_commands or python_package.name).split())
+    install_pip_packages(package_names)
 
-    python_packages = []
 
-    python_packages.append(SoftwarePackage("pgzero", PIP))
-    python_packages.append(SoftwarePackage("pibrella", PIP))
-    python_packages.append(SoftwarePackage("skywriter", PIP))
-    python_packages.append(SoftwarePackage("unicornhat", PIP))
-    python_packages.append(SoftwarePackage("piglow", PIP))
-    python_packages.append(SoftwarePackage("pianohat", PIP))
-    python_packages.append(SoftwarePackage("explorerhat", PIP))
-    python_packages.append(SoftwarePackage("twython", PIP))
-    python_packages.append(SoftwarePackage("python-sonic", PIP))
+@contextlib.contextmanager
+def mounted_pip_cache():
+    """
+    Bind mount the persistent pip cache (PIP_CACHE_DIRPATH) into the chroot for the with block, so wheels built
+    under emulation are kept across Update-All and Rebuild-OS.
+    :return: Path of the cache inside the chroot, or None if it couldn't be mounted.
+    """
+    mount_point = CHROOT_DIRPATH + CHROOT_PIP_CACHE_DIRPATH
+    make_folder(PIP_CACHE_DIRPATH)
+    make_folder(mount_point)
+    if run_bash(["mount", "--bind", PIP_CACHE_DIRPATH, mount_point], ignore_errors=True) is not True:
+        fileLogger.warning("Unable to mount the pip cache into the chroot, installing without it.")
+        yield None
+        return
+    try:
+        yield CHROOT_PIP_CACHE_DIRPATH
+    finally:
+        run_bash(["umount", mount_point], ignore_errors=True)
 
 
-    for python_package in python_packages:
-        python_package.install_package()
+def install_pip_packages(package_names, install_on_server=False):
+    """
+    Install Python packages with one pip install per interpreter (pip2 and pip3). In the chroot, pip's cache is the
+    persistent one mounted by mounted_pip_cache(). If a batch fails, it is split up to find the failing packages.
+    :param package_names: List of pip package names.
+    :param install_on_server: Install on the server instead of the Raspbian chroot.
+    :return: List of (pip, package name) that failed to install.
+    """
+    if not package_names:
+        return []
+    if install_on_server:
+        failed = run_pip_installs(package_names, run_bash)
+    else:
+        with mounted_pip_cache() as cache_dirpath:
+            failed = run_pip_installs(package_names, ltsp_chroot, cache_dirpath)
+    if failed:
+        fileLogger.warning("Failed to install pip packages - {}".format(
+            ", ".join("{} ({})".format(package_name, pip) for pip, package_name in failed)))
+    return failed
+
+
+def run_pip_installs(package_names, run, cache_dirpath=None):
+    """
+    :param run: run_bash or ltsp_chroot.
+    :param cache_dirpath: pip cache directory to use, or None for pip's default.
+    :return: List of (pip, package name) that failed to install.
+    """
+    failed = []
+    for pip in ("pip2", "pip3"):
+        command = [pip, "install", "-U"]
+        if cache_dirpath:
+            command.extend(["--cache-dir", cache_dirpath])
+        failed.extend((pip, package_name) for package_name in bisect_install(
+            list(package_names), lambda batch: run(command + batch, ignore_errors=True) is True))
+    return failed
 
+
+def install_raspi2png():
     if not os.path.exists("/opt/ltsp/armhf/usr/local/bin/raspi2png"):
         download_file("https://github.com/AndrewFromMelbourne/raspi2png/blob/master/raspi2png?raw=true",
                       "/tmp/raspi2png")
         copy_file_folder("/tmp/raspi2png", "/opt/ltsp/armhf/usr/local/bin/raspi2png")
         os.chmod("/opt/ltsp/armhf/usr/local/bin/raspi2png", 0o755)
 
-    #ltsp_chroot("sudo apt-get -y purge clipit")  # Remove clipit application as serves no purpose on Raspbian
-    run_bash("sudo DEBIAN_FRONTEND=noninteractive ltsp-chroot --arch armhf apt-get install -y sonic-pi")
-    run_bash("sudo DEBIAN_FRONTEND=noninteractive ltsp-chroot --arch armhf apt-get install -y chromium-browser rpi-chromium-mods")
-    run_bash("apt-get upgrade -y")
-    run_bash("ltsp-update-sshkeys")
-    ltsp_chroot("apt-get upgrade -y")
-    ltsp_chroot("apt-get autoremove -y")
-
 
 def nbd_run():
     """
@@ -1753,8 +4094,10 @@ def get_external_ip_address():
     Get the PiNet server external IP address using an external server.
     If there is any issues, defaults to returning 0.0.0.0.
     """
+    import requests
     try:
-        response = requests.get("http://links.pinet.org.uk/external_ip", timeout=5).text.strip()
+        with profiled("http", "http://links.pinet.org.uk/external_ip"):
+            response = requests.get("http://links.pinet.org.uk/external_ip", timeout=5).text.strip()
         if len(response) > 16: # Verify isn't a blocked site page etc.
             return "0.0.0.0"
         return response
@@ -1821,13 +4164,15 @@ def ask_extra_stats_info():
                  False, height="13")
     city = whiptail_box("inputbox", _("Nearest major city"), _(
         "To help with putting a dot on the map for your server, what is your nearest major town or city? Leave blank if you don't want to answer."),
-                        False, return_err=True)
+                        False, return_err=True, answer_key="City", default="")
     organisation_type = whiptail_select_menu(_("Organisation type"), _(
         "What type of organisation are you setting PiNet up for? Leave on blank if you don't want to answer."),
                                              ["Blank", "School", "Non Commercial Organisation",
-                                              "Commercial Organisation", "Raspberry Jam/Club", "N/A"])
+                                              "Commercial Organisation", "Raspberry Jam/Club", "N/A"],
+                                             answer_key="OrganisationType", default="Blank")
     organisation_name = whiptail_box("inputbox", _("School/organisation name"), _(
-        "What is the name of your organisation? Leave blank if you don't want to answer."), False, return_err=True)
+        "What is the name of your organisation? Leave blank if you don't want to answer."), False, return_err=True,
+                                     answer_key="OrganisationName", default="")
     whiptail_box("msgbox", _("Additional information"), _(
         'Thanks for taking the time to read through (and if possible fill in) additional information. If you ever want to edit your information supplied, you can do so by selecting the "Other" menu and selecting "Edit-Information".'),
                  False, height="11")
@@ -1952,12 +4297,14 @@ def restore_chroot():
 
 
 def get_current_raspbian_release():
+    import requests
     release_channel = get_config_file_parameter("ReleaseChannel")
     if release_channel:
         release_channel = release_channel.lower()
     try:
-        release_version = int(requests.get("https://links.pinet.org.uk/current_raspbian_release_{}_version".format(release_channel)).text.strip()[:2])
-        release_title = str(requests.get("https://links.pinet.org.uk/current_raspbian_release_{}_title".format(release_channel)).text.strip()[:10])
+        with profiled("http", "https://links.pinet.org.uk/current_raspbian_release_{}".format(release_channel)):
+            release_version = int(requests.get("https://links.pinet.org.uk/current_raspbian_release_{}_version".format(release_channel)).text.strip()[:2])
+            release_title = str(requests.get("https://links.pinet.org.uk/current_raspbian_release_{}_title".format(release_channel)).text.strip()[:10])
         return release_version, release_title
     except:
         return RASPBIAN_RELEASE, "Unknown"
@@ -2035,20 +4382,25 @@ def upgrade_raspbian_release_part_two():  # Runs after new version is installed.
 
 
 
+@persistent_chroot()
 def upgrade_raspbian_inplace(new_release_version):
+    sources_list = TextFileEditSession("/opt/ltsp/armhf/etc/apt/sources.list")
+    raspi_list = TextFileEditSession("/opt/ltsp/armhf/etc/apt/sources.list.d/raspi.list")
+    pinet_list = TextFileEditSession("/opt/ltsp/armhf/etc/apt/sources.list.d/pinet.list")
     for release in RASPBIAN_RELEASES.values():
         release = release.lower()
-        replace_in_text_file("/opt/ltsp/armhf/etc/apt/sources.list", release, RASPBIAN_RELEASES[new_release_version].lower(), replace_all_uses=True, replace_entire_line=False, add_if_not_exists=False)
-        replace_in_text_file("/opt/ltsp/armhf/etc/apt/sources.list", "mirrordirector.raspbian.org", "raspbian.raspberrypi.org", replace_all_uses=True, replace_entire_line=False, add_if_not_exists=False)
-        replace_in_text_file("/opt/ltsp/armhf/etc/apt/sources.list.d/raspi.list", release, RASPBIAN_RELEASES[new_release_version].lower(), replace_all_uses=True, replace_entire_line=False, add_if_not_exists=False)
-        replace_in_text_file("/opt/ltsp/armhf/etc/apt/sources.list.d/pinet.list", release, RASPBIAN_RELEASES[new_release_version].lower(), replace_all_uses=True, replace_entire_line=False, add_if_not_exists=False)
-
-    replace_in_text_file("/opt/ltsp/armhf/etc/apt/sources.list.d/raspi.list", "staging", "", replace_all_uses=True, replace_entire_line=False, add_if_not_exists=False) # Remove staging as no longer used beyond Jessie
-
-    ltsp_chroot("apt update")
+        sources_list.replace(release, RASPBIAN_RELEASES[new_release_version].lower())
+        sources_list.replace("mirrordirector.raspbian.org", "raspbian.raspberrypi.org")
+        raspi_list.replace(release, RASPBIAN_RELEASES[new_release_version].lower())
+        pinet_list.replace(release, RASPBIAN_RELEASES[new_release_version].lower())
+    raspi_list.replace("staging", "")  # Remove staging as no longer used beyond Jessie
+    for session in (sources_list, raspi_list, pinet_list):
+        session.commit()
+
+    apt_update()
     #ltsp_chroot("apt -y purge pulseaudio*")  # Causing some issues in relation to ltsp-client package, so disabling line for now
     ltsp_chroot("apt full-upgrade -y")
-    ltsp_chroot("apt update")
+    apt_update()
     install_chroot_software()
     install_pinet_theme()
     reset_theme_cache_for_all_users()
@@ -2106,7 +4458,7 @@ def custom_config_txt():
     with tempfile.NamedTemporaryFile(mode="w", delete=False) as temp_config_file:
         additional_config = information_lines + additional_config
         temp_config_file.write('\n'.join(additional_config) + '\n')
-    run_bash(["nano", temp_config_file.name])
+    run_bash(["nano", temp_config_file.name], interactive=True)
     write_file(additional_config_path, read_file(temp_config_file.name)[5:])
     if whiptail_box("yesno", _("Update-SD"), _("Config file has been updated. To push this update out, Update-SD needs run. Would you like to run Update-SD?"), True, height="10"):
         update_sd()
@@ -2187,6 +4539,7 @@ def parse_group_file(lines):
     return groups
 
 
+@persistent_chroot()
 def verify_groups():
     """
     Verify that all groups are correctly set up in the chroot and also on the server OS
@@ -2195,27 +4548,33 @@ def verify_groups():
     server_groups = parse_group_file(read_file("/etc/group"))
     pi_groups = parse_group_file(read_file("/opt/ltsp/armhf/etc/group"))
 
-    for group in PINET_GROUPS:
-        if group in server_groups:
-            if PINET_GROUPS[group] and PINET_GROUPS[group] != server_groups[group]:
-                fileLogger.warning("The group with name {} on server has an ID mismatch. It is currently using {} and should be using {}. This has been corrected.".format(group, server_groups[group], PINET_GROUPS[group]))
-                modify_linux_group(group, PINET_GROUPS[group], in_chroot=False)
-                set_config_parameter("NBDBuildNeeded", "true")
-        else:
-            # If required group doesn't exist on the server, add it.
-            add_linux_group(group, PINET_GROUPS[group])
-
-        if PINET_GROUPS[group]:
-            if group in pi_groups:
-                if PINET_GROUPS[group] != pi_groups[group]:
-                    fileLogger.warning("The group with name {} on the Raspbian chroot has an ID mismatch. It is currently using {} and should be using {}. This has been corrected.".format(group, pi_groups[group], PINET_GROUPS[group]))
-                    modify_linux_group(group, PINET_GROUPS[group], in_chroot=True)
-                    set_config_parameter("NBDBuildNeeded", "true")
+    # NBDBuildNeeded is set once at the end, but also if a later group fails (or the user aborts), as the changes
+    # already made still need the image rebuilt.
+    nbd_build_needed = False
+    try:
+        for group in PINET_GROUPS:
+            if group in server_groups:
+                if PINET_GROUPS[group] and PINET_GROUPS[group] != server_groups[group]:
+                    fileLogger.warning("The group with name {} on server has an ID mismatch. It is currently using {} and should be using {}. This has been corrected.".format(group, server_groups[group], PINET_GROUPS[group]))
+                    nbd_build_needed = True
+                    modify_linux_group(group, PINET_GROUPS[group], in_chroot=False)
             else:
-                # If required group doesn't exist on the Raspbian chroot, add it.
-                add_linux_group(group, PINET_GROUPS[group], in_chroot=True)
-                set_config_parameter("NBDBuildNeeded", "true")
-
+                # If required group doesn't exist on the server, add it.
+                add_linux_group(group, PINET_GROUPS[group])
+
+            if PINET_GROUPS[group]:
+                if group in pi_groups:
+                    if PINET_GROUPS[group] != pi_groups[group]:
+                        fileLogger.warning("The group with name {} on the Raspbian chroot has an ID mismatch. It is currently using {} and should be using {}. This has been corrected.".format(group, pi_groups[group], PINET_GROUPS[group]))
+                        nbd_build_needed = True
+                        modify_linux_group(group, PINET_GROUPS[group], in_chroot=True)
+                else:
+                    # If required group doesn't exist on the Raspbian chroot, add it.
+                    nbd_build_needed = True
+                    add_linux_group(group, PINET_GROUPS[group], in_chroot=True)
+    finally:
+        if nbd_build_needed:
+            set_config_parameter("NBDBuildNeeded", "true")
 
 def get_users_linux_groups(username):
     """
@@ -2263,7 +4622,7 @@ def select_release_channel():
     current_channel = get_config_file_parameter("ReleaseChannel")
     if not current_channel:
         current_channel = _("no channel selected, defaulting to stable")
-    release = decode_bash_output(whiptail_select_menu(_("Release Channel"), _("Select a release channel to use. If in doubt, select Stable. Your current selected channel is \"{}\".".format(current_channel)), OrderedDict([("Stable", _("Extensively tested. Recommended for production use.")), ("Beta", _("Partially tested. Suitable in non production environment.")), ("Alpha", _("Experimental & untested. Use only for testing bleeding edge features."))]), width="80"), True, False)
+    release = decode_bash_output(whiptail_select_menu(_("Release Channel"), _("Select a release channel to use. If in doubt, select Stable. Your current selected channel is \"{}\".".format(current_channel)), OrderedDict([("Stable", _("Extensively tested. Recommended for production use.")), ("Beta", _("Partially tested. Suitable in non production environment.")), ("Alpha", _("Experimental & untested. Use only for testing bleeding edge features."))]), width="80", answer_key="ReleaseChannel", default="Stable"), True, False)
     if release in ["Stable", "Beta", "Alpha", "Development"]:
         set_config_parameter("ReleaseChannel", str(release).lower())
         return_data(1)
@@ -2279,6 +4638,11 @@ def select_release_channel():
 
 def get_internal_ip_address():
     # Using netiface, grab the current internal IP address. If 2 network cards, pick alphabetically
+    try:
+        import netifaces
+    except ImportError:
+        print("Unable to import netifaces. Please run sudo pip3 install netifaces")
+        return "0.0.0.0"
     try:
         interfaces = netifaces.interfaces()
         for interface in interfaces:
@@ -2293,9 +4657,9 @@ def get_internal_ip_address():
 
 def update_sd_card_ip_address():
     local_ip_address = get_internal_ip_address()
-    continue_on = whiptail_box_yes_no(_("IP Address"), _("Your detected local IP address is {}. This will be added to the SD card boot files. If it has been detected incorrectly, select change below. Otherwise, select continue.".format(local_ip_address)), return_true_false = True, custom_yes=_("Continue"), custom_no=_("Change"), height="9")
+    continue_on = whiptail_box_yes_no(_("IP Address"), _("Your detected local IP address is {}. This will be added to the SD card boot files. If it has been detected incorrectly, select change below. Otherwise, select continue.".format(local_ip_address)), return_true_false = True, custom_yes=_("Continue"), custom_no=_("Change"), height="9", answer_key="IPAddressCorrect", default="yes")
     if not continue_on:
-        local_ip_address = str(whiptail_box("inputbox", _("Custom IP address"),_("Enter the IP address you plan to use for your PiNet server below."),False, return_err=True))
+        local_ip_address = str(whiptail_box("inputbox", _("Custom IP address"),_("Enter the IP address you plan to use for your PiNet server below."),False, return_err=True, answer_key="IPAddress"))
         if not local_ip_address:
             return
     pass # Some sort of check in case they hit cancel?
@@ -2559,80 +4923,140 @@ def install_pinet_theme():
 
 # ------------------------------Main program-------------------------
 
-if __name__ == "__main__":
-    get_release_channel()
-    setup_logger()
-
-    if len(sys.argv) == 1:
+def run_entry_point(argv):
+    """
+    Run one of the entry points the bash side calls as $p, either from the command line or from serve().
+    :param argv: Arguments as they would be in sys.argv, so argv[1] is the entry point name.
+    """
+    if len(argv) == 1:
         print(_("This python script does nothing on its own, it must be passed stuff"))
     else:
-        if sys.argv[1] == "replaceLineOrAdd":
-            replace_line_or_add(sys.argv[2], sys.argv[3], sys.argv[4])
-        elif sys.argv[1] == "replaceBitOrAdd":
-            replace_bit_or_add(sys.argv[2], sys.argv[3], sys.argv[4])
-        elif sys.argv[1] == "CheckInternet":
-            internet_on(sys.argv[2])
-        elif sys.argv[1] == "CheckUpdate":
-            check_update(sys.argv[2])
-        elif sys.argv[1] == "CompareVersion":
-            compare_versions(sys.argv[2], sys.argv[3])
-        elif sys.argv[1] == "updatePiNet":
+        if argv[1] == "replaceLineOrAdd":
+            replace_line_or_add(argv[2], argv[3], argv[4])
+        elif argv[1] == "replaceBitOrAdd":
+            replace_bit_or_add(argv[2], argv[3], argv[4])
+        elif argv[1] == "promptAnswer":
+            # promptAnswer key box-type yes-button [default], see Prompt in pinet
+            answer = get_whiptail_answer(argv[3], argv[2], argv[2], argv[5] if len(argv) > 5 else None,
+                                         custom_yes=argv[4])
+            if answer is None:
+                sys.exit(255)
+            return_data(answer[1])
+            sys.exit(DECLINED_EXIT_CODE if answer[0] else 0)
+        elif argv[1] == "editTextFile":
+            # editTextFile file action search [new_string]...
+            return_data(" ".join(str(matches) for matches in edit_text_file(argv[2], argv[3:])))
+        elif argv[1] == "CheckInternet":
+            internet_on(argv[2])
+        elif argv[1] == "CheckUpdate":
+            check_update(argv[2])
+        elif argv[1] == "CompareVersion":
+            compare_versions(argv[2], argv[3])
+        elif argv[1] == "updatePiNet":
             update_PiNet()
-        elif sys.argv[1] == "triggerInstall":
+        elif argv[1] == "triggerInstall":
             download_file("http://bit.ly/pinetinstall1", "/dev/null")
-        elif sys.argv[1] == "checkKernelFileUpdateWeb":
+        elif argv[1] == "checkKernelFileUpdateWeb":
             check_kernel_file_update_web()
-        elif sys.argv[1] == "checkKernelUpdater":
+        elif argv[1] == "checkKernelUpdater":
             check_kernel_updater()
-        elif sys.argv[1] == "installCheckKernelUpdater":
+        elif argv[1] == "installCheckKernelUpdater":
             install_check_kernel_updater()
-        elif sys.argv[1] == "importFromCSV":
-            import_users_csv(sys.argv[2], sys.argv[3])
-        elif sys.argv[1] == "usersCSVDelete":
-            users_csv_delete(sys.argv[2], sys.argv[3])
-        elif sys.argv[1] == "checkIfFileContainsString":
-            check_if_file_contains(sys.argv[2], sys.argv[3])
-        elif sys.argv[1] == "initialInstallSoftwareList":
+        elif argv[1] == "importFromCSV":
+            import_users_csv(argv[2], argv[3])
+        elif argv[1] == "usersCSVDelete":
+            users_csv_delete(argv[2], argv[3])
+        elif argv[1] == "checkIfFileContainsString":
+            check_if_file_contains(argv[2], argv[3])
+        elif argv[1] == "initialInstallSoftwareList":
             install_software_list(True)
-        elif sys.argv[1] == "installSoftwareList":
+        elif argv[1] == "installSoftwareList":
             install_software_list(False)
-        elif sys.argv[1] == "installSoftwareFromFile":
+        elif argv[1] == "installSoftwareFromFile":
             install_software_from_file()
-        elif sys.argv[1] == "sendStats":
+        elif argv[1] == "sendStats":
             send_status()
-        elif sys.argv[1] == "checkStatsNotification":
+        elif argv[1] == "checkStatsNotification":
             check_stats_notification()
-        elif sys.argv[1] == "askExtraStatsInfo":
+        elif argv[1] == "askExtraStatsInfo":
             ask_extra_stats_info()
-        elif sys.argv[1] == "internetFullStatusCheck":
+        elif argv[1] == "internetFullStatusCheck":
             internet_full_status_check()
-        elif sys.argv[1] == "checkDebianVersion":
+        elif argv[1] == "checkDebianVersion":
             check_debian_version()
-        elif sys.argv[1] == "setConfigParameter":
-            set_config_parameter(sys.argv[2], sys.argv[3])
-        elif sys.argv[1] == "installChrootSoftware":
-            install_chroot_software()
-        elif sys.argv[1] == "verifyCorrectGroupUsers":
+        elif argv[1] == "setConfigParameter":
+            set_config_parameter(argv[2], argv[3])
+        elif argv[1] == "installChrootSoftware":
+            if not install_chroot_software():
+                sys.exit(1)
+        elif argv[1] == "verifyCorrectGroupUsers":
             verify_correct_group_users()
-        elif sys.argv[1] == "verifyCorrectGroupSingleUser":
-            verify_correct_group_single_user(sys.argv[2])
-        elif sys.argv[1] == "selectReleaseChannel":
+        elif argv[1] == "verifyCorrectGroupSingleUser":
+            verify_correct_group_single_user(argv[2])
+        elif argv[1] == "selectReleaseChannel":
             select_release_channel()
-        elif sys.argv[1] == "buildDownloadURL":
-            return_data(build_download_url(sys.argv[2], sys.argv[3]))
-        elif sys.argv[1] == "updateSD":
+        elif argv[1] == "buildDownloadURL":
+            return_data(build_download_url(argv[2], argv[3]))
+        elif argv[1] == "updateSD":
             update_sd()
-        elif sys.argv[1] == "importMigration":
-            import_migration(sys.argv[2])
-        elif sys.argv[1] == "resetThemeCacheForAllUsers":
+        elif argv[1] == "importMigration":
+            import_migration(argv[2])
+        elif argv[1] == "resetThemeCacheForAllUsers":
             reset_theme_cache_for_all_users()
-        elif sys.argv[1] == "getInternalIPAddress":
+        elif argv[1] == "getInternalIPAddress":
             return_data(get_internal_ip_address())
-        elif sys.argv[1] == "customConfig":
+        elif argv[1] == "customConfig":
             custom_config_txt()
-        elif sys.argv[1] == "verifyChrootIntegrity":
+        elif argv[1] == "verifyChrootIntegrity":
             verify_chroot_integrity()
-        elif sys.argv[1] == "UpgradeRaspbianReleasePartTwo":
+        elif argv[1] == "UpgradeRaspbianReleasePartTwo":
             upgrade_raspbian_release_part_two()
-        elif sys.argv[1] == "InstallPiNetTheme":
+        elif argv[1] == "InstallPiNetTheme":
             install_pinet_theme()
+        elif argv[1] == "profileReport":
+            if len(argv) > 3:
+                profile_report(argv[2], int(argv[3]))
+            elif len(argv) > 2:
+                profile_report(argv[2])
+            else:
+                profile_report()
+        elif argv[1] == "aptCacheSeed":
+            AptPackageCache().seed()
+        elif argv[1] == "aptCacheHarvest":
+            AptPackageCache().harvest()
+        elif argv[1] == "aptCacheStats":
+            print_apt_cache_stats()
+        elif argv[1] == "baseRootfsRestore":
+            return_data(str(BaseRootfsCache().restore()).lower())
+        elif argv[1] == "baseRootfsSave":
+            BaseRootfsCache().save()
+        elif argv[1] == "buildCacheRestore":
+            # buildCacheRestore stage:hash...
+            return_data(BuildStageCache().restore(argv[2:]) or "")
+        elif argv[1] == "buildCacheSave":
+            # buildCacheSave stage stage:hash...
+            BuildStageCache().save(argv[2], argv[3:])
+        elif argv[1] == "fastBuildEnable":
+            enable_fast_build()
+        elif argv[1] == "fastBuildFinish":
+            if not finish_fast_build():
+                sys.exit(1)
+        elif argv[1] == "installPlan":
+            print_install_plan()
+        elif argv[1] == "aptUpdate":
+            # aptUpdate server|chroot [force]
+            if apt_update(install_on_server=argv[2] == "server", force="force" in argv[3:],
+                          ignore_errors=True) is not True:
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    get_release_channel()
+    setup_logger()
+    if len(sys.argv) > 3 and sys.argv[1] == "serve":
+        # serve request-pipe response-pipe
+        serve(sys.argv[2], sys.argv[3])
+    else:
+        if profiling_enabled() and len(sys.argv) > 1:
+            atexit.register(record_entry_point, sys.argv[1], time.time(), time.monotonic())
+        run_entry_point(sys.argv)